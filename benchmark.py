@@ -0,0 +1,167 @@
+import argparse, csv, json, platform, random, sys, time, tracemalloc
+from tabulate import tabulate
+from bplus_tree import BPlusTree, InstrumentedBPlusTree
+from hash_join import VirtualDisk, VirtualMemory, generateRelation, hashJoin, hybridHashJoin, sortMergeJoin
+
+FIELDS = ["suite", "case", "op", "ops", "throughput", "p50_us", "p95_us", "p99_us", "peak_kib", "io_count"]
+TREE_OPS = ("insert", "search", "search_many", "range_search", "delete")
+# Probes per search_many call, whose latencies are per batch
+SEARCH_BATCH = 100
+JOIN_METHODS = {
+    "grace hash": lambda mem, disk, R1, R2: hashJoin(mem, disk, R1, R2)[:2],
+    "hybrid hash": lambda mem, disk, R1, R2: hybridHashJoin(mem, disk, R1, R2)[:2],
+    "sort-merge": lambda mem, disk, R1, R2: sortMergeJoin(mem, disk, R1, R2)[:2],
+}
+
+def percentile(ordered, q):
+    # Nearest rank on an already sorted list
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+def result(suite, case, op, latencies_ns, units, peak_bytes, io_count):
+    ordered = sorted(latencies_ns)
+    return {
+        "suite": suite, "case": case, "op": op, "ops": len(latencies_ns),
+        "throughput": round(units / (sum(latencies_ns) / 1e9)) if sum(latencies_ns) else None,
+        "p50_us": round(percentile(ordered, 50) / 1000, 2),
+        "p95_us": round(percentile(ordered, 95) / 1000, 2),
+        "p99_us": round(percentile(ordered, 99) / 1000, 2),
+        "peak_kib": round(peak_bytes / 1024, 1),
+        "io_count": io_count,
+    }
+
+def tree_workload(num_keys, ops, rng):
+    # Keys to load, fresh keys to insert, loaded keys to delete, point and range probes
+    keys = rng.sample(range(20 * num_keys), num_keys + ops)
+    keys, fresh = keys[:num_keys], keys[num_keys:]
+    probes = [rng.choice(keys) if i % 2 else rng.randrange(20 * num_keys) for i in range(ops)]
+    ranges = [(start, start + rng.randint(1, 100)) for start in (rng.randrange(20 * num_keys) for _ in range(ops))]
+    return keys, {
+        "insert": fresh,
+        "search": probes,
+        "search_many": [probes[i:i + SEARCH_BATCH] for i in range(0, ops, SEARCH_BATCH)],
+        "range_search": ranges,
+        "delete": rng.sample(keys, ops),
+    }
+
+def run_tree_ops(tree, workload, op, timed):
+    fn = getattr(tree, op)
+    latencies = []
+    for arg in workload[op]:
+        begin = time.perf_counter_ns()
+        fn(*arg) if op == "range_search" else fn(arg)
+        latencies.append(time.perf_counter_ns() - begin)
+    return latencies if timed else None
+
+def bench_trees(args, rng):
+    results = []
+    for order in args.orders:
+        for layout in args.layouts:
+            keys, workload = tree_workload(args.keys, args.ops, rng)
+            case = f"order={order} {layout} keys={args.keys}"
+            tree = BPlusTree(order, is_sparse=layout == "sparse")
+            tree.build(keys)
+            # Timing on a plain tree, then node visits and allocations on an instrumented
+            # replay, since tracing and instrumentation would both skew the latencies
+            latencies = {op: run_tree_ops(tree, workload, op, True) for op in TREE_OPS}
+            tree = InstrumentedBPlusTree(order, is_sparse=layout == "sparse")
+            tree.build(keys)
+            for op in TREE_OPS:
+                tracemalloc.start()
+                visits = tree.metrics.visits
+                run_tree_ops(tree, workload, op, False)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                units = sum(map(len, workload[op])) if op == "search_many" else len(workload[op])
+                results.append(result("tree", case, op, latencies[op], units, peak, tree.metrics.visits - visits))
+    return results
+
+def join_relations(disk, build_size, probe_size, skew):
+    # R has unique keys, S references them with Zipf-distributed frequencies, so the join
+    # returns one row per S tuple whatever the skew
+    R = generateRelation(disk, "R", build_size, keyRange=(0, 10 * build_size), unique=True)
+    S = generateRelation(disk, "S", probe_size, distribution="zipf" if skew else "uniform", skew=skew, refKeys=R.refKeys)
+    return R, S
+
+def bench_joins(args):
+    results = []
+    for build_size, probe_size in args.sizes:
+        for skew in args.skews:
+            disk = VirtualDisk()
+            R, S = join_relations(disk, build_size, probe_size, skew)
+            for mem_size in args.memory:
+                case = f"R={build_size} S={probe_size} mem={mem_size} skew={skew}"
+                for method, join in JOIN_METHODS.items():
+                    latencies, io_counts = [], set()
+                    for _ in range(args.repeat):
+                        mem = VirtualMemory(mem_size)
+                        begin = time.perf_counter_ns()
+                        joinResults, io_count = join(mem, disk, R, S)
+                        latencies.append(time.perf_counter_ns() - begin)
+                        io_counts.add(io_count)
+                        if len(joinResults) != probe_size:
+                            raise AssertionError(f"{method} {case}: {len(joinResults)} rows, expected {probe_size}")
+                        mem.catalog.clear()
+                    tracemalloc.start()
+                    mem = VirtualMemory(mem_size)
+                    join(mem, disk, R, S)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    mem.catalog.clear()
+                    # Throughput in input tuples per second; IO is deterministic for a given disk
+                    results.append(result("join", case, method, latencies, (build_size + probe_size) * len(latencies), peak, max(io_counts)))
+    return results
+
+def parse_sizes(text):
+    build_size, probe_size = text.split(":")
+    return int(build_size), int(probe_size)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the B+ tree and join implementations")
+    parser.add_argument("suites", nargs="*", default=["trees", "joins"], help="trees, joins or both (default)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--format", choices=["json", "csv", "table"], default="table")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--keys", type=int, default=10000, help="keys loaded into each tree")
+    parser.add_argument("--ops", type=int, default=1000, help="operations of each kind per tree")
+    parser.add_argument("--orders", type=int, nargs="+", default=[13, 24])
+    parser.add_argument("--layouts", nargs="+", choices=["dense", "sparse"], default=["dense", "sparse"])
+    parser.add_argument("--sizes", type=parse_sizes, nargs="+", default=[(1000, 1000), (5000, 5000)],
+                        help="R:S relation sizes in tuples, multiples of the block size")
+    parser.add_argument("--memory", type=int, nargs="+", default=[8, 15, 30], help="memory sizes in blocks")
+    parser.add_argument("--skews", type=float, nargs="+", default=[0, 1.0], help="Zipf exponents of S's keys, 0 is uniform")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each join")
+    args = parser.parse_args(argv)
+    # argparse rejects an empty default for nargs="*" positionals with choices, so check here
+    if not set(args.suites) <= {"trees", "joins"}:
+        parser.error(f"unknown suites: {', '.join(sorted(set(args.suites) - {'trees', 'joins'}))}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    results = []
+    if "trees" in args.suites:
+        results += bench_trees(args, rng)
+    if "joins" in args.suites:
+        # The relation generator draws from the module-level random
+        random.seed(args.seed)
+        results += bench_joins(args)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            meta = {"python": platform.python_version(), "platform": platform.platform(), "argv": sys.argv[1:] if argv is None else argv, "seed": args.seed}
+            json.dump({"meta": meta, "results": results}, out, indent=2)
+            out.write("\n")
+        elif args.format == "csv":
+            writer = csv.DictWriter(out, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            out.write(tabulate([[row[field] for field in FIELDS] for row in results], headers=FIELDS, tablefmt="rounded_grid") + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
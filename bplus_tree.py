@@ -1,5 +1,14 @@
 import math
 import random
+import sys
+import threading
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from heapq import merge
+from operator import itemgetter
 from tabulate import tabulate
 
 DEBUG_ENABLED = False
@@ -7,9 +16,13 @@ def debug_print(*args):
     if DEBUG_ENABLED:
         print(*args)
 class BPlusTreeNode:
-    def __init__(self, threshold, _is_leaf=False):
+    __slots__ = ("threshold", "typecode", "keys", "values", "children", "is_leaf", "next", "prev", "parent", "is_root")
+
+    def __init__(self, threshold, _is_leaf=False, typecode=None):
         self.threshold = threshold
-        self.keys = []
+        self.typecode = typecode
+        self.keys = self.make_keys()
+        self.values = []
         self.children = []
         self.is_leaf = _is_leaf
         self.next = None
@@ -23,65 +36,75 @@ class BPlusTreeNode:
             ret += "\n" + str(child)
         return ret
     
+    def make_keys(self, keys=()):
+        # Integer keys can be stored in a typed array instead of a list of boxed ints
+        return array(self.typecode, keys) if self.typecode else list(keys)
+
     def pretty_keys(self):
         # return tabulate([self.keys], tablefmt="rounded_grid")
         return self.keys
 
-    def insert(self, key):
-        return self._insert_into_leaf(key) if self.is_leaf else self._insert_into_internal(key)
+    def insert(self, key, value=None):
+        return self._insert_into_leaf(key, value) if self.is_leaf else self._insert_into_internal(key, value)
 
     def _sorted_index(self, key):
-        i = 0
-        while i < len(self.keys) and self.keys[i] <= key:
-            i += 1
-        return i
+        return bisect_right(self.keys, key)
 
-    def _insert_into_internal(self, key):
-        ret_key, new_node = self.children[self._sorted_index(key)].insert(key)
+    def _insert_into_internal(self, key, value):
+        ret_key, new_node = self.children[self._sorted_index(key)].insert(key, value)
         if new_node:
-            debug_print(f"Internal node BEFORE: ")
-            debug_print(self.pretty_keys())
+            if DEBUG_ENABLED:
+                debug_print(f"Internal node BEFORE: ")
+                debug_print(self.pretty_keys())
             loc = self._sorted_index(ret_key)
             self.keys.insert(loc, ret_key)
             self.children.insert(loc + 1, new_node)
             new_node.parent = self
-            debug_print(f"Internal node AFTER: ")
-            debug_print(self.pretty_keys())
+            if DEBUG_ENABLED:
+                debug_print(f"Internal node AFTER: ")
+                debug_print(self.pretty_keys())
             if len(self.keys) > self.threshold:
                 return self._split_internal()
         return (None, None)
 
     def _split_leaf(self):
         mid = len(self.keys) // 2
-        new_node = BPlusTreeNode(self.threshold, True)
+        new_node = type(self)(self.threshold, True, self.typecode)
         new_node.keys = self.keys[mid:]
+        new_node.values = self.values[mid:]
         new_node.prev = self
         new_node.next = self.next
         if self.next:
             self.next.prev = new_node
         self.next = new_node
         self.keys = self.keys[:mid]
-        debug_print(f"Leaf node SPLIT AFTER: ")
-        debug_print(self.pretty_keys())
-        debug_print(new_node.pretty_keys())
+        self.values = self.values[:mid]
+        if DEBUG_ENABLED:
+            debug_print(f"Leaf node SPLIT AFTER: ")
+            debug_print(self.pretty_keys())
+            debug_print(new_node.pretty_keys())
         return (new_node.keys[0], new_node)
 
-    def _insert_into_leaf(self, key):
-        debug_print(f"Leaf node: BEFORE:")
-        debug_print(self.pretty_keys())
-        if key in self.keys:
+    def _insert_into_leaf(self, key, value):
+        if DEBUG_ENABLED:
+            debug_print(f"Leaf node: BEFORE:")
+            debug_print(self.pretty_keys())
+        loc = bisect_left(self.keys, key)
+        if loc < len(self.keys) and self.keys[loc] == key:
+            self.values[loc] = value
             return (None, None)
-        self.keys.append(key)
-        self.keys.sort()
-        debug_print(f"Leaf node: AFTER:")
-        debug_print(self.pretty_keys())
+        self.keys.insert(loc, key)
+        self.values.insert(loc, value)
+        if DEBUG_ENABLED:
+            debug_print(f"Leaf node: AFTER:")
+            debug_print(self.pretty_keys())
         if len(self.keys) <= self.threshold:
             return (None, None)
         else:
             return self._split_leaf()
 
     def _split_internal(self):
-        new_node = BPlusTreeNode(self.threshold, False)
+        new_node = type(self)(self.threshold, False, self.typecode)
         mid = len(self.keys) // 2
         new_node.keys = self.keys[mid + 1:]
         k_ret = self.keys[mid]
@@ -91,185 +114,576 @@ class BPlusTreeNode:
         for child in new_node.children:
             child.parent = new_node
 
-        debug_print(f"Internal node SPLIT AFTER: ")
-        debug_print(self.pretty_keys())
-        debug_print(new_node.pretty_keys())
+        if DEBUG_ENABLED:
+            debug_print(f"Internal node SPLIT AFTER: ")
+            debug_print(self.pretty_keys())
+            debug_print(new_node.pretty_keys())
         return (k_ret, new_node)
 
     def is_sibling(self, node):
         return self.parent == node.parent
 
     def delete(self, key):
+        # Returns True when this node fell below its minimum fill and the parent must rebalance it
         if self.is_leaf:
             return self._delete_from_leaf(key)
         else:
             return self._delete_from_internal(key)
 
+    def min_keys(self):
+        return (self.threshold + 1) // 2 if self.is_leaf else self.threshold // 2
+
     def _delete_from_leaf(self, key):
-        debug_print(f"Leaf node: BEFORE:")
-        debug_print(self.pretty_keys())
-        if key not in self.keys:
-            return (None, None)
-        
-        self.keys.remove(key)
-        debug_print(f"Leaf node: AFTER:")
-        debug_print(self.pretty_keys())
-        if len(self.keys) >= math.ceil((self.threshold+1)/2) or self.is_root:
-            return (None, None)
-        elif self.next and self.is_sibling(self.next) and len(self.next.keys) > math.ceil((self.threshold+1)/2):
-            debug_print(f"Leaf node: BORROW BEFORE: SIBLING:")
-            debug_print(self.next.pretty_keys())
-            self.keys.append(self.next.keys.pop(0))
-            debug_print(f"Leaf node: BORROW AFTER: LEAF:")
+        if DEBUG_ENABLED:
+            debug_print(f"Leaf node: BEFORE:")
             debug_print(self.pretty_keys())
-            debug_print(f"Leaf node: BORROW AFTER: SIBLING:")
-            debug_print(self.next.pretty_keys())
-            return (0, self.next.keys[0])
-        elif self.prev and self.is_sibling(self.prev) and len(self.prev.keys) > math.ceil((self.threshold+1)/2):
-            debug_print(f"Leaf node: BORROW BEFORE: SIBLING:")
-            debug_print(self.prev.pretty_keys())
-            self.keys.insert(0, self.prev.keys.pop())
-            debug_print(f"Leaf node: BORROW AFTER: LEAF:")
-            debug_print(self.pretty_keys())
-            debug_print(f"Leaf node: BORROW AFTER: SIBLING:")
-            debug_print(self.prev.pretty_keys())
-            return (1, self.keys[0])
-        elif self.next and self.is_sibling(self.next):
-            debug_print(f"Leaf node: MERGE BEFORE: SIBLING:")
-            debug_print(self.next.pretty_keys())
-            self.keys.extend(self.next.keys)
-            self.next = self.next.next
-            if self.next:
-                self.next.prev = self
-            debug_print(f"Leaf node: MERGE AFTER LEAF:")
+        loc = bisect_left(self.keys, key)
+        if loc == len(self.keys) or self.keys[loc] != key:
+            return False
+
+        del self.keys[loc]
+        del self.values[loc]
+        if DEBUG_ENABLED:
+            debug_print(f"Leaf node: AFTER:")
             debug_print(self.pretty_keys())
-            return (-1, self.keys[0])
-        elif self.prev and self.is_sibling(self.prev):
-            debug_print(f"Leaf node: MERGE BEFORE: SIBLING:")
-            debug_print(self.prev.pretty_keys())
-            self.prev.keys.extend(self.keys)
-            self.prev.next = self.next
-            if self.next:
-                self.next.prev = self.prev
-            debug_print(f"Leaf node: MERGE AFTER LEAF:")
-            debug_print(self.prev.pretty_keys())
-            return (-2, self.prev.keys[0])
-        else:
-            return (None, None)
+        return len(self.keys) < self.min_keys()
 
     def _delete_from_internal(self, key):
         loc = self._sorted_index(key)
-        dir, min_key = self.children[loc].delete(key)
-        if not min_key:
-            return None, None
-        debug_print(f"Internal node: BEFORE:")
-        debug_print(self.pretty_keys())
-        if dir >= 0:
-            self.keys[loc - dir] = min_key
-            debug_print(f"Internal node: AFTER: ")
-            debug_print(self.pretty_keys())
-            return None, None
-        elif dir <0:
-            if dir == -1:
-                self.keys.pop(loc)
-                self.children = self.children.pop(loc)
+        if self.children[loc].delete(key):
+            if DEBUG_ENABLED:
+                debug_print(f"Internal node: BEFORE:")
+                debug_print(self.pretty_keys())
+            self._rebalance_child(loc)
+            if DEBUG_ENABLED:
+                debug_print(f"Internal node: AFTER: ")
+                debug_print(self.pretty_keys())
+        return len(self.keys) < self.min_keys()
+
+    def _rebalance_child(self, loc):
+        # Borrow from a sibling that can spare a key, otherwise merge with one
+        node = self.children[loc]
+        left = self.children[loc - 1] if loc > 0 else None
+        right = self.children[loc + 1] if loc + 1 < len(self.children) else None
+        if left and len(left.keys) > left.min_keys():
+            if DEBUG_ENABLED:
+                debug_print(f"{'Leaf' if node.is_leaf else 'Internal'} node: BORROW BEFORE: SIBLING:")
+                debug_print(left.pretty_keys())
+            if node.is_leaf:
+                node.keys.insert(0, left.keys.pop())
+                node.values.insert(0, left.values.pop())
+                self.keys[loc - 1] = node.keys[0]
+            else:
+                node.keys.insert(0, self.keys[loc - 1])
+                node.children.insert(0, left.children.pop())
+                node.children[0].parent = node
+                self.keys[loc - 1] = left.keys.pop()
+        elif right and len(right.keys) > right.min_keys():
+            if DEBUG_ENABLED:
+                debug_print(f"{'Leaf' if node.is_leaf else 'Internal'} node: BORROW BEFORE: SIBLING:")
+                debug_print(right.pretty_keys())
+            if node.is_leaf:
+                node.keys.append(right.keys.pop(0))
+                node.values.append(right.values.pop(0))
+                self.keys[loc] = right.keys[0]
             else:
-                self.keys.pop(loc - 1)
-                self.children = self.children.pop(loc - 1)
+                node.keys.append(self.keys[loc])
+                node.children.append(right.children.pop(0))
+                node.children[-1].parent = node
+                self.keys[loc] = right.keys.pop(0)
+        elif left:
+            self._merge_children(loc - 1)
+        else:
+            self._merge_children(loc)
 
-        debug_print(f"Internal node: AFTER: ")
-        debug_print(self.pretty_keys())
-        if len(self.keys) >= math.ceil((self.threshold+1)/2):
-            return None, None
+    def _merge_children(self, loc):
+        # Fold children[loc + 1] into children[loc] and drop the separator between them
+        left, right = self.children[loc], self.children[loc + 1]
+        if DEBUG_ENABLED:
+            debug_print(f"{'Leaf' if left.is_leaf else 'Internal'} node: MERGE BEFORE: SIBLING:")
+            debug_print(right.pretty_keys())
+        if left.is_leaf:
+            left.keys.extend(right.keys)
+            left.values.extend(right.values)
+            left.next = right.next
+            if left.next:
+                left.next.prev = left
+        else:
+            left.keys.append(self.keys[loc])
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+            for child in right.children:
+                child.parent = left
+        del self.keys[loc]
+        del self.children[loc + 1]
+        if DEBUG_ENABLED:
+            debug_print(f"{'Leaf' if left.is_leaf else 'Internal'} node: MERGE AFTER:")
+            debug_print(left.pretty_keys())
+
+    def _redistribute(self, loc):
+        # Split the entries of two neighbouring children evenly, moving as many as needed
+        left, right = self.children[loc], self.children[loc + 1]
+        if left.is_leaf:
+            keys, values = left.keys + right.keys, left.values + right.values
+            mid = len(keys) // 2
+            left.keys, right.keys = keys[:mid], keys[mid:]
+            left.values, right.values = values[:mid], values[mid:]
+            self.keys[loc] = right.keys[0]
         else:
-            return dir, self.keys[0]
+            keys = left.keys + left.make_keys([self.keys[loc]]) + right.keys
+            children = left.children + right.children
+            mid = len(keys) // 2
+            left.keys, self.keys[loc], right.keys = keys[:mid], keys[mid], keys[mid + 1:]
+            left.children, right.children = children[:mid + 1], children[mid + 1:]
+            for child in left.children:
+                child.parent = left
+            for child in right.children:
+                child.parent = right
 
+    def _repair(self):
+        # After a bulk delete only the children on the affected spine can be underfull, and
+        # they may be far below the minimum, so merge or redistribute until each one fits.
+        # Repairing grandchildren can shrink a child again, so the pair is re-checked.
+        loc = 0
+        while loc < len(self.children) and len(self.children) > 1:
+            child = self.children[loc]
+            if len(child.keys) >= child.min_keys() and (child.is_leaf or child.keys):
+                loc += 1
+                continue
+            loc = loc - 1 if loc > 0 else loc
+            left, right = self.children[loc], self.children[loc + 1]
+            if len(left.keys) + len(right.keys) + (0 if left.is_leaf else 1) <= self.threshold:
+                self._merge_children(loc)
+                if not left.is_leaf:
+                    left._repair()
+            else:
+                self._redistribute(loc)
+                if not left.is_leaf:
+                    left._repair()
+                    right._repair()
+
+    def delete_range(self, start, end):
+        if self.is_leaf:
+            lo, hi = bisect_left(self.keys, start), bisect_right(self.keys, end)
+            del self.keys[lo:hi]
+            del self.values[lo:hi]
+            return
+        first, last = bisect_right(self.keys, start), bisect_right(self.keys, end)
+        self.children[first].delete_range(start, end)
+        if last == first:
+            self._repair()
+            return
+        self.children[last].delete_range(start, end)
+        # Children strictly between the two boundary children hold only keys in the range
+        if last > first + 1:
+            left, right = self.children[first], self.children[last]
+            while not left.is_leaf:
+                left, right = left.children[-1], right.children[0]
+            left.next, right.prev = right, left
+            del self.children[first + 1:last]
+            del self.keys[first:last - 1]
+        self._repair()
+
+    def delete_many(self, probes, lo, hi):
+        # probes is sorted and unique; each child only receives the slice routed to it
+        if self.is_leaf:
+            keep, j = [], lo
+            for i, key in enumerate(self.keys):
+                while j < hi and probes[j] < key:
+                    j += 1
+                if j == hi or probes[j] != key:
+                    keep.append(i)
+            if len(keep) < len(self.keys):
+                self.keys = self.make_keys(self.keys[i] for i in keep)
+                self.values = [self.values[i] for i in keep]
+            return
+        while lo < hi:
+            child = bisect_right(self.keys, probes[lo])
+            cut = bisect_left(probes, self.keys[child], lo, hi) if child < len(self.keys) else hi
+            self.children[child].delete_many(probes, lo, cut)
+            lo = cut
+        self._repair()
 
     def search(self, key):
         if self.is_leaf:
-            ret = [key] if key in self.keys else []
-            if(ret):
-                debug_print(f"FOUND KEY: {ret}")
-            else:
-                debug_print(f"KEY NOT FOUND")
+            loc = bisect_left(self.keys, key)
+            ret = [key] if loc < len(self.keys) and self.keys[loc] == key else []
+            if DEBUG_ENABLED:
+                debug_print(f"FOUND KEY: {ret}" if ret else "KEY NOT FOUND")
             return ret
         else:
-            for i in range(len(self.keys)):
-                if key < self.keys[i]:
-                    return self.children[i].search(key)
-            return self.children[-1].search(key)
+            return self.children[bisect_right(self.keys, key)].search(key)
+
+    def search_many(self, probes, lo, hi, found, values=None):
+        # probes is sorted; each child only receives the slice of the batch routed to it
+        if self.is_leaf:
+            loc = 0
+            for i in range(lo, hi):
+                loc = bisect_left(self.keys, probes[i], loc)
+                found[i] = loc < len(self.keys) and self.keys[loc] == probes[i]
+                if found[i] and values is not None:
+                    values[i] = self.values[loc]
+        else:
+            while lo < hi:
+                child = bisect_right(self.keys, probes[lo])
+                cut = bisect_left(probes, self.keys[child], lo, hi) if child < len(self.keys) else hi
+                self.children[child].search_many(probes, lo, cut, found, values)
+                lo = cut
 
     def range_search(self, start, end):
         if self.is_leaf:
             node, ret = self, []
+            lo = bisect_left(node.keys, start)
             while node:
-                for key in node.keys:
-                    if key >= start and key <= end:
-                        ret.append(key)
-                    elif key > end:
-                        if ret:
-                            debug_print(f"Leaf nodes iterated: FOUND {len(ret)} KEYS: {ret}")
-                        else:
-                            debug_print(f"Leaf nodes iterated: FOUND NO KEYS")
-                        return ret
-                node = node.next
-            if ret:
-                debug_print(f"Leaf nodes iterated: FOUND {len(ret)} KEYS: {ret}")
-            else:
-                debug_print(f"Leaf nodes iterated: FOUND NO KEYS")
+                hi = bisect_right(node.keys, end, lo)
+                ret.extend(node.keys[lo:hi])
+                if hi < len(node.keys):
+                    if DEBUG_ENABLED:
+                        debug_print(f"Leaf nodes iterated: FOUND {len(ret)} KEYS: {ret}" if ret else "Leaf nodes iterated: FOUND NO KEYS")
+                    return ret
+                node, lo = node.next, 0
+            if DEBUG_ENABLED:
+                debug_print(f"Leaf nodes iterated: FOUND {len(ret)} KEYS: {ret}" if ret else "Leaf nodes iterated: FOUND NO KEYS")
             return ret
         else:
-            for i in range(len(self.keys)):
-                if start < self.keys[i]:
-                    return self.children[i].range_search(start, end)
-            return self.children[-1].range_search(start, end)
+            return self.children[bisect_right(self.keys, start)].range_search(start, end)
 
 
 class BPlusTree:
-    def __init__(self, order, is_sparse=False):
+    node_class = BPlusTreeNode
+    # bulk_merge repacks the whole tree once a batch reaches this fraction of its keys
+    REPACK_FRACTION = 0.1
+
+    def __init__(self, order, is_sparse=False, typecode=None, unique=True, value_typecode=None):
         self.order = order
         self.is_sparse = is_sparse
+        self.typecode = typecode
+        # Non-unique trees keep one leaf entry per key with a posting list of payloads,
+        # stored in a typed array when the payloads are integer record ids
+        self.unique = unique
+        self.value_typecode = value_typecode
         self.threshold = math.ceil(order / 2) if self.is_sparse else order
-        self.root = BPlusTreeNode(self.threshold, True)
+        self.root = self.node_class(self.threshold, True, typecode)
 
-    def insert(self, key):
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Inserting {key}")
-        ret_key, new_node = self.root.insert(key)
+    def insert(self, key, value=None):
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Inserting {key}")
+        if not self.unique:
+            leaf = self.find_leaf(key)
+            loc = bisect_left(leaf.keys, key)
+            if loc < len(leaf.keys) and leaf.keys[loc] == key:
+                leaf.values[loc].append(value)
+                if DEBUG_ENABLED:
+                    debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Inserting {key}\n")
+                return
+            value = self._postings(value)
+        ret_key, new_node = self.root.insert(key, value)
         if new_node:
-            new_root = BPlusTreeNode(self.threshold, False)
-            new_root.is_root = True
-            new_root.keys.append(ret_key)
-            new_root.children.append(self.root)
-            new_root.children.append(new_node)
-            self.root.parent = new_node.parent = self.root = new_root
+            self._grow_root(ret_key, new_node)
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Inserting {key}\n")
+
+    def _grow_root(self, ret_key, new_node):
+        new_root = self.node_class(self.threshold, False, self.typecode)
+        new_root.is_root = True
+        new_root.keys.append(ret_key)
+        new_root.children.append(self.root)
+        new_root.children.append(new_node)
+        self.root.is_root = False
+        self.root.parent = new_node.parent = self.root = new_root
+        if DEBUG_ENABLED:
             debug_print(f"Root node: NEW: ", new_root.keys)
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Inserting {key}\n")
-    
-    def build(self, keys):
-        for key in keys:
-            self.insert(key)
 
-    def delete(self, key):
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Deleting {key}")
-        _, new_node = self.root.delete(key)
-        if new_node:
-            self.root = new_node
+    def _shrink_root(self):
+        while not self.root.is_leaf and not self.root.keys:
+            self.root = self.root.children[0]
             self.root.parent = None
-            debug_print(f"Root node: NEW: ", self.root.keys)
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Deleting {key}\n")
+            self.root.is_root = True
+            if DEBUG_ENABLED:
+                debug_print(f"Root node: NEW: ", self.root.keys)
+    
+    def build(self, keys, bulk=False, fill_factor=1.0, values=None):
+        if bulk:
+            self.bulk_load(keys, fill_factor, values)
+            return
+        if values is None:
+            for key in keys:
+                self.insert(key)
+        else:
+            for key, value in zip(keys, values):
+                self.insert(key, value)
+
+    def bulk_load(self, keys, fill_factor=1.0, values=None):
+        # Sort once, pack the leaves left to right and build the internal levels bottom-up
+        self._load_sorted(*self._merge_batch([], keys, values), fill_factor)
+
+    def bulk_merge(self, keys, fill_factor=None, values=None):
+        # Small batches are spliced into the leaves they land in: one descent per affected
+        # leaf, which is split once into as many leaves as it needs, so the rest of the tree
+        # keeps its fill. A batch of REPACK_FRACTION of the tree or more, or any fill_factor,
+        # merges into the leaf chain in one pass and repacks the whole tree at that fill.
+        if values is None:
+            values = [None] * len(keys)
+        if fill_factor is not None or len(keys) >= self.REPACK_FRACTION * self._estimated_size():
+            self._load_sorted(*self._merge_batch(self.leaf_items(), keys, values), 1.0 if fill_factor is None else fill_factor)
+            return
+        batch = sorted(zip(keys, values), key=itemgetter(0))
+        batch_keys = [key for key, _ in batch]
+        i = 0
+        while i < len(batch):
+            leaf, hi = self._find_leaf_bounded(batch_keys[i])
+            j = len(batch) if hi is None else bisect_left(batch_keys, hi, i)
+            merged_keys, leaf.values = self._merge_batch(zip(leaf.keys, leaf.values), batch_keys[i:j],
+                                                         [value for _, value in batch[i:j]])
+            leaf.keys = leaf.make_keys(merged_keys)
+            if len(leaf.keys) > leaf.threshold:
+                self._split_leaf_into(leaf)
+            i = j
+
+    def _estimated_size(self):
+        # Fanouts along the leftmost path times the fill of the first leaf
+        size, node = 1, self.root
+        while not node.is_leaf:
+            size *= len(node.children)
+            node = node.children[0]
+        return size * len(node.keys)
+
+    def _find_leaf_bounded(self, key):
+        # The leaf key routes to and the separator bounding it on the right (None for the last)
+        node, hi = self.root, None
+        while not node.is_leaf:
+            loc = bisect_right(node.keys, key)
+            if loc < len(node.keys):
+                hi = node.keys[loc]
+            node = node.children[loc]
+        return node, hi
+
+    def _split_leaf_into(self, leaf):
+        # Cut an overfull leaf into evenly filled leaves and hang each new one off the parent
+        chunks = _pack(list(zip(leaf.keys, leaf.values)), leaf.threshold)
+        leaf.keys = leaf.make_keys(key for key, _ in chunks[0])
+        leaf.values = [value for _, value in chunks[0]]
+        left = leaf
+        for chunk in chunks[1:]:
+            new_node = self.node_class(self.threshold, True, self.typecode)
+            new_node.keys = new_node.make_keys(key for key, _ in chunk)
+            new_node.values = [value for _, value in chunk]
+            new_node.prev, new_node.next = left, left.next
+            if left.next:
+                left.next.prev = new_node
+            left.next = new_node
+            self._insert_child(left, new_node.keys[0], new_node)
+            left = new_node
+
+    def _insert_child(self, left, key, child):
+        # Place child right after its sibling left under separator key, splitting the
+        # ancestors on the way up like an insert would
+        parent = left.parent
+        if parent is None:
+            self._grow_root(key, child)
+            return
+        loc = parent._sorted_index(key)
+        parent.keys.insert(loc, key)
+        parent.children.insert(loc + 1, child)
+        child.parent = parent
+        if len(parent.keys) > parent.threshold:
+            self._insert_child(parent, *parent._split_internal())
+
+    def get(self, key, default=None):
+        leaf = self.find_leaf(key)
+        loc = bisect_left(leaf.keys, key)
+        if loc < len(leaf.keys) and leaf.keys[loc] == key:
+            return leaf.values[loc]
+        return default
+
+    def leaf_keys(self):
+        node, ret = self.find_leaf(), []
+        while node:
+            ret.extend(node.keys)
+            node = node.next
+        return ret
+
+    def leaf_items(self):
+        node = self.find_leaf()
+        while node:
+            yield from zip(node.keys, node.values)
+            node = node.next
+
+    def _postings(self, value):
+        return array(self.value_typecode, [value]) if self.value_typecode else [value]
+
+    def _merge_batch(self, existing, keys, values):
+        if values is None:
+            values = [None] * len(keys)
+        batch = sorted(zip(keys, values), key=itemgetter(0))
+        merged_keys, merged_values = [], []
+        # Existing entries sort ahead of batch entries with the same key, so a unique
+        # tree keeps the last value loaded and a non-unique one appends to its postings
+        stream = merge(((key, 0, value) for key, value in existing),
+                       ((key, 1, value) for key, value in batch), key=itemgetter(0, 1))
+        for key, from_batch, value in stream:
+            if merged_keys and merged_keys[-1] == key:
+                if self.unique:
+                    merged_values[-1] = value
+                elif from_batch:
+                    merged_values[-1].append(value)
+                else:
+                    merged_values[-1].extend(value)
+            else:
+                merged_keys.append(key)
+                merged_values.append(self._postings(value) if from_batch and not self.unique else value)
+        return merged_keys, merged_values
+
+    def _load_sorted(self, keys, values, fill_factor):
+        leaf_fill = max(1, min(self.threshold, int(self.threshold * fill_factor)))
+        level = []
+        for chunk, payloads in zip(_pack(keys, leaf_fill), _pack(values, leaf_fill)):
+            leaf = self.node_class(self.threshold, True, self.typecode)
+            leaf.keys = leaf.make_keys(chunk)
+            leaf.values = payloads
+            if level:
+                leaf.prev = level[-1]
+                level[-1].next = leaf
+            level.append(leaf)
+        if not level:
+            level.append(self.node_class(self.threshold, True, self.typecode))
+        mins = [leaf.keys[0] if leaf.keys else None for leaf in level]
+
+        # Internal nodes need threshold // 2 + 1 children to survive deletes, whatever the fill
+        min_children = self.threshold // 2 + 1
+        fanout = min(self.threshold + 1, max(3, min_children, int((self.threshold + 1) * fill_factor)))
+        while len(level) > 1:
+            parents, parent_mins, i = [], [], 0
+            for chunk in _pack(level, fanout, min_children):
+                parent = self.node_class(self.threshold, False, self.typecode)
+                parent.children = chunk
+                parent.keys = parent.make_keys(mins[i + 1:i + len(chunk)])
+                for child in chunk:
+                    child.parent = parent
+                parents.append(parent)
+                parent_mins.append(mins[i])
+                i += len(chunk)
+            level, mins = parents, parent_mins
+
+        self.root = level[0]
+        self.root.parent = None
+        self.root.is_root = True
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] Bulk loaded {len(keys)} keys")
+
+    def delete(self, key, value=None):
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Deleting {key}")
+        if not self.unique and value is not None:
+            # Drop a single payload and only remove the key once its postings are empty
+            postings = self.get(key)
+            if postings is not None and value in postings:
+                postings.remove(value)
+            if postings:
+                if DEBUG_ENABLED:
+                    debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Deleting {key}\n")
+                return
+        self.root.delete(key)
+        self._shrink_root()
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Deleting {key}\n")
+
+    def delete_range(self, start, end):
+        # Drops every key in [start, end] in one pass and only rebalances the two boundary spines
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] Deleting range ({start}, {end})")
+        self.root.delete_range(start, end)
+        self._shrink_root()
+
+    def delete_many(self, keys):
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] Deleting {len(keys)} keys")
+        probes = sorted(set(keys))
+        self.root.delete_many(probes, 0, len(probes))
+        self._shrink_root()
 
     def search(self, key):
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Searching {key}")
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++Searching {key}")
         ret =  self.root.search(key)
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Searching {key}\n")
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --Searching {key}\n")
+        return ret
+
+    def contains_many(self, keys):
+        # Sort the batch once and descend a single time, splitting it among the children
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        probes = [keys[i] for i in order]
+        found = [False] * len(probes)
+        self.root.search_many(probes, 0, len(probes), found)
+        ret = [False] * len(keys)
+        for i, hit in zip(order, found):
+            ret[i] = hit
+        return ret
+
+    def search_many(self, keys):
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] Searching {len(keys)} keys")
+        return [[key] if hit else [] for key, hit in zip(keys, self.contains_many(keys))]
+
+    def get_many(self, keys, default=None):
+        # Batched get: one sorted descent, every node on the way is touched once per batch
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        probes = [keys[i] for i in order]
+        found, values = [False] * len(probes), [None] * len(probes)
+        self.root.search_many(probes, 0, len(probes), found, values)
+        ret = [default] * len(keys)
+        for i, hit, value in zip(order, found, values):
+            if hit:
+                ret[i] = value
         return ret
 
     def range_search(self, start, end):
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++RangeSearching ({start}, {end})")
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] ++RangeSearching ({start}, {end})")
         ret = self.root.range_search(start, end)
-        debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --RangeSearching ({start}, {end})\n")
+        if DEBUG_ENABLED:
+            debug_print(f"[B+ {self.order} {'sparse' if self.is_sparse else 'dense'}] --RangeSearching ({start}, {end})\n")
         return ret
 
+    def cursor(self, start=None, end=None, reverse=False, include_start=True, include_end=True, limit=None, resume=None, items=False):
+        # Lazy alternative to range_search: None means an open bound, resume is a
+        # cursor.position saved from an earlier scan over the same range and items
+        # yields (key, value) pairs instead of bare keys
+        if resume is not None:
+            if reverse:
+                end, include_end = resume, False
+            else:
+                start, include_start = resume, False
+        return BPlusTreeCursor(self, start, end, reverse, include_start, include_end, limit, items)
+
+    def find_leaf(self, key=None, rightmost=False):
+        node = self.root
+        while not node.is_leaf:
+            if key is None:
+                node = node.children[-1] if rightmost else node.children[0]
+            else:
+                node = node.children[bisect_right(node.keys, key)]
+        return node
+
+    def stats(self):
+        height, node = 1, self.root
+        while not node.is_leaf:
+            node = node.children[0]
+            height += 1
+        leaves, keys, histogram = 0, 0, [0] * 10
+        while node:
+            leaves += 1
+            keys += len(node.keys)
+            histogram[min(9, len(node.keys) * 10 // self.threshold)] += 1
+            node = node.next
+        return {
+            "height": height,
+            "leaves": leaves,
+            "keys": keys,
+            "leaf_fill_histogram": {f"{i * 10}-{i * 10 + 10}%": count for i, count in enumerate(histogram)},
+        }
+
     def __repr__(self) -> str:
         ret = "---- B+ Tree ----\n"
         ret += str(self.root)
@@ -277,6 +691,761 @@ class BPlusTree:
         return ret
 
 
+class BPlusTreeCursor:
+    def __init__(self, tree, start, end, reverse, include_start, include_end, limit, items=False):
+        self.items = items
+        self.start, self.end = start, end
+        self.include_start, self.include_end = include_start, include_end
+        self.reverse = reverse
+        self.limit = limit
+        self.count = 0
+        self.position = None
+        if reverse:
+            self.node = tree.find_leaf(end, rightmost=True)
+            if end is None:
+                self.index = len(self.node.keys) - 1
+            else:
+                self.index = (bisect_right if include_end else bisect_left)(self.node.keys, end) - 1
+        else:
+            self.node = tree.find_leaf(start)
+            if start is None:
+                self.index = 0
+            else:
+                self.index = (bisect_left if include_start else bisect_right)(self.node.keys, start)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.node is None or (self.limit is not None and self.count >= self.limit):
+            raise StopIteration
+        if self.reverse:
+            while self.index < 0:
+                self.node = self.node.prev
+                if self.node is None:
+                    raise StopIteration
+                self.index = len(self.node.keys) - 1
+            key = self.node.keys[self.index]
+            if self.start is not None and (key < self.start or (key == self.start and not self.include_start)):
+                self.node = None
+                raise StopIteration
+            value = self.node.values[self.index]
+            self.index -= 1
+        else:
+            while self.index >= len(self.node.keys):
+                self.node = self.node.next
+                if self.node is None:
+                    raise StopIteration
+                self.index = 0
+            key = self.node.keys[self.index]
+            if self.end is not None and (key > self.end or (key == self.end and not self.include_end)):
+                self.node = None
+                raise StopIteration
+            value = self.node.values[self.index]
+            self.index += 1
+        self.count += 1
+        self.position = key
+        return (key, value) if self.items else key
+
+    def close(self):
+        self.node = None
+
+
+class LatchedBPlusTreeNode(BPlusTreeNode):
+    __slots__ = ("latch", "version", "obsolete")
+
+    def __init__(self, threshold, _is_leaf=False, typecode=None):
+        super().__init__(threshold, _is_leaf, typecode)
+        self.latch = threading.Lock()
+        # Even while the node is stable, odd while a writer may be changing it
+        self.version = 0
+        # Set under the latch once the node is unlinked from the tree
+        self.obsolete = False
+
+    def _merge_children(self, loc):
+        self.children[loc + 1].obsolete = True
+        super()._merge_children(loc)
+
+
+class ConcurrentBPlusTree(BPlusTree):
+    # Writers crab latches top-down, readers validate node versions and fall back to
+    # latches after OPTIMISTIC_RETRIES failed attempts. build/bulk_*, delete_range,
+    # delete_many and cursor still need exclusive access to the tree.
+    node_class = LatchedBPlusTreeNode
+    OPTIMISTIC_RETRIES = 16
+
+    def __init__(self, order, is_sparse=False, typecode=None, unique=True, value_typecode=None):
+        super().__init__(order, is_sparse, typecode, unique, value_typecode)
+        self.root_latch = threading.Lock()
+        self.optimistic_retries = 0
+
+    def _latch_path(self, key, is_safe, root_is_safe):
+        # Ancestors stay latched only while the node below them may split or underflow;
+        # root_latch guards the root pointer while the root itself may change
+        self.root_latch.acquire()
+        node = self.root
+        node.latch.acquire()
+        held, root_held = [node], True
+        if root_is_safe(node):
+            self.root_latch.release()
+            root_held = False
+        while not node.is_leaf:
+            child = node.children[bisect_right(node.keys, key)]
+            child.latch.acquire()
+            if is_safe(child):
+                for ancestor in held:
+                    ancestor.latch.release()
+                held = []
+                if root_held:
+                    self.root_latch.release()
+                    root_held = False
+            held.append(child)
+            node = child
+        return held, root_held
+
+    def _release(self, latched, root_held):
+        for node in latched:
+            node.latch.release()
+        if root_held:
+            self.root_latch.release()
+
+    def _begin_write(self, nodes):
+        for node in nodes:
+            node.version += 1
+
+    def _end_write(self, nodes):
+        for node in nodes:
+            # A node merged away stays odd so optimistic readers still holding it restart
+            if not node.obsolete:
+                node.version += 1
+
+    def _shrink_root(self):
+        root = self.root
+        super()._shrink_root()
+        if self.root is not root:
+            root.obsolete = True
+
+    def insert(self, key, value=None):
+        held, root_held = self._latch_path(key, lambda node: len(node.keys) < node.threshold,
+                                           lambda node: len(node.keys) < node.threshold)
+        latched, leaf = list(held), held[-1]
+        try:
+            loc = bisect_left(leaf.keys, key)
+            exists = loc < len(leaf.keys) and leaf.keys[loc] == key
+            if not self.unique:
+                if exists:
+                    self._begin_write([leaf])
+                    leaf.values[loc].append(value)
+                    self._end_write([leaf])
+                    return
+                value = self._postings(value)
+            # A leaf split relinks the next leaf's prev pointer
+            if not exists and len(leaf.keys) >= leaf.threshold and leaf.next:
+                leaf.next.latch.acquire()
+                latched.append(leaf.next)
+            self._begin_write(latched)
+            ret_key, new_node = held[0].insert(key, value)
+            if new_node:
+                self._grow_root(ret_key, new_node)
+            self._end_write(latched)
+        finally:
+            self._release(latched, root_held)
+
+    def delete(self, key, value=None):
+        while True:
+            held, root_held = self._latch_path(key, lambda node: len(node.keys) > node.min_keys(),
+                                               lambda node: node.is_leaf or len(node.keys) > 1)
+            latched = self._latch_rebalance_set(key, held)
+            if latched is not None:
+                break
+            self._release(held, root_held)
+            time.sleep(0)
+        try:
+            leaf = held[-1]
+            if not self.unique and value is not None:
+                # Drop a single payload and only remove the key once its postings are empty
+                loc = bisect_left(leaf.keys, key)
+                if loc == len(leaf.keys) or leaf.keys[loc] != key or value not in leaf.values[loc]:
+                    return
+                if len(leaf.values[loc]) > 1:
+                    self._begin_write([leaf])
+                    leaf.values[loc].remove(value)
+                    self._end_write([leaf])
+                    return
+            self._begin_write(latched)
+            held[0].delete(key)
+            if root_held:
+                self._shrink_root()
+            self._end_write(latched)
+        finally:
+            self._release(latched, root_held)
+
+    def _latch_rebalance_set(self, key, held):
+        # Every held child below held[0] may underflow, so its siblings (and for leaves
+        # the leaf after a merge) are latched too. Leftward latches are only tried, and
+        # the whole delete restarts if one is busy, so latches never wait right-to-left.
+        latched, seen = list(held), {id(node) for node in held}
+
+        def grab(node, blocking):
+            if node is None or id(node) in seen:
+                return True
+            if not node.latch.acquire(blocking):
+                return False
+            latched.append(node)
+            seen.add(id(node))
+            return True
+
+        for parent, child in zip(held, held[1:]):
+            loc = bisect_right(parent.keys, key)
+            left = parent.children[loc - 1] if loc > 0 else None
+            right = parent.children[loc + 1] if loc + 1 < len(parent.children) else None
+            ok = grab(left, False) and grab(right, True)
+            if ok and child.is_leaf:
+                ok = grab(child.next, True) and (right is None or grab(right.next, True))
+            if not ok:
+                for node in latched[len(held):]:
+                    node.latch.release()
+                return None
+        return latched
+
+    def _optimistic_leaf(self, key):
+        node = self.root
+        version = node.version
+        # A root split or collapse between the two loads leaves node off the tree
+        if version & 1 or node is not self.root:
+            return None, None
+        try:
+            while not node.is_leaf:
+                child = node.children[bisect_right(node.keys, key)]
+                child_version = child.version
+                if node.version != version or child_version & 1:
+                    return None, None
+                node, version = child, child_version
+        except IndexError:
+            return None, None
+        return node, version
+
+    def _locked_leaf(self, key):
+        self.root_latch.acquire()
+        node = self.root
+        node.latch.acquire()
+        self.root_latch.release()
+        while not node.is_leaf:
+            child = node.children[bisect_right(node.keys, key)]
+            child.latch.acquire()
+            node.latch.release()
+            node = child
+        return node
+
+    def _read_leaf(self, key, read):
+        for _ in range(self.OPTIMISTIC_RETRIES):
+            leaf, version = self._optimistic_leaf(key)
+            if leaf is not None:
+                try:
+                    ret = read(leaf)
+                    if leaf.version == version:
+                        return ret
+                except IndexError:
+                    pass
+            self.optimistic_retries += 1
+        leaf = self._locked_leaf(key)
+        try:
+            return read(leaf)
+        finally:
+            leaf.latch.release()
+
+    def search(self, key):
+        def read(leaf):
+            loc = bisect_left(leaf.keys, key)
+            return [key] if loc < len(leaf.keys) and leaf.keys[loc] == key else []
+        return self._read_leaf(key, read)
+
+    def get(self, key, default=None):
+        def read(leaf):
+            loc = bisect_left(leaf.keys, key)
+            return leaf.values[loc] if loc < len(leaf.keys) and leaf.keys[loc] == key else default
+        return self._read_leaf(key, read)
+
+    def contains_many(self, keys):
+        return [bool(self.search(key)) for key in keys]
+
+    def get_many(self, keys, default=None):
+        return [self.get(key, default) for key in keys]
+
+    def range_scan(self, start, end):
+        # Each leaf is copied and validated before its keys are yielded; on a conflict
+        # the scan descends again from the last key it returned
+        last = None
+        while True:
+            bound = start if last is None else last
+
+            def read(leaf):
+                lo = bisect_left(leaf.keys, bound) if last is None else bisect_right(leaf.keys, bound)
+                return list(leaf.keys[lo:]), leaf.next
+            chunk, node = self._read_leaf(bound, read)
+            while True:
+                for key in chunk:
+                    if key > end:
+                        return
+                    last = key
+                    yield key
+                if node is None:
+                    return
+                version = node.version
+                if version & 1:
+                    break
+                try:
+                    chunk, next_node = list(node.keys), node.next
+                except IndexError:
+                    break
+                if node.version != version:
+                    break
+                node = next_node
+            self.optimistic_retries += 1
+
+    def range_search(self, start, end):
+        return list(self.range_scan(start, end))
+
+
+class CopyOnWriteNode:
+    # No parent or sibling pointers: a node may be shared by several versions of the tree
+    __slots__ = ("keys", "values", "children", "is_leaf", "epoch")
+
+    def __init__(self, is_leaf, epoch, keys=None, values=None, children=None):
+        self.keys = keys if keys is not None else []
+        self.values = values if values is not None else []
+        self.children = children if children is not None else []
+        self.is_leaf = is_leaf
+        self.epoch = epoch
+
+    def copy(self, epoch):
+        return CopyOnWriteNode(self.is_leaf, epoch, self.keys[:], self.values[:], self.children[:])
+
+    def min_keys(self, threshold):
+        return (threshold + 1) // 2 if self.is_leaf else threshold // 2
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.keys) + sys.getsizeof(self.values) + sys.getsizeof(self.children)
+
+
+def _cow_find(node, key):
+    while not node.is_leaf:
+        node = node.children[bisect_right(node.keys, key)]
+    loc = bisect_left(node.keys, key)
+    return node, loc, loc < len(node.keys) and node.keys[loc] == key
+
+def _cow_scan(node, start, end):
+    # Ordered (key, value) pairs in [start, end], None being an open bound; without a leaf
+    # chain the scan walks down the tree, slicing each node once
+    if node.is_leaf:
+        lo = 0 if start is None else bisect_left(node.keys, start)
+        hi = len(node.keys) if end is None else bisect_right(node.keys, end)
+        yield from zip(node.keys[lo:hi], node.values[lo:hi])
+        return
+    first = 0 if start is None else bisect_right(node.keys, start)
+    last = len(node.keys) if end is None else bisect_right(node.keys, end)
+    for child in node.children[first:last + 1]:
+        yield from _cow_scan(child, start, end)
+
+
+class BPlusTreeSnapshot:
+    # A frozen version of a CopyOnWriteBPlusTree; reads need no latches. The nodes only it
+    # still references are reclaimed when it is closed or garbage collected.
+    def __init__(self, tree, root, epoch, size):
+        self.root = root
+        self.epoch = epoch
+        self.size = size
+        self._release = weakref.finalize(self, tree._release_snapshot, epoch)
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.root = None
+        self._release()
+
+    def get(self, key, default=None):
+        node, loc, found = _cow_find(self.root, key)
+        return node.values[loc] if found else default
+
+    def search(self, key):
+        return [key] if _cow_find(self.root, key)[2] else []
+
+    def range_search(self, start, end):
+        return [key for key, _ in _cow_scan(self.root, start, end)]
+
+    def scan(self, start=None, end=None):
+        return _cow_scan(self.root, start, end)
+
+
+class CopyOnWriteBPlusTree:
+    # Unique-key B+ tree whose snapshots stay consistent while writers continue. Every
+    # node records the epoch it was created in and snapshot() starts a new epoch, so a
+    # node from an epoch a live snapshot can see is copied, together with its path from
+    # the root, before a writer changes it. Nodes no snapshot can see are changed in place.
+    # Writers and snapshot() serialize on a lock; reads of the live tree are only safe
+    # while no writer runs, concurrent readers should take a snapshot.
+    def __init__(self, order, is_sparse=False):
+        self.order = order
+        self.is_sparse = is_sparse
+        self.unique = True
+        self.threshold = math.ceil(order / 2) if self.is_sparse else order
+        self.epoch = 0
+        # Nodes of this epoch or older are visible to a live snapshot
+        self.frozen = -1
+        self.snapshot_epochs = Counter()
+        self.snapshots = weakref.WeakSet()
+        self.lock = threading.RLock()
+        self.root = CopyOnWriteNode(True, self.epoch)
+        self.size = 0
+        self.copies = 0
+
+    def __len__(self):
+        return self.size
+
+    def _writable(self, node):
+        if node.epoch > self.frozen:
+            return node
+        self.copies += 1
+        return node.copy(self.epoch)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = BPlusTreeSnapshot(self, self.root, self.epoch, self.size)
+            self.snapshot_epochs[self.epoch] += 1
+            self.frozen = self.epoch
+            self.epoch += 1
+            self.snapshots.add(snapshot)
+            return snapshot
+
+    def _release_snapshot(self, epoch):
+        # Lowering frozen is always safe: nodes past it are only reachable from the live tree
+        with self.lock:
+            self.snapshot_epochs[epoch] -= 1
+            if not self.snapshot_epochs[epoch]:
+                del self.snapshot_epochs[epoch]
+            self.frozen = max(self.snapshot_epochs, default=-1)
+
+    def insert(self, key, value=None):
+        with self.lock:
+            root, ret_key, new_node = self._insert(self.root, key, value)
+            if new_node:
+                root = CopyOnWriteNode(False, self.epoch, [ret_key], children=[root, new_node])
+            # Publishing the new root is a single assignment
+            self.root = root
+
+    def _insert(self, node, key, value):
+        node = self._writable(node)
+        if node.is_leaf:
+            loc = bisect_left(node.keys, key)
+            if loc < len(node.keys) and node.keys[loc] == key:
+                node.values[loc] = value
+                return node, None, None
+            node.keys.insert(loc, key)
+            node.values.insert(loc, value)
+            self.size += 1
+            if len(node.keys) <= self.threshold:
+                return node, None, None
+            mid = len(node.keys) // 2
+            new_node = CopyOnWriteNode(True, self.epoch, node.keys[mid:], node.values[mid:])
+            del node.keys[mid:], node.values[mid:]
+            return node, new_node.keys[0], new_node
+        loc = bisect_right(node.keys, key)
+        child, ret_key, new_child = self._insert(node.children[loc], key, value)
+        node.children[loc] = child
+        if new_child:
+            node.keys.insert(loc, ret_key)
+            node.children.insert(loc + 1, new_child)
+            if len(node.keys) > self.threshold:
+                mid = len(node.keys) // 2
+                ret_key = node.keys[mid]
+                new_node = CopyOnWriteNode(False, self.epoch, node.keys[mid + 1:], children=node.children[mid + 1:])
+                del node.keys[mid:], node.children[mid + 1:]
+                return node, ret_key, new_node
+        return node, None, None
+
+    def delete(self, key):
+        with self.lock:
+            # Only copy a path when there is something to delete
+            if not _cow_find(self.root, key)[2]:
+                return
+            root, _ = self._delete(self.root, key)
+            while not root.is_leaf and not root.keys:
+                root = root.children[0]
+            self.root = root
+            self.size -= 1
+
+    def _delete(self, node, key):
+        # Returns the writable node and whether it fell below its minimum fill
+        node = self._writable(node)
+        if node.is_leaf:
+            loc = bisect_left(node.keys, key)
+            del node.keys[loc], node.values[loc]
+            return node, len(node.keys) < node.min_keys(self.threshold)
+        loc = bisect_right(node.keys, key)
+        child, underfull = self._delete(node.children[loc], key)
+        node.children[loc] = child
+        if underfull:
+            self._rebalance_child(node, loc)
+        return node, len(node.keys) < node.min_keys(self.threshold)
+
+    def _rebalance_child(self, node, loc):
+        # As BPlusTreeNode._rebalance_child, but a sibling is copied before it changes
+        child = node.children[loc]
+        left = node.children[loc - 1] if loc > 0 else None
+        right = node.children[loc + 1] if loc + 1 < len(node.children) else None
+        if left and len(left.keys) > left.min_keys(self.threshold):
+            left = node.children[loc - 1] = self._writable(left)
+            if child.is_leaf:
+                child.keys.insert(0, left.keys.pop())
+                child.values.insert(0, left.values.pop())
+                node.keys[loc - 1] = child.keys[0]
+            else:
+                child.keys.insert(0, node.keys[loc - 1])
+                child.children.insert(0, left.children.pop())
+                node.keys[loc - 1] = left.keys.pop()
+        elif right and len(right.keys) > right.min_keys(self.threshold):
+            right = node.children[loc + 1] = self._writable(right)
+            if child.is_leaf:
+                child.keys.append(right.keys.pop(0))
+                child.values.append(right.values.pop(0))
+                node.keys[loc] = right.keys[0]
+            else:
+                child.keys.append(node.keys[loc])
+                child.children.append(right.children.pop(0))
+                node.keys[loc] = right.keys.pop(0)
+        else:
+            # Merge into the left node of the pair; the right one is dropped unchanged
+            if left:
+                loc -= 1
+                left = node.children[loc] = self._writable(left)
+            else:
+                left = child
+            right = node.children[loc + 1]
+            if left.is_leaf:
+                left.keys.extend(right.keys)
+                left.values.extend(right.values)
+            else:
+                left.keys.append(node.keys[loc])
+                left.keys.extend(right.keys)
+                left.children.extend(right.children)
+            del node.keys[loc], node.children[loc + 1]
+
+    def delete_range(self, start, end):
+        for key in self.range_search(start, end):
+            self.delete(key)
+
+    def delete_many(self, keys):
+        for key in set(keys):
+            self.delete(key)
+
+    def get(self, key, default=None):
+        node, loc, found = _cow_find(self.root, key)
+        return node.values[loc] if found else default
+
+    def search(self, key):
+        return [key] if _cow_find(self.root, key)[2] else []
+
+    def range_search(self, start, end):
+        return [key for key, _ in _cow_scan(self.root, start, end)]
+
+    def leaf_items(self):
+        return _cow_scan(self.root, None, None)
+
+    def leaf_keys(self):
+        return [key for key, _ in _cow_scan(self.root, None, None)]
+
+    def _nodes(self, root, skip=()):
+        # Every node reachable from root, not descending into nodes in skip: in a
+        # copy-on-write tree a shared node shares its whole subtree
+        stack, seen = [root], []
+        while stack:
+            node = stack.pop()
+            if id(node) in skip:
+                continue
+            seen.append(node)
+            stack.extend(node.children)
+        return seen
+
+    def stats(self):
+        height, node = 1, self.root
+        while not node.is_leaf:
+            node = node.children[0]
+            height += 1
+        nodes = self._nodes(self.root)
+        return {
+            "height": height,
+            "leaves": sum(node.is_leaf for node in nodes),
+            "keys": self.size,
+            "nodes": len(nodes),
+            "bytes": sum(node.nbytes() for node in nodes),
+        }
+
+    def snapshot_stats(self):
+        # What each live snapshot keeps alive beyond the current version: nodes shared with
+        # another old snapshot are counted for each of them
+        with self.lock:
+            current = {id(node) for node in self._nodes(self.root)}
+            snapshots = sorted((snapshot for snapshot in self.snapshots if snapshot.root is not None), key=lambda snapshot: snapshot.epoch)
+            retained = [self._nodes(snapshot.root, current) for snapshot in snapshots]
+            return {
+                "live_snapshots": len(snapshots),
+                "copied_nodes": self.copies,
+                "snapshots": [{"epoch": snapshot.epoch, "keys": snapshot.size, "retained_nodes": len(nodes),
+                               "retained_bytes": sum(node.nbytes() for node in nodes)}
+                              for snapshot, nodes in zip(snapshots, retained)],
+            }
+
+
+class TreeMetrics:
+    def __init__(self):
+        self.visits = 0
+        self.operations = Counter()
+        self.nodes_visited = Counter()
+        self.events = Counter()
+        # Latencies go into power-of-two microsecond buckets per operation
+        self.latency = defaultdict(Counter)
+
+    def record(self, op, visited, elapsed_ns):
+        self.operations[op] += 1
+        self.nodes_visited[op] += visited
+        self.latency[op][(elapsed_ns // 1000).bit_length()] += 1
+
+    def snapshot(self):
+        return {
+            "operations": dict(self.operations),
+            "nodes_visited_per_op": {op: self.nodes_visited[op] / count for op, count in self.operations.items()},
+            "events": dict(self.events),
+            "latency_us": {op: {f"<{2 ** bucket}": hist[bucket] for bucket in sorted(hist)}
+                           for op, hist in self.latency.items()},
+        }
+
+
+class InstrumentedBPlusTreeNode(BPlusTreeNode):
+    __slots__ = ()
+    metrics = None
+
+    def insert(self, key, value=None):
+        self.metrics.visits += 1
+        return super().insert(key, value)
+
+    def delete(self, key):
+        self.metrics.visits += 1
+        return super().delete(key)
+
+    def search(self, key):
+        self.metrics.visits += 1
+        return super().search(key)
+
+    def search_many(self, probes, lo, hi, found, values=None):
+        self.metrics.visits += 1
+        return super().search_many(probes, lo, hi, found, values)
+
+    def range_search(self, start, end):
+        self.metrics.visits += 1
+        if self.is_leaf:
+            # Count the extra leaves the scan walks along the next chain
+            node = self
+            while node.next and (not node.keys or node.keys[-1] <= end):
+                node = node.next
+                self.metrics.visits += 1
+        return super().range_search(start, end)
+
+    def _split_leaf(self):
+        self.metrics.events["leaf_split"] += 1
+        return super()._split_leaf()
+
+    def _split_internal(self):
+        self.metrics.events["internal_split"] += 1
+        return super()._split_internal()
+
+    def _rebalance_child(self, loc):
+        kind, count = "leaf" if self.children[loc].is_leaf else "internal", len(self.children)
+        super()._rebalance_child(loc)
+        if len(self.children) == count:
+            self.metrics.events[f"{kind}_borrow"] += 1
+
+    def _merge_children(self, loc):
+        self.metrics.events[f"{'leaf' if self.children[loc].is_leaf else 'internal'}_merge"] += 1
+        super()._merge_children(loc)
+
+    def _redistribute(self, loc):
+        self.metrics.events[f"{'leaf' if self.children[loc].is_leaf else 'internal'}_borrow"] += 1
+        super()._redistribute(loc)
+
+    def delete_range(self, start, end):
+        self.metrics.visits += 1
+        super().delete_range(start, end)
+
+    def delete_many(self, probes, lo, hi):
+        self.metrics.visits += 1
+        super().delete_many(probes, lo, hi)
+
+
+class InstrumentedBPlusTree(BPlusTree):
+    # Same tree with per-operation metrics; a plain BPlusTree pays nothing for them
+    def __init__(self, order, is_sparse=False, typecode=None, unique=True, value_typecode=None):
+        self.metrics = TreeMetrics()
+        # Nodes created by splits inherit this per-tree class and report to its metrics
+        self.node_class = type("InstrumentedBPlusTreeNode", (InstrumentedBPlusTreeNode,),
+                               {"__slots__": (), "metrics": self.metrics})
+        super().__init__(order, is_sparse, typecode, unique, value_typecode)
+
+    def _timed(self, op, fn, *args):
+        visits = self.metrics.visits
+        begin = time.perf_counter_ns()
+        ret = fn(*args)
+        self.metrics.record(op, self.metrics.visits - visits, time.perf_counter_ns() - begin)
+        return ret
+
+    def insert(self, key, value=None):
+        return self._timed("insert", super().insert, key, value)
+
+    def delete(self, key, value=None):
+        return self._timed("delete", super().delete, key, value)
+
+    def delete_range(self, start, end):
+        return self._timed("delete_range", super().delete_range, start, end)
+
+    def delete_many(self, keys):
+        return self._timed("delete_many", super().delete_many, keys)
+
+    def search(self, key):
+        return self._timed("search", super().search, key)
+
+    def contains_many(self, keys):
+        return self._timed("search_many", super().contains_many, keys)
+
+    def get_many(self, keys, default=None):
+        return self._timed("get_many", super().get_many, keys, default)
+
+    def range_search(self, start, end):
+        return self._timed("range_search", super().range_search, start, end)
+
+    def stats(self):
+        ret = super().stats()
+        ret.update(self.metrics.snapshot())
+        return ret
+
+
+def _pack(items, per_node, min_per_node=1):
+    # Split items into the fewest nodes holding at most per_node each, spread evenly
+    # so the last node is never left underfull. Nodes that would hold fewer than
+    # min_per_node are folded into the others, which may then exceed per_node.
+    count = max(1, min(math.ceil(len(items) / per_node), len(items) // min_per_node))
+    ret, start = [], 0
+    for i in range(count):
+        end = start + (len(items) - start) // (count - i)
+        ret.append(items[start:end])
+        start = end
+    return ret
+
 def generate_keys(count = 10000, low = 100000, high=200000):
     return random.sample(range(low, high), count)
 
@@ -298,7 +1467,7 @@ def debug():
     print(tree.range_search(13, 22))
 
 
-def build_trees():
+def build_trees(keys):
     dense_tree_13 = BPlusTree(13, is_sparse=False)
     dense_tree_13.build(keys)
 
@@ -313,73 +1482,166 @@ def build_trees():
 
     return dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24
 
-def random_insert_delete(tree, keys, count=5):
+def random_insert_delete(tree, keys, count=5, model=None):
+    # model, a ReferenceModel of the tree, is kept in step when given
     for _ in range(count):
         key = generate_key()
         tree.insert(key)
+        if model is not None:
+            model.insert(key)
     for _ in range(count):
         key = random.sample(keys, 1)[0]
         tree.delete(key)
+        if model is not None:
+            model.delete(key)
 
-def validate_search(ret, key, keys):
-    if (ret and ret[0]!=key) or (key in keys and not key in ret):
+def validate_search(ret, key, model):
+    if ret != model.search(key):
         print("Search validation failed")
 
-def validate_range_search(ret, start, end, keys):
-    if not ret:
-        if any([key >= start and key <= end for key in keys]):
-            print("Range search validation failed")
-    else:
-        rkeys = sorted([key for key in keys if key >= start and key <= end])
-        ret = sorted(ret)
-        if len(ret) != len(rkeys):
-            print("Range search validation failed")
-        else:
-            for i in range(len(ret)):
-                if ret[i] != rkeys[i]:
-                    print("Range search validation failed")
+def validate_range_search(ret, start, end, model):
+    if ret != model.range_search(start, end):
+        print("Range search validation failed")
 
-def random_search(tree, key, count=5):
+def random_search(tree, keys, count=5):
+    # The test oracle is only imported by the workloads that validate against it
+    from verify import ReferenceModel
+    model = keys if isinstance(keys, ReferenceModel) else ReferenceModel(keys)
     for _ in range(count):
         start = random.randint(100000, 200000)
         end = start + random.randint(1, 100)
         ret = tree.range_search(start, end)
-        validate_range_search(ret, start, end, keys)
+        validate_range_search(ret, start, end, model)
 
     for _ in range(count):
         key = random.randint(100000, 200000)
         ret = tree.search(key)
-        validate_search(ret, key, keys)
+        validate_search(ret, key, model)
+
+def concurrent_stress_test(order=13, thread_counts=(1, 2, 4, 8), ops_per_thread=5000, count=10000):
+    # Even keys are loaded up front and never deleted, odd keys are inserted and deleted
+    # while other threads scan, so every scan must return each even key in its range in order
+    global DEBUG_ENABLED
+    DEBUG_ENABLED = False
+    rows = []
+    for threads in thread_counts:
+        tree = ConcurrentBPlusTree(order)
+        stable = list(range(0, 2 * count, 2))
+        for key in random.sample(stable, len(stable)):
+            tree.insert(key)
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            for _ in range(ops_per_thread):
+                op = rng.random()
+                key = rng.randrange(1, 2 * count, 2)
+                if op < 0.3:
+                    tree.insert(key)
+                elif op < 0.6:
+                    tree.delete(key)
+                elif op < 0.9:
+                    probe = rng.randrange(0, 2 * count, 2)
+                    if tree.search(probe) != [probe]:
+                        errors.append(("search", probe))
+                else:
+                    start = rng.randrange(0, 2 * count)
+                    end = start + rng.randint(1, 400)
+                    ret = tree.range_search(start, end)
+                    expected = [key for key in range(start + start % 2, end + 1, 2) if key < 2 * count]
+                    if [key for key in ret if key % 2 == 0] != expected or \
+                            any(a >= b for a, b in zip(ret, ret[1:])) or any(key < start or key > end for key in ret):
+                        errors.append(("range", start, end))
+
+        pool = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+        begin = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - begin
+        rows.append([threads, threads * ops_per_thread, f"{threads * ops_per_thread / elapsed:.0f}",
+                     tree.optimistic_retries, len(errors)])
+    print(tabulate(rows, headers=["Threads", "Ops", "Ops/s", "Optimistic retries", "Errors"], tablefmt="rounded_grid"))
+    return rows
+
+def snapshot_stress_test(order=13, count=10000, writes=100000, scanners=2):
+    # One writer inserts and deletes odd keys while scanner threads repeatedly scan a
+    # fresh snapshot end to end; each scan must be ordered, hold every (never deleted)
+    # even key and exactly as many keys as the tree had when the snapshot was taken
+    tree = CopyOnWriteBPlusTree(order)
+    for key in random.sample(range(0, 2 * count, 2), count):
+        tree.insert(key)
+    done, errors, scans, overhead = threading.Event(), [], [0] * scanners, []
+
+    def writer():
+        rng = random.Random(0)
+        for _ in range(writes):
+            key = rng.randrange(1, 2 * count, 2)
+            if rng.random() < 0.5:
+                tree.insert(key)
+            else:
+                tree.delete(key)
+        done.set()
+
+    def scanner(i):
+        # At least one scan each, however soon the writer finishes
+        while not done.is_set() or not scans[i]:
+            with tree.snapshot() as snapshot:
+                keys = [key for key, _ in snapshot.scan()]
+                if len(keys) != len(snapshot) or any(a >= b for a, b in zip(keys, keys[1:])) or \
+                        sum(1 for key in keys if key % 2 == 0) != count:
+                    errors.append(snapshot.epoch)
+                if i == 0 and scans[0] % 10 == 0:
+                    overhead.append(tree.snapshot_stats()["snapshots"])
+            scans[i] += 1
+
+    pool = [threading.Thread(target=writer)] + [threading.Thread(target=scanner, args=(i,)) for i in range(scanners)]
+    begin = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    retained = [snapshot["retained_bytes"] for sample in overhead for snapshot in sample]
+    row = [scanners, writes, f"{writes / elapsed:.0f}", sum(scans), tree.copies,
+           f"{sum(retained) / max(1, len(retained)) / 1024:.1f}", f"{tree.stats()['bytes'] / 1024:.1f}", len(errors)]
+    print(tabulate([row], headers=["Scanners", "Writes", "Writes/s", "Scans", "Nodes copied", "KiB kept per snapshot", "Tree KiB", "Errors"],
+                   tablefmt="rounded_grid"))
+    return row
 
 def run_experiments(dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24, keys):
+    from verify import ReferenceModel
     global DEBUG_ENABLED
     DEBUG_ENABLED = True
 
-    dense_tree_13.insert(generate_key())
-    dense_tree_13.insert(generate_key())
-    dense_tree_24.insert(generate_key())
-    dense_tree_24.insert(generate_key())
+    # Searches are validated against a model of each tree's contents after its updates
+    models = {tree: ReferenceModel(keys) for tree in (dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24)}
+    for tree in (dense_tree_13, dense_tree_13, dense_tree_24, dense_tree_24):
+        key = generate_key()
+        tree.insert(key)
+        models[tree].insert(key)
+
+    for tree in (sparse_tree_13, sparse_tree_13, sparse_tree_24, sparse_tree_24):
+        key = random.sample(keys,1)[0]
+        tree.delete(key)
+        models[tree].delete(key)
 
-    sparse_tree_13.delete(random.sample(keys,1)[0])
-    sparse_tree_13.delete(random.sample(keys,1)[0])
-    sparse_tree_24.delete(random.sample(keys,1)[0])
-    sparse_tree_24.delete(random.sample(keys,1)[0])
+    for tree, model in models.items():
+        random_insert_delete(tree, keys, model=model)
 
-    random_insert_delete(dense_tree_13, keys)
-    random_insert_delete(dense_tree_24, keys)
-    random_insert_delete(sparse_tree_13, keys)
-    random_insert_delete(sparse_tree_24, keys)
+    for tree, model in models.items():
+        random_search(tree, model)
 
-    random_search(dense_tree_13, keys)
-    random_search(dense_tree_24, keys)
-    random_search(sparse_tree_13, keys)
-    random_search(sparse_tree_24, keys)
+def main():
+    random.seed(1)
+    keys = generate_keys()
 
-random.seed(1)
-keys = generate_keys()
+    dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24 = build_trees(keys)
+    run_experiments(dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24, keys)
 
-dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24 = build_trees()
-run_experiments(dense_tree_13, dense_tree_24, sparse_tree_13, sparse_tree_24, keys)
+if __name__ == "__main__":
+    main()
 
 '''
 Doubts:
@@ -1,21 +1,33 @@
-import random, string, math
+import random, string, math, mmap, os, struct, tempfile, time, tracemalloc, warnings, weakref, csv
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, chain, islice, product
+from multiprocessing.shared_memory import SharedMemory
+from heapq import merge
+from operator import itemgetter
 from tabulate import tabulate
+from bplus_tree import InstrumentedBPlusTree
 
 class Relation:
-    def __init__(self, name, base_address, size=0, ref = [], refKeys = set()):
+    def __init__(self, name, base_address, size=0, ref = [], refKeys = set(), is_sorted=False):
         self.name = name
         self.base_address = base_address
         self.size = size
         self.ref = ref
         self.refKeys = refKeys
+        self.is_sorted = is_sorted
         self.metrics = [0]
 
+    def numBlocks(self, block_size):
+        # The last block may be partly filled, its unused slots hold None
+        return math.ceil(self.size / block_size)
+
 class VirtualDiskBlock:
     def __init__(self, block_size, data=[]):
         self.block_size = block_size
-        self.data = [None]*block_size
-        for i in range(min(block_size, len(data))):
-            self.data[i] = data[i]
+        self.data = list(data[:block_size])
+        self.data += [None] * (block_size - len(self.data))
 
     def get(self):
         return self.data
@@ -24,36 +36,337 @@ class VirtualDiskBlock:
         return str(self.data)
     
 
+class ColumnarBlock:
+    # Keys in an int64 array and values as fixed-width utf-8 in one bytes object, so whole
+    # blocks are hashed, scattered and probed without a tuple per row. data rebuilds the
+    # row view, so row-at-a-time operators can still read columnar relations.
+    def __init__(self, block_size, keys=(), values=b"", width=10):
+        self.block_size = block_size
+        self.width = width
+        self.keys = array('q', keys)
+        self.values = bytes(values)
+
+    def value(self, i):
+        return self.values[i * self.width:(i + 1) * self.width].rstrip(b"\0").decode()
+
+    @property
+    def data(self):
+        rows = [(key, self.value(i)) for i, key in enumerate(self.keys)]
+        return rows + [None] * (self.block_size - len(rows))
+
+    def get(self):
+        return self.data
+
+    def __repr__(self):
+        return str(self.data)
+
+def packValues(values, width):
+    packed = [value.encode() for value in values]
+    if any(len(value) > width for value in packed):
+        raise ValueError(f"value longer than the {width} byte column width")
+    return b"".join(value.ljust(width, b"\0") for value in packed)
+
 class VirtualDisk:
-    def __init__(self):
+    def __init__(self, num_blocks=None):
+        # Relations are laid out from block 0 in the first num_blocks blocks, partition and
+        # spill blocks are appended after them
         self.BLOCK_SIZE = 8
         self.BUCKET_CAP = 200
-        self.array = [None] * self.BUCKET_CAP ** 2
+        self.num_blocks = num_blocks or self.BUCKET_CAP ** 2
+        self.array = [None] * self.num_blocks
         self.cursor = 0
         self.io_count = 0
         self.bucket_base = 0
+        # Reads and writes are separate streams: an access to the block right after the
+        # previous one of the same kind is sequential, any other is random
+        self.sequential_io = 0
+        self.random_io = 0
+        self.last_block = [-2, -2]
+        self.phases = {}
 
-    def readBlock(self, block_id):
+    def countAccess(self, block_id, write=False):
         self.io_count += 1
+        if block_id == self.last_block[write] + 1:
+            self.sequential_io += 1
+        else:
+            self.random_io += 1
+        self.last_block[write] = block_id
+
+    def countRun(self, num_blocks):
+        # A run of contiguous blocks read outside readBlock, e.g. by a pool worker
+        if num_blocks:
+            self.io_count += num_blocks
+            self.random_io += 1
+            self.sequential_io += num_blocks - 1
+
+    def countWorker(self, io_count, sequential_io, random_io):
+        # IO a pool worker counted on its own disk
+        self.io_count += io_count
+        self.sequential_io += sequential_io
+        self.random_io += random_io
+
+    def countRandom(self, num_blocks):
+        self.io_count += num_blocks
+        self.random_io += num_blocks
+
+    def readBlock(self, block_id):
+        self.countAccess(block_id)
         return self.array[block_id]
 
     def writeBlockSeq(self, block):
         self.array[self.cursor] = block
         self.cursor += 1
+
+    def writeBlocksSeq(self, blocks):
+        # Bulk writeBlockSeq for loading relations, likewise not counted as disk IO
+        end = self.cursor + len(blocks)
+        if end > self.num_blocks:
+            raise ValueError(f"relations need {end} blocks, the disk holds {self.num_blocks}; create it with num_blocks")
+        self.array[self.cursor:end] = blocks
+        self.cursor = end
     
     def writeBlock(self, block, block_id):
-        self.io_count += 1
+        self.countAccess(block_id, True)
         self.array[block_id] = block
+
+    def phaseStart(self):
+        return time.perf_counter(), self.io_count, self.sequential_io, self.random_io
+
+    def phaseEnd(self, name, start):
+        # Adds the IO and wall time since phaseStart() to the named phase
+        begin, io_count, sequential_io, random_io = start
+        stats = self.phases.setdefault(name, {"io": 0, "sequential": 0, "random": 0, "seconds": 0.0})
+        stats["io"] += self.io_count - io_count
+        stats["sequential"] += self.sequential_io - sequential_io
+        stats["random"] += self.random_io - random_io
+        stats["seconds"] += time.perf_counter() - begin
     
     def getWriteCursor(self):
         return self.cursor
+
+    def allocateBlock(self):
+        # Partition and spill blocks are appended past the relations area
+        self.array.append(None)
+        return len(self.array) - 1
     
+# block kind, row count, stride of the values
+BLOCK_HEADER = struct.Struct("<BxHH")
+EMPTY_BLOCK, ROW_BLOCK, COLUMNAR_BLOCK = 0, 1, 2
+
+class MappedBlocks:
+    # List-like view of fixed-size block pages in an mmap'ed file, standing in for the
+    # VirtualDisk block list. A page is the header, BLOCK_SIZE int64 keys and BLOCK_SIZE
+    # utf-8 values of at most value_width bytes; columnar blocks keep their own width.
+    def __init__(self, path, block_size, value_width, num_blocks):
+        self.block_size = block_size
+        self.value_width = value_width
+        self.page_size = BLOCK_HEADER.size + block_size * (8 + value_width)
+        self.length = num_blocks
+        self.capacity = max(1, num_blocks)
+        self.file = open(path, "w+b")
+        self.file.truncate(self.capacity * self.page_size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    def __len__(self):
+        return self.length
+
+    def index(self, block_id):
+        if block_id < 0:
+            block_id += self.length
+        if not 0 <= block_id < self.length:
+            raise IndexError("block id out of range")
+        return block_id
+
+    def __getitem__(self, block_id):
+        offset = self.index(block_id) * self.page_size
+        kind, count, width = BLOCK_HEADER.unpack_from(self.mm, offset)
+        if kind == EMPTY_BLOCK:
+            return None
+        offset += BLOCK_HEADER.size
+        keys = array('q')
+        keys.frombytes(self.mm[offset:offset + 8 * count])
+        offset += 8 * self.block_size
+        values = self.mm[offset:offset + count * width]
+        if kind == COLUMNAR_BLOCK:
+            return ColumnarBlock(self.block_size, keys, values, width)
+        return VirtualDiskBlock(self.block_size, [(key, values[i * width:(i + 1) * width].rstrip(b"\0").decode()) for i, key in enumerate(keys)])
+
+    def __setitem__(self, block_id, block):
+        offset = self.index(block_id) * self.page_size
+        if block == None:
+            BLOCK_HEADER.pack_into(self.mm, offset, EMPTY_BLOCK, 0, 0)
+            return
+        # A block that does not match the page layout would spill into the next page
+        if block.block_size != self.block_size:
+            raise ValueError(f"block of {block.block_size} slots written to pages of {self.block_size}")
+        if isinstance(block, ColumnarBlock):
+            kind, keys, values, width = COLUMNAR_BLOCK, block.keys, block.values, block.width
+            if len(keys) > self.block_size or width > self.value_width or len(values) != len(keys) * width:
+                raise ValueError(f"columnar block of {len(keys)} keys and {len(values)} value bytes of width {width} "
+                                 f"does not fit pages of {self.block_size} keys and {self.value_width} byte values")
+        else:
+            rows = [tuple for tuple in block.data if tuple != None]
+            if len(block.data) != self.block_size or any(len(tuple) != 2 for tuple in rows):
+                raise ValueError(f"row blocks hold {self.block_size} (key, value) slots")
+            kind, keys, width = ROW_BLOCK, array('q', [key for key, _ in rows]), self.value_width
+            values = packValues([val for _, val in rows], width)
+        BLOCK_HEADER.pack_into(self.mm, offset, kind, len(keys), width)
+        offset += BLOCK_HEADER.size
+        self.mm[offset:offset + 8 * len(keys)] = keys.tobytes()
+        offset += 8 * self.block_size
+        self.mm[offset:offset + len(values)] = values
+
+    def append(self, block):
+        if self.length == self.capacity:
+            self.capacity *= 2
+            self.file.truncate(self.capacity * self.page_size)
+            self.mm.resize(self.capacity * self.page_size)
+        self.length += 1
+        self[self.length - 1] = block
+
+    def __delitem__(self, key):
+        # Only the trailing del disk.array[mark:] used to drop spilled runs is supported
+        if not isinstance(key, slice) or key.stop != None or key.step != None:
+            raise TypeError("only trailing slices can be deleted")
+        mark = min(self.length, key.start or 0)
+        for block_id in range(mark, self.length):
+            self[block_id] = None
+        self.length = mark
+
+    def prefetch(self, block_id, count):
+        # Asks the kernel to start reading the pages in the background
+        if not hasattr(self.mm, "madvise") or block_id >= self.length:
+            return
+        begin = block_id * self.page_size // mmap.PAGESIZE * mmap.PAGESIZE
+        end = min(self.length, block_id + count) * self.page_size
+        self.mm.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+class FileVirtualDisk(VirtualDisk):
+    # VirtualDisk on an mmap'ed file with the same IO accounting. With read_ahead, a
+    # sequential scan prefetches the next read_ahead blocks once it is halfway through
+    # the blocks prefetched last.
+    def __init__(self, path, value_width=16, read_ahead=0, num_blocks=None):
+        super().__init__(num_blocks)
+        self.array = MappedBlocks(path, self.BLOCK_SIZE, value_width, self.num_blocks)
+        self.read_ahead = read_ahead
+        self.prefetched = 0
+
+    def writeBlocksSeq(self, blocks):
+        if self.cursor + len(blocks) > self.num_blocks:
+            raise ValueError(f"relations need {self.cursor + len(blocks)} blocks, the disk holds {self.num_blocks}; create it with num_blocks")
+        for block in blocks:
+            self.writeBlockSeq(block)
+
+    def readBlock(self, block_id):
+        if self.read_ahead and block_id == self.last_block[False] + 1 and block_id + self.read_ahead // 2 >= self.prefetched:
+            self.array.prefetch(block_id + 1, self.read_ahead)
+            self.prefetched = block_id + 1 + self.read_ahead
+        return super().readBlock(block_id)
+
+    def close(self):
+        self.array.close()
+
+class PartitionSet:
+    # The buckets of one relation: tuple count and disk blocks per bucket, the Bloom filter
+    # built alongside, if any, and the IO it took to build, which every reuse saves
+    def __init__(self, num_buckets):
+        self.counts = [0] * num_buckets
+        self.blocks = [[] for _ in range(num_buckets)]
+        self.filter = None
+        self.io_count = 0
+        self.pins = 0
+
+    def numBlocks(self):
+        return sum(len(blocks) for blocks in self.blocks)
+
+# Blocks the catalog may hold before evicting: what the old fixed bucket area held,
+# three relations of 14 buckets with BUCKET_CAP blocks each
+PARTITION_CAPACITY = 3 * 14 * 200
+
+class PartitionCatalog:
+    # Partition sets keyed by (relation, join column, hash function, bucket count), so any
+    # join needing the same partitioning reuses it. When the sets would hold more than
+    # capacity blocks, the least recently used unpinned ones are evicted and their blocks
+    # handed out again.
+    def __init__(self, capacity=PARTITION_CAPACITY):
+        self.capacity = capacity
+        self.sets = OrderedDict()
+        self.finalizers = {}
+        self.free = []
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.io_saved = 0
+
+    @staticmethod
+    def key(R, num_buckets, hashFn, column="B"):
+        # By identity: regenerated relations keep their name and every lambda is <lambda>
+        return id(R), column, hashFn, num_buckets
+
+    def peek(self, R, num_buckets, hashFn, column="B"):
+        return self.sets.get(self.key(R, num_buckets, hashFn, column))
+
+    def get(self, R, num_buckets, hashFn, column="B"):
+        key = self.key(R, num_buckets, hashFn, column)
+        partitions = self.sets.get(key)
+        if partitions == None:
+            self.misses += 1
+            return None
+        self.sets.move_to_end(key)
+        self.hits += 1
+        self.io_saved += partitions.io_count
+        return partitions
+
+    def put(self, R, num_buckets, hashFn, partitions, column="B"):
+        self.drop(R, num_buckets, hashFn, column)
+        key = self.key(R, num_buckets, hashFn, column)
+        self.sets[key] = partitions
+        # Once R is gone its id may be handed to a new relation, which must not find these
+        self.finalizers[key] = weakref.finalize(R, self.discard, key)
+
+    def drop(self, R, num_buckets, hashFn, column="B"):
+        self.discard(self.key(R, num_buckets, hashFn, column))
+
+    def discard(self, key):
+        finalizer = self.finalizers.pop(key, None)
+        if finalizer != None:
+            finalizer.detach()
+        partitions = self.sets.pop(key, None)
+        if partitions != None:
+            self.release(partitions)
+
+    def release(self, partitions):
+        for blocks in partitions.blocks:
+            self.free.extend(blocks)
+            self.used -= len(blocks)
+            blocks.clear()
+
+    def allocate(self, disk):
+        # Pinned sets are in use by a join; with nothing else to evict the disk simply grows
+        while self.capacity != None and self.used >= self.capacity:
+            victim = next((key for key, partitions in self.sets.items() if partitions.pins == 0), None)
+            if victim == None:
+                break
+            self.discard(victim)
+            self.evictions += 1
+        self.used += 1
+        return self.free.pop() if self.free else disk.allocateBlock()
+
+    def clear(self):
+        for key in list(self.sets):
+            self.discard(key)
+
 class VirtualMemory:
-    def __init__(self):
-        self.SIZE = 15
+    def __init__(self, size=15):
+        self.SIZE = size
         self.array = [None] * self.SIZE * 8
         self.base_address = 0
-        self.cache = [None] * 3
+        self.catalog = PartitionCatalog()
 
     def writeToDiskSeq(self, disk, mem_offset = 0):
         block = VirtualDiskBlock(disk.BLOCK_SIZE, self.array[mem_offset:mem_offset+disk.BLOCK_SIZE])
@@ -65,70 +378,110 @@ class VirtualMemory:
 
     def readFromDisk(self, disk,  block_id, mem_offset = 0):
         block = disk.readBlock(block_id)
-        for i in range(disk.BLOCK_SIZE):
-            self.array[mem_offset + i] = block.data[i]
+        self.array[mem_offset:mem_offset + disk.BLOCK_SIZE] = block.data
     
     def flush(self):
         for i in range(self.base_address, self.SIZE*8):
             self.array[i] = None
 
+WORD_ALPHABET = string.ascii_lowercase + string.digits
+
 def generateRandomWord():
-    return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(10))
+    return ''.join(random.choices(WORD_ALPHABET, k=10))
+
+def generateWords(count, width=10):
+    # One draw for every character, then sliced into words
+    chars = ''.join(random.choices(WORD_ALPHABET, k=count * width))
+    return [chars[i:i + width] for i in range(0, count * width, width)]
 
 def generateRandomKey(low, high):
     return random.randint(low, high)
 
-def generateRelationBC(disk, size=5000):
+def zipfSample(population, count, skew):
+    # The i-th element of population is drawn with weight 1 / i^skew
+    weights = list(accumulate(1 / rank ** skew for rank in range(1, len(population) + 1)))
+    return random.choices(population, cum_weights=weights, k=count)
+
+def writeRelation(disk, name, tuples, is_sorted=False):
+    # Lays the tuples out in consecutive blocks after the relations written so far
     base_address = disk.getWriteCursor()
-    ref, refKeys = [], set()
-    for off in range(size//disk.BLOCK_SIZE):
-        block = VirtualDiskBlock(disk.BLOCK_SIZE)
-        for blk in range(disk.BLOCK_SIZE):
-            while True:
-                B = generateRandomKey(10000, 50000)
-                if B not in refKeys:
-                    refKeys.add(B)
-                    break
-            C = generateRandomWord()
-            ref.append((B, C))
-            block.data[blk] = (B, C)
-        disk.writeBlockSeq(block)
-    disk.bucket_base += size//disk.BLOCK_SIZE
-    return Relation("BC", base_address, size, ref, refKeys)
+    disk.writeBlocksSeq([VirtualDiskBlock(disk.BLOCK_SIZE, tuples[i:i + disk.BLOCK_SIZE]) for i in range(0, len(tuples), disk.BLOCK_SIZE)])
+    R = Relation(name, base_address, len(tuples), tuples, {key for key, _ in tuples}, is_sorted)
+    disk.bucket_base += R.numBlocks(disk.BLOCK_SIZE)
+    return R
+
+def generateRelation(disk, name, size, keyRange=(0, 100000), distribution="uniform", skew=1.0, unique=False, refKeys=None, matchRate=1.0, valueWidth=10):
+    # Keys come from keyRange, or from refKeys for a foreign key, drawn uniformly or with
+    # Zipf skew (the smallest keys are the most frequent). Of a foreign key only a
+    # matchRate share references refKeys; the rest lie above them and never join.
+    low, high = keyRange
+    population = sorted(refKeys) if refKeys != None else range(low, high + 1)
+    matching = round(size * matchRate) if refKeys != None else size
+    if unique:
+        if refKeys != None or distribution != "uniform":
+            raise ValueError("unique keys are only drawn uniformly from keyRange")
+        keys = random.sample(population, size)
+    elif distribution == "uniform":
+        keys = random.choices(population, k=matching)
+    elif distribution == "zipf":
+        keys = zipfSample(population, matching, skew)
+    else:
+        raise ValueError(f"unknown key distribution {distribution!r}")
+    if matching < size:
+        above = (population[-1] + 1) if population else low
+        keys += random.choices(range(above, above + high - low + 1), k=size - matching)
+        random.shuffle(keys)
+    return writeRelation(disk, name, list(zip(keys, generateWords(size, valueWidth))))
+
+def generateRelationBC(disk, size=5000):
+    return generateRelation(disk, "BC", size, keyRange=(10000, 50000), unique=True)
 
 def generateRelationABFromBKeys(disk, refBKeys, size = 1000):
-    base_address = disk.getWriteCursor()
-    ref, refKeys = [], set()
-    for off in range(size//disk.BLOCK_SIZE):
-        block = VirtualDiskBlock(disk.BLOCK_SIZE)
-        for blk in range(disk.BLOCK_SIZE):
-            A = generateRandomWord()
-            B = random.choice(list(refBKeys))
-            refKeys.add(B)
-            ref.append((B, A))
-            block.data[blk] = (B, A)
-        disk.writeBlockSeq(block)
-    disk.bucket_base += size//disk.BLOCK_SIZE        
-    return Relation("AB", base_address, size, ref, refKeys)
+    return generateRelation(disk, "AB", size, refKeys=refBKeys)
 
 def generateRelationAB(disk, size = 1200):
-    base_address = disk.getWriteCursor()
-    ref, refKeys = [], set()
-    for off in range(size//disk.BLOCK_SIZE):
-        block = VirtualDiskBlock(disk.BLOCK_SIZE)
-        for blk in range(disk.BLOCK_SIZE):
-            A = generateRandomWord()
-            B = generateRandomKey(20000, 30000)
-            refKeys.add(B)
-            ref.append((B, A))
-            block.data[blk] = (B, A)
-        disk.writeBlockSeq(block)
-    disk.bucket_base += size//disk.BLOCK_SIZE     
-    return Relation("AB2", base_address, size, ref, refKeys)
+    return generateRelation(disk, "AB2", size, keyRange=(20000, 30000))
 
-def jenkinsHash(key, size):
+def readRelation(disk, R):
+    # The tuples of R as stored on disk, without counting IO
+    return [tuple for i in range(R.numBlocks(disk.BLOCK_SIZE)) for tuple in disk.array[R.base_address + i].data if tuple != None]
+
+def loadRelationCSV(disk, path, name=None, keyColumn=0, valueColumn=1, header=False):
+    # Integer keys and string values from two columns of a CSV file
+    with open(path, newline="") as file:
+        rows = csv.reader(file)
+        if header:
+            next(rows, None)
+        tuples = [(int(row[keyColumn]), row[valueColumn]) for row in rows if row]
+    return writeRelation(disk, name or os.path.splitext(os.path.basename(path))[0], tuples)
+
+def saveRelationCSV(disk, R, path):
+    with open(path, "w", newline="") as file:
+        csv.writer(file).writerows(readRelation(disk, R))
+
+# magic and tuple count, followed by the tuples in the packBucket layout
+RELATION_HEADER = struct.Struct("<4sQ")
+RELATION_MAGIC = b"HJR1"
+
+def saveRelationBinary(disk, R, path):
+    tuples = readRelation(disk, R)
+    with open(path, "wb") as file:
+        file.write(RELATION_HEADER.pack(RELATION_MAGIC, len(tuples)))
+        file.write(packTuples(tuples))
+
+def loadRelationBinary(disk, path, name=None):
+    with open(path, "rb") as file:
+        buf = file.read()
+    magic, count = RELATION_HEADER.unpack_from(buf)
+    if magic != RELATION_MAGIC:
+        raise ValueError(f"{path} is not a relation file")
+    return writeRelation(disk, name or os.path.splitext(os.path.basename(path))[0], unpackBucket(buf, RELATION_HEADER.size, count))
+
+def jenkinsHash(key, size, seed=0):
     # return key % size
-    hash = 0
+    # Without 32-bit wraparound the value is a multiple of 32769 = 3 * 3 * 11 * 331, so 3, 9
+    # or 11 buckets all land in bucket 0; mixHash has no such sizes
+    hash = seed
     key = str(key)
     for c in key:
         hash += ord(c)
@@ -139,104 +492,1241 @@ def jenkinsHash(key, size):
     hash += (hash << 15)
     return hash % size
 
+MASK64 = (1 << 64) - 1
+
+def mixHash(key, size, seed=0):
+    # splitmix64 finalizer on integer keys: a few multiplies instead of a loop over the digits,
+    # and every seed gives an independent function for recursive re-partitioning
+    h = (key + 0x9E3779B97F4A7C15 * (seed + 1)) & MASK64
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK64
+    return (h ^ (h >> 31)) % size
+
+def mixHashBlock(keys, size, seed=0):
+    # mixHash over a whole block of keys in one loop, without a call per key
+    salt, ret = 0x9E3779B97F4A7C15 * (seed + 1), []
+    for key in keys:
+        h = (key + salt) & MASK64
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK64
+        ret.append((h ^ (h >> 31)) % size)
+    return ret
+
+# Hash functions with a block-at-a-time variant; any other function is applied key by key
+BLOCK_HASHES = {mixHash: mixHashBlock}
+
+def hashBlock(hashFn, keys, size, seed=0):
+    if hashFn in BLOCK_HASHES:
+        return BLOCK_HASHES[hashFn](keys, size, seed)
+    return [hashFn(key, size, seed) for key in keys]
+
+class BloomFilter:
+    # Sized from the expected number of keys for a target false-positive rate
+    def __init__(self, expected_keys, fp_rate=0.01):
+        expected_keys = max(1, expected_keys)
+        self.num_bits = max(8, math.ceil(-expected_keys * math.log(fp_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / expected_keys * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.tested = 0
+        self.passed = 0
+
+    def positions(self, key):
+        # Double hashing: two seeded hashes stand in for num_hashes independent ones
+        h1, h2 = mixHash(key, self.num_bits, 1), 1 + mixHash(key, self.num_bits - 1, 2)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def mightContain(self, key):
+        self.tested += 1
+        for pos in self.positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        self.passed += 1
+        return True
+
+    def expectedFalsePositiveRate(self):
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
 def printRelation(disk, R):
-    print("Relation", R.name, ":", R.size//disk.BLOCK_SIZE, "blocks")
-    for i in range(R.size//disk.BLOCK_SIZE):
+    print("Relation", R.name, ":", R.numBlocks(disk.BLOCK_SIZE), "blocks")
+    for i in range(R.numBlocks(disk.BLOCK_SIZE)):
         print(disk.readBlock(R.base_address + i))
 
-def getRIndex(R):
-    return 0 if R.name == "BC" else 1 if R.name == "AB" else 2
+def relationBlocks(mem, disk, R):
+    # A Relation is read from disk a block at a time into the input buffer; any other
+    # iterable of (key, val) tuples, such as another join's output, is cut into blocks as
+    # it streams in and costs no read IO here
+    if isinstance(R, Relation):
+        for i in range(R.numBlocks(disk.BLOCK_SIZE)):
+            mem.readFromDisk(disk, R.base_address + i , mem.base_address)
+            yield [tuple for tuple in mem.array[mem.base_address:mem.base_address + disk.BLOCK_SIZE] if tuple != None]
+        return
+    stream = iter(R)
+    while True:
+        block = list(islice(stream, disk.BLOCK_SIZE))
+        if not block:
+            return
+        yield block
 
-def generateBuckets(mem, disk, R, num_buckets):
-    r = getRIndex(R)
-    disk.cursor = disk.bucket_base + r * num_buckets * disk.BUCKET_CAP
-    mem.cache[r] = [0] * num_buckets
-    for i in range(R.size//disk.BLOCK_SIZE):
-        mem.readFromDisk(disk, R.base_address + i , mem.base_address)
-        bucket_base = mem.base_address + disk.BLOCK_SIZE
-        for j in range(mem.base_address, mem.base_address + disk.BLOCK_SIZE):
-            key, val = mem.array[j]
-            hash = jenkinsHash(key, num_buckets)
-            mem.array[bucket_base + hash * disk.BLOCK_SIZE + mem.cache[r][hash]%disk.BLOCK_SIZE] = (key, val)
-            mem.cache[r][hash] += 1
-            if mem.cache[r][hash]%disk.BLOCK_SIZE == 0:
-                mem.writeToDiskLoc(disk, disk.cursor + hash * disk.BUCKET_CAP + mem.cache[r][hash]//disk.BLOCK_SIZE - 1, bucket_base + hash * disk.BLOCK_SIZE)
+def generateBuckets(mem, disk, R, num_buckets, buildFilter=None, probeFilter=None, hashFn=jenkinsHash, register=True):
+    # buildFilter collects the keys of R, probeFilter drops tuples whose key cannot join.
+    # The buckets are registered in the catalog unless register is False, in which case
+    # the caller releases them. R may also be a stream of (key, val) tuples, see relationBlocks.
+    start = disk.phaseStart()
+    partitions = PartitionSet(num_buckets)
+    partitions.filter = buildFilter
+    partitions.pins += 1
+    if register:
+        mem.catalog.put(R, num_buckets, hashFn, partitions)
+    counts, blocks = partitions.counts, partitions.blocks
+    # Leftovers of an earlier join must not end up in the partial bucket blocks
+    mem.flush()
+    bucket_base = mem.base_address + disk.BLOCK_SIZE
+    for block in relationBlocks(mem, disk, R):
+        for (key, val), hash in zip(block, hashBlock(hashFn, [key for key, _ in block], num_buckets)):
+            if probeFilter != None and not probeFilter.mightContain(key):
+                continue
+            if buildFilter != None:
+                buildFilter.add(key)
+            mem.array[bucket_base + hash * disk.BLOCK_SIZE + counts[hash]%disk.BLOCK_SIZE] = (key, val)
+            counts[hash] += 1
+            if counts[hash]%disk.BLOCK_SIZE == 0:
+                blocks[hash].append(mem.catalog.allocate(disk))
+                mem.writeToDiskLoc(disk, blocks[hash][-1], bucket_base + hash * disk.BLOCK_SIZE)
                 for i in range(disk.BLOCK_SIZE):
                     mem.array[bucket_base + hash * disk.BLOCK_SIZE + i] = None
 
     for bucket in range(num_buckets):
-        if mem.cache[r][bucket]%disk.BLOCK_SIZE > 0:
-            mem.writeToDiskLoc(disk, disk.cursor + bucket * disk.BUCKET_CAP + mem.cache[r][bucket]//disk.BLOCK_SIZE, bucket_base + bucket * disk.BLOCK_SIZE)
+        if counts[bucket]%disk.BLOCK_SIZE > 0:
+            blocks[bucket].append(mem.catalog.allocate(disk))
+            mem.writeToDiskLoc(disk, blocks[bucket][-1], bucket_base + bucket * disk.BLOCK_SIZE)
     mem.flush()
+    partitions.pins -= 1
+    partitions.io_count = disk.io_count - start[1]
+    disk.phaseEnd(f"partition {R.name if isinstance(R, Relation) else 'stream'}", start)
+    return partitions
 
+def addBloomFilter(mem, disk, partitions, expected_keys):
+    # A filter for partitions cached without one: reading the buckets back costs half
+    # of partitioning R again
+    start = disk.phaseStart()
+    partitions.filter = BloomFilter(expected_keys)
+    for blocks in partitions.blocks:
+        for block_id in blocks:
+            mem.readFromDisk(disk, block_id, mem.base_address)
+            for tuple in mem.array[mem.base_address:mem.base_address + disk.BLOCK_SIZE]:
+                if tuple == None:
+                    break
+                partitions.filter.add(tuple[0])
+    mem.flush()
+    partitions.io_count += disk.io_count - start[1]
+    disk.phaseEnd("bloom filter", start)
+    return partitions.filter
 
-def hashJoin(mem, disk, R1, R2):
-    num_buckets = mem.SIZE - 1 # 1 block for reading
-    r1, r2 = getRIndex(R1), getRIndex(R2)
-    begin_io_count = disk.io_count
-    if(mem.cache[r1] == None):
-        generateBuckets(mem, disk, R1, num_buckets)
-        R1.metrics[0] = disk.io_count - begin_io_count
-    if(mem.cache[r2] == None):
-        r2_begin_io_count = disk.io_count
-        generateBuckets(mem, disk, R2, num_buckets)
-        R2.metrics[0] = disk.io_count - r2_begin_io_count
-
-    disk.cursor = disk.bucket_base
-    
-    joinResults = []
-    for bucket in range(num_buckets):
-        for i in range(math.ceil(mem.cache[r2][bucket]/disk.BLOCK_SIZE)):
-            mem.readFromDisk(disk, disk.cursor + r2 * num_buckets * disk.BUCKET_CAP + bucket * disk.BUCKET_CAP + i, mem.base_address + (i+1)*disk.BLOCK_SIZE)
-        
-        for j in range(math.ceil(mem.cache[r1][bucket]/disk.BLOCK_SIZE)):
-            mem.readFromDisk(disk, disk.cursor + bucket * disk.BUCKET_CAP + j, mem.base_address)
-            for tuple in mem.array[mem.base_address + disk.BLOCK_SIZE:mem.base_address + disk.BLOCK_SIZE + mem.cache[r2][bucket]]:
-                keyR2, valR2 = tuple
+# A bucket is skewed once it holds this many times the mean bucket
+SKEW_RATIO = 2.0
+
+def skewReport(mem, disk, R, hashFn=jenkinsHash):
+    # Bucket-size distribution of a partitioned relation. Buckets over BUCKET_CAP blocks are
+    # always warned about; buckets over memory only when skew put them there, since a
+    # relation much larger than memory overflows in every bucket and is simply re-partitioned
+    counts = mem.catalog.peek(R, mem.SIZE - 1, hashFn).counts
+    mean = sum(counts) / len(counts)
+    blocks = [math.ceil(count/disk.BLOCK_SIZE) for count in counts]
+    report = {
+        "buckets": len(counts),
+        "tuples": sum(counts),
+        "min": min(counts),
+        "max": max(counts),
+        "mean": mean,
+        "stdev": math.sqrt(sum((count - mean) ** 2 for count in counts) / len(counts)),
+        "max/mean": max(counts) / mean if mean else 0,
+        "max blocks": max(blocks),
+        "over memory": [bucket for bucket, n in enumerate(blocks) if n > mem.SIZE - 1],
+        "over cap": [bucket for bucket, n in enumerate(blocks) if n > disk.BUCKET_CAP],
+    }
+    report["skewed"] = [bucket for bucket in report["over memory"] if counts[bucket] > SKEW_RATIO * mean]
+    if report["over cap"]:
+        warnings.warn(f"{R.name}: buckets {report['over cap']} exceed BUCKET_CAP ({disk.BUCKET_CAP} blocks)")
+    if report["skewed"]:
+        warnings.warn(f"{R.name}: skewed buckets {report['skewed']} exceed {mem.SIZE - 1} memory blocks, so they are re-partitioned unless the other relation builds")
+    return report
+
+def hashJoin(mem, disk, R1, R2, bloom=False, workers=0, hashFn=jenkinsHash):
+    # With bloom, a filter on R1.B built while R1 is partitioned keeps R2 tuples that
+    # cannot match out of its buckets; with workers, bucket pairs are joined in a process pool.
+    # hashFn(key, size, seed) assigns buckets; partitions from the catalog are reused when
+    # relation, hash function and bucket count all match.
+    join = HashJoinIterator(mem, disk, R1, R2, bloom=bloom, workers=workers, hashFn=hashFn)
+    joinResults = list(join)
+    return joinResults, join.io_count
+
+class HashJoinIterator:
+    # Volcano-style pull operator: open() partitions both inputs, next() returns the next
+    # (B, C, A) tuple and raises StopIteration once the join is exhausted, and close() may
+    # end it early. where selects and columns projects rows inside the probe loop, before
+    # they are returned. R2 may be any iterable of (key, val) tuples, e.g. another
+    # HashJoinIterator projected to two columns, which then needs a VirtualMemory of its own.
+    def __init__(self, mem, disk, R1, R2, where=None, columns=None, bloom=False, workers=0, hashFn=jenkinsHash):
+        self.mem = mem
+        self.disk = disk
+        self.R1 = R1
+        self.R2 = R2
+        self.where = where
+        self.columns = columns
+        self.bloom = bloom
+        self.workers = workers
+        self.hashFn = hashFn
+        self.tuples = None
+        self.io_count = 0
+
+    def open(self):
+        if self.tuples != None:
+            return self
+        mem, disk, R1, R2 = self.mem, self.disk, self.R1, self.R2
+        self.num_buckets = mem.SIZE - 1 # 1 block for reading
+        self.begin_io_count = disk.io_count
+        self.p1 = mem.catalog.get(R1, self.num_buckets, self.hashFn)
+        if self.p1 == None:
+            self.p1 = generateBuckets(mem, disk, R1, self.num_buckets, buildFilter=BloomFilter(R1.size) if self.bloom else None, hashFn=self.hashFn)
+            R1.metrics[0] = self.p1.io_count
+        self.p1.pins += 1
+        if self.bloom and self.p1.filter == None:
+            addBloomFilter(mem, disk, self.p1, R1.size)
+        # Buckets filtered by R1's Bloom filter only hold R2's semi-join with R1, and a
+        # stream cannot be looked up again, so those stay out of the catalog and are
+        # released on close
+        self.probeFilter = self.p1.filter if self.bloom else None
+        self.cacheP2 = self.probeFilter == None and isinstance(R2, Relation)
+        self.p2 = mem.catalog.get(R2, self.num_buckets, self.hashFn) if self.cacheP2 else None
+        if self.p2 == None:
+            self.p2 = generateBuckets(mem, disk, R2, self.num_buckets, probeFilter=self.probeFilter, hashFn=self.hashFn, register=self.cacheP2)
+            if isinstance(R2, Relation):
+                R2.metrics[0] = self.p2.io_count
+        self.p2.pins += 1
+
+        self.tuples = self.probe()
+        self.probe_start = disk.phaseStart()
+        return self
+
+    def next(self):
+        if self.tuples == None:
+            raise StopIteration
+        return next(self.tuples)
+
+    def close(self):
+        if self.tuples == None:
+            return
+        self.tuples.close()
+        self.tuples = None
+        self.p1.pins -= 1
+        self.p2.pins -= 1
+        if not self.cacheP2:
+            self.mem.catalog.release(self.p2)
+        # Wall time of the probe phase runs until close, including time spent by the consumer
+        self.disk.phaseEnd("probe", self.probe_start)
+        self.io_count = self.disk.io_count - self.begin_io_count
+
+    def __iter__(self):
+        self.open()
+        try:
+            yield from self.tuples
+        finally:
+            self.close()
+
+    def select(self, rows):
+        for row in rows:
+            if self.where == None or self.where(row):
+                yield row if self.columns == None else tuple(row[c] for c in self.columns)
+
+    def probe(self):
+        mem, disk, p1, p2 = self.mem, self.disk, self.p1, self.p2
+        if self.workers:
+            yield from self.select(joinBucketsParallel(mem, disk, p1, p2, self.workers))
+            return
+
+        where, columns = self.where, self.columns
+        for bucket in range(self.num_buckets):
+            # Build a hash table on the smaller side of the partition and stream the other side through it
+            build_r1 = p1.counts[bucket] < p2.counts[bucket]
+            build, probe = (p1, p2) if build_r1 else (p2, p1)
+            if len(build.blocks[bucket]) > mem.SIZE - 1:
+                joinResults = []
+                repartitionBucket(mem, disk, build, probe, build_r1, bucket, joinResults)
+                yield from self.select(joinResults)
+                continue
+            for i, block_id in enumerate(build.blocks[bucket]):
+                mem.readFromDisk(disk, block_id, mem.base_address + (i+1)*disk.BLOCK_SIZE)
+            table = {}
+            for key, val in mem.array[mem.base_address + disk.BLOCK_SIZE:mem.base_address + disk.BLOCK_SIZE + build.counts[bucket]]:
+                table.setdefault(key, []).append(val)
+
+            for block_id in probe.blocks[bucket]:
+                mem.readFromDisk(disk, block_id, mem.base_address)
                 for l in range(disk.BLOCK_SIZE):
                     if mem.array[mem.base_address + l] == None:
                         break
-                    keyR1, valR1 = mem.array[mem.base_address + l]
-                    if keyR2 == keyR1:
-                        # print(key1, val1, val2)
-                        joinResults.append((keyR2, valR1, valR2))
+                    key, val = mem.array[mem.base_address + l]
+                    for match in table.get(key, ()):
+                        row = (key, match, val) if build_r1 else (key, val, match)
+                        if where == None or where(row):
+                            yield row if columns == None else tuple(row[c] for c in columns)
+
+def repartitionBucket(mem, disk, build, probe, build_r1, bucket, joinResults):
+    # Even the smaller side overflows memory, so re-partition this bucket pair recursively
+    mark = len(disk.array)
+    hybridJoinRuns(mem, disk, (build.blocks[bucket], build.counts[bucket]), (probe.blocks[bucket], probe.counts[bucket]), build_r1, 1, joinResults, {})
+    del disk.array[mark:]
 
+def packBucket(disk, partitions, bucket):
+    # The copy is not counted as disk IO: the worker that reads the bucket counts it
+    return packTuples(disk.array[partitions.blocks[bucket][i // disk.BLOCK_SIZE]].data[i % disk.BLOCK_SIZE] for i in range(partitions.counts[bucket]))
 
+def packTuples(tuples):
+    # Keys as int64, then the end offset of every value, then the utf-8 values themselves
+    keys, ends, vals, end = array('q'), array('I'), [], 0
+    for key, val in tuples:
+        data = val.encode()
+        end += len(data)
+        keys.append(key)
+        ends.append(end)
+        vals.append(data)
+    return keys.tobytes() + ends.tobytes() + b"".join(vals)
+
+def unpackBucket(buf, offset, count):
+    keys, ends = array('q'), array('I')
+    keys.frombytes(buf[offset:offset + 8 * count])
+    ends.frombytes(buf[offset + 8 * count:offset + 12 * count])
+    base, start, ret = offset + 12 * count, 0, []
+    for key, end in zip(keys, ends):
+        ret.append((key, bytes(buf[base + start:base + end]).decode()))
+        start = end
+    return ret
+
+def packRows(rows):
+    # Join rows as two packTuples columns in the same order, (B, C) then (B, A); returns
+    # the bytes and the offset of the second column
+    first = packTuples((key, valR1) for key, valR1, _ in rows)
+    return first + packTuples((key, valR2) for key, _, valR2 in rows), len(first)
+
+def unpackRows(buf, count, split):
+    return [(key, valR1, valR2) for (key, valR1), (_, valR2) in zip(unpackBucket(buf, 0, count), unpackBucket(buf, split, count))]
+
+def joinBucketShared(shm_name, build, probe, build_r1, block_size, mem_size):
+    # Runs in a pool worker: build and probe are (offset, count) of the bucket pair in the segment.
+    # A pair whose build side overflows memory is re-partitioned on a private disk holding
+    # it in as many blocks as in the parent, so the IO counted is the same. The rows go back
+    # in a new segment the parent unlinks; returns (segment name, rows, second column
+    # offset) and (io, sequential, random) counts.
+    shm = SharedMemory(name=shm_name)
+    try:
+        buildTuples, probeTuples = unpackBucket(shm.buf, *build), unpackBucket(shm.buf, *probe)
+    finally:
+        shm.close()
+    joinResults = []
+    if math.ceil(len(buildTuples) / block_size) > mem_size - 1:
+        disk = VirtualDisk(num_blocks=math.ceil(len(buildTuples) / block_size) + math.ceil(len(probeTuples) / block_size))
+        R1, R2 = writeRelation(disk, "build", buildTuples), writeRelation(disk, "probe", probeTuples)
+        hybridJoinRuns(VirtualMemory(mem_size), disk, relationRun(disk, R1), relationRun(disk, R2), build_r1, 1, joinResults, {})
+        counts = disk.io_count, disk.sequential_io, disk.random_io
+    else:
+        table = {}
+        for key, val in buildTuples:
+            table.setdefault(key, []).append(val)
+        for key, val in probeTuples:
+            for match in table.get(key, ()):
+                joinResults.append((key, match, val) if build_r1 else (key, val, match))
+        # Each side is one contiguous run read
+        runs = [math.ceil(len(tuples) / block_size) for tuples in (buildTuples, probeTuples)]
+        counts = sum(runs), sum(max(0, n - 1) for n in runs), sum(1 for n in runs if n)
+    if not joinResults:
+        return (None, 0, 0), counts
+    data, split = packRows(joinResults)
+    out = SharedMemory(create=True, size=len(data))
+    out.buf[:len(data)] = data
+    out.close()
+    return (out.name, len(joinResults), split), counts
+
+def joinBucketsParallel(mem, disk, p1, p2, workers):
+    # Bucket pairs are copied once into a shared memory segment and joined by pool workers,
+    # which also re-partition the pairs that overflow memory. Per-bucket results are
+    # concatenated in bucket order, so the output matches the serial join.
+    bucketResults = [[] for _ in p1.counts]
+    pending, blobs, offset = [], [], 0
+    for bucket in range(len(p1.counts)):
+        build_r1 = p1.counts[bucket] < p2.counts[bucket]
+        build, probe = (p1, p2) if build_r1 else (p2, p1)
+        if not build.counts[bucket]:
+            # Nothing can match, but the serial join still streams the probe side through
+            disk.countRun(len(probe.blocks[bucket]))
+            continue
+        entries = []
+        for partitions in (build, probe):
+            blobs.append(packBucket(disk, partitions, bucket))
+            entries.append((offset, partitions.counts[bucket]))
+            offset += len(blobs[-1])
+        pending.append((bucket, entries[0], entries[1], build_r1))
+
+    shm = SharedMemory(create=True, size=max(1, offset))
+    try:
+        shm.buf[:offset] = b"".join(blobs)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(bucket, pool.submit(joinBucketShared, shm.name, build, probe, build_r1, disk.BLOCK_SIZE, mem.SIZE))
+                       for bucket, build, probe, build_r1 in pending]
+            for bucket, future in futures:
+                (name, count, split), counts = future.result()
+                disk.countWorker(*counts)
+                if name != None:
+                    out = SharedMemory(name=name)
+                    try:
+                        bucketResults[bucket] = unpackRows(out.buf, count, split)
+                    finally:
+                        out.close()
+                        out.unlink()
+    finally:
+        shm.close()
+        shm.unlink()
+    return [t for results in bucketResults for t in results]
+
+HYBRID_MAX_DEPTH = 6
+
+def relationRun(disk, R):
+    return list(range(R.base_address, R.base_address + R.numBlocks(disk.BLOCK_SIZE))), R.size
+
+def choosePartitions(build_blocks, mem_size):
+    # Fewest spilled partitions that still fit in memory for the second pass, with the rest
+    # of memory holding a resident partition. Both are sized with slack (one block for the
+    # resident partition, a fifth of memory for the spilled ones) to absorb uneven hashing.
+    # Returns (spills, resident blocks, resident share in blocks); with no such split every
+    # partition spills, as in a grace hash join.
+    for spills in range(1, mem_size - 2):
+        resident = mem_size - 1 - spills
+        if math.ceil((build_blocks - (resident - 1)) / spills) <= int((mem_size - 1) * 0.8):
+            return spills, resident, resident - 1
+    return mem_size - 1, 0, 0
+
+def partitionOf(key, seed, build_blocks, share, spills):
+    # Hash into one slot per build block: the first share slots are the resident partition 0
+    slot = mixHash(key, build_blocks, seed)
+    if share:
+        return 0 if slot < share else 1 + (slot - share) % spills
+    return slot % spills
+
+def partitionRun(mem, disk, run, num_parts, partOf, resident_blocks, onResident, store_resident):
+    # Slot 0 reads the run, slots 1.. buffer the spilled partitions and the rest of memory
+    # holds partition 0 when it is resident. A stored resident partition that outgrows its
+    # blocks is written out and spills like the others; the second return value says so.
+    resident = resident_blocks > 0
+    resident_count = 0
+    spills = num_parts - 1 if resident else num_parts
+    resident_base = mem.base_address + (spills + 1) * disk.BLOCK_SIZE
+    blocks, counts = [[] for _ in range(num_parts)], [0] * num_parts
+
+    def slot(part):
+        if part == 0 and resident_blocks:
+            return resident_base
+        return mem.base_address + (part + (0 if resident_blocks else 1)) * disk.BLOCK_SIZE
+
+    def spill(part, tuple):
+        offset = slot(part)
+        mem.array[offset + counts[part] % disk.BLOCK_SIZE] = tuple
+        counts[part] += 1
+        if counts[part] % disk.BLOCK_SIZE == 0:
+            block_id = disk.allocateBlock()
+            mem.writeToDiskLoc(disk, block_id, offset)
+            blocks[part].append(block_id)
+            for i in range(disk.BLOCK_SIZE):
+                mem.array[offset + i] = None
+
+    for block_id in run[0]:
+        mem.readFromDisk(disk, block_id, mem.base_address)
+        for j in range(mem.base_address, mem.base_address + disk.BLOCK_SIZE):
+            if mem.array[j] == None:
+                break
+            key, val = mem.array[j]
+            part = partOf(key)
+            if part == 0 and resident:
+                if not store_resident or resident_count < resident_blocks * disk.BLOCK_SIZE:
+                    if store_resident:
+                        mem.array[resident_base + resident_count] = (key, val)
+                        resident_count += 1
+                    onResident(key, val)
+                    continue
+                for i in range(resident_blocks):
+                    block_id = disk.allocateBlock()
+                    mem.writeToDiskLoc(disk, block_id, resident_base + i * disk.BLOCK_SIZE)
+                    blocks[0].append(block_id)
+                counts[0] = resident_count
+                for i in range(resident_base, resident_base + resident_blocks * disk.BLOCK_SIZE):
+                    mem.array[i] = None
+                resident = False
+            spill(part, (key, val))
+
+    for part in range(num_parts):
+        if counts[part] % disk.BLOCK_SIZE > 0 and not (part == 0 and resident):
+            block_id = disk.allocateBlock()
+            mem.writeToDiskLoc(disk, block_id, slot(part))
+            blocks[part].append(block_id)
+    mem.flush()
+    return [(blocks[part], counts[part]) for part in range(num_parts)], resident
+
+def joinRunsInMemory(mem, disk, build, probe, build_is_r1, joinResults):
+    # Load as much of the build run as fits next to one probe block and stream the probe run
+    # through its hash table, once per chunk when the build run does not fit at all
+    chunk = mem.SIZE - 1
+    for start in range(0, len(build[0]), chunk):
+        mem.flush()
+        table = {}
+        for i, block_id in enumerate(build[0][start:start + chunk]):
+            mem.readFromDisk(disk, block_id, mem.base_address + (i+1)*disk.BLOCK_SIZE)
+        for tuple in mem.array[mem.base_address + disk.BLOCK_SIZE:mem.base_address + (chunk+1)*disk.BLOCK_SIZE]:
+            if tuple != None:
+                table.setdefault(tuple[0], []).append(tuple[1])
+        for block_id in probe[0]:
+            mem.readFromDisk(disk, block_id, mem.base_address)
+            for l in range(disk.BLOCK_SIZE):
+                if mem.array[mem.base_address + l] == None:
+                    break
+                key, val = mem.array[mem.base_address + l]
+                for match in table.get(key, ()):
+                    joinResults.append((key, match, val) if build_is_r1 else (key, val, match))
+    mem.flush()
+
+def hybridJoinRuns(mem, disk, build, probe, build_is_r1, depth, joinResults, phases):
+    if len(probe[0]) < len(build[0]):
+        build, probe, build_is_r1 = probe, build, not build_is_r1
+    if len(build[0]) <= mem.SIZE - 1 or depth >= HYBRID_MAX_DEPTH:
+        begin_io_count = disk.io_count
+        joinRunsInMemory(mem, disk, build, probe, build_is_r1, joinResults)
+        phases["join"] = phases.get("join", 0) + disk.io_count - begin_io_count
+        return
+
+    # Each level hashes with a different seed so a recursive pass splits what the last one could not
+    spills, resident_blocks, share = choosePartitions(len(build[0]), mem.SIZE)
+    num_parts = spills + (1 if resident_blocks else 0)
+    partOf = lambda key: partitionOf(key, depth, len(build[0]), share, spills)
+    table = {}
+
+    def addResident(key, val):
+        table.setdefault(key, []).append(val)
+
+    def probeResident(key, val):
+        for match in table.get(key, ()):
+            joinResults.append((key, match, val) if build_is_r1 else (key, val, match))
+
+    begin_io_count = disk.io_count
+    build_parts, resident = partitionRun(mem, disk, build, num_parts, partOf, resident_blocks, addResident, True)
+    phases[f"build partition (level {depth})"] = phases.get(f"build partition (level {depth})", 0) + disk.io_count - begin_io_count
+    begin_io_count = disk.io_count
+    probe_parts, _ = partitionRun(mem, disk, probe, num_parts, partOf, resident_blocks if resident else 0, probeResident, False)
+    phases[f"probe partition (level {depth})"] = phases.get(f"probe partition (level {depth})", 0) + disk.io_count - begin_io_count
+
+    for part in range(num_parts):
+        if (part == 0 and resident) or build_parts[part][1] == 0 or probe_parts[part][1] == 0:
+            continue
+        hybridJoinRuns(mem, disk, build_parts[part], probe_parts[part], build_is_r1, depth + 1, joinResults, phases)
+
+def hybridHashJoin(mem, disk, R1, R2):
+    # One partition of the smaller relation stays in memory while the other is partitioned,
+    # so its tuples never go to disk; partitions still too large are re-partitioned
+    begin_io_count = disk.io_count
+    mark = len(disk.array)
+    joinResults, phases = [], {}
+    build_is_r1 = R1.size <= R2.size
+    build, probe = (R1, R2) if build_is_r1 else (R2, R1)
+    hybridJoinRuns(mem, disk, relationRun(disk, build), relationRun(disk, probe), build_is_r1, 0, joinResults, phases)
+    del disk.array[mark:]
+    return joinResults, disk.io_count - begin_io_count, phases
+
+class RunWriter:
+    # Appends tuples to a run of freshly allocated disk blocks through one memory block
+    def __init__(self, mem, disk, mem_offset):
+        self.mem = mem
+        self.disk = disk
+        self.mem_offset = mem_offset
+        self.blocks = []
+        self.count = 0
+
+    def append(self, tuple):
+        self.mem.array[self.mem_offset + self.count % self.disk.BLOCK_SIZE] = tuple
+        self.count += 1
+        if self.count % self.disk.BLOCK_SIZE == 0:
+            self.flush()
+
+    def flush(self):
+        block_id = self.disk.allocateBlock()
+        self.mem.writeToDiskLoc(self.disk, block_id, self.mem_offset)
+        self.blocks.append(block_id)
+        for i in range(self.disk.BLOCK_SIZE):
+            self.mem.array[self.mem_offset + i] = None
+
+    def close(self):
+        if self.count % self.disk.BLOCK_SIZE > 0:
+            self.flush()
+        return self.blocks, self.count
+
+def scanRun(mem, disk, run, mem_offset):
+    for block_id in run[0]:
+        mem.readFromDisk(disk, block_id, mem_offset)
+        for tuple in mem.array[mem_offset:mem_offset + disk.BLOCK_SIZE]:
+            if tuple == None:
+                break
+            yield tuple
+
+def mergePass(mem, disk, runs):
+    # Merge SIZE - 1 runs at a time, one input block each and the last block for output
+    fan_in = mem.SIZE - 1
+    merged = []
+    for start in range(0, len(runs), fan_in):
+        writer = RunWriter(mem, disk, mem.base_address + fan_in * disk.BLOCK_SIZE)
+        inputs = [scanRun(mem, disk, run, mem.base_address + i * disk.BLOCK_SIZE) for i, run in enumerate(runs[start:start + fan_in])]
+        for tuple in merge(*inputs, key=itemgetter(0)):
+            writer.append(tuple)
+        merged.append(writer.close())
+    mem.flush()
+    return merged
+
+def externalSort(mem, disk, run, max_runs=1):
+    # Pass 0 sorts memory-sized chunks into runs, later passes merge them until at most
+    # max_runs are left so the caller can fold the final merge into its own pass
+    runs = []
+    for start in range(0, len(run[0]), mem.SIZE):
+        mem.flush()
+        chunk = run[0][start:start + mem.SIZE]
+        for i, block_id in enumerate(chunk):
+            mem.readFromDisk(disk, block_id, mem.base_address + i * disk.BLOCK_SIZE)
+        tuples = sorted((tuple for tuple in mem.array[mem.base_address:mem.base_address + len(chunk) * disk.BLOCK_SIZE] if tuple != None), key=itemgetter(0))
+        mem.flush()
+        mem.array[mem.base_address:mem.base_address + len(tuples)] = tuples
+        blocks = []
+        for i in range(math.ceil(len(tuples) / disk.BLOCK_SIZE)):
+            block_id = disk.allocateBlock()
+            mem.writeToDiskLoc(disk, block_id, mem.base_address + i * disk.BLOCK_SIZE)
+            blocks.append(block_id)
+        runs.append((blocks, len(tuples)))
+    mem.flush()
+    while len(runs) > max_runs:
+        runs = mergePass(mem, disk, runs)
+    return runs
+
+def sortMergeJoin(mem, disk, R1, R2):
+    begin_io_count = disk.io_count
+    mark = len(disk.array)
+    phases = {}
+    sortedRuns = []
+    for R in (R1, R2):
+        r_begin_io_count = disk.io_count
+        sortedRuns.append([relationRun(disk, R)] if R.is_sorted else externalSort(mem, disk, relationRun(disk, R), mem.SIZE))
+        phases[f"sort {R.name}"] = disk.io_count - r_begin_io_count
+    # The last merge pass of both sorts is fused with the join, one memory block per run
+    r_begin_io_count = disk.io_count
+    while len(sortedRuns[0]) + len(sortedRuns[1]) > mem.SIZE:
+        larger = 0 if len(sortedRuns[0]) >= len(sortedRuns[1]) else 1
+        sortedRuns[larger] = mergePass(mem, disk, sortedRuns[larger])
+    phases["merge passes"] = disk.io_count - r_begin_io_count
+
+    r_begin_io_count = disk.io_count
+    slots = iter(range(mem.SIZE))
+    left, right = [merge(*[scanRun(mem, disk, run, mem.base_address + next(slots) * disk.BLOCK_SIZE) for run in runs], key=itemgetter(0)) for runs in sortedRuns]
+    joinResults = []
+    l, r = next(left, None), next(right, None)
+    while l != None and r != None:
+        if l[0] < r[0]:
+            l = next(left, None)
+        elif l[0] > r[0]:
+            r = next(right, None)
+        else:
+            # Tuples of R1 sharing the key are held while the matching R2 tuples stream past
+            key, group = l[0], []
+            while l != None and l[0] == key:
+                group.append(l[1])
+                l = next(left, None)
+            while r != None and r[0] == key:
+                for valR1 in group:
+                    joinResults.append((key, valR1, r[1]))
+                r = next(right, None)
+    phases["merge join"] = disk.io_count - r_begin_io_count
+    mem.flush()
+    del disk.array[mark:]
+    return joinResults, disk.io_count - begin_io_count, phases
+
+def multiwayHashJoin(mem, disk, relations, hashFn=jenkinsHash):
+    # Joins any number of relations on B in one pass: each is partitioned once (or taken from
+    # the catalog) and every bucket is joined across all inputs, the largest streaming through
+    # hash tables on the others. A bucket empty in any input is never read. Rows are
+    # (B, value of relations[0], value of relations[1], ...).
+    begin_io_count = disk.io_count
+    num_buckets = mem.SIZE - 1
+    phases, partitions = {}, []
+    for R in relations:
+        partitions.append(mem.catalog.get(R, num_buckets, hashFn))
+        if partitions[-1] == None:
+            partitions[-1] = generateBuckets(mem, disk, R, num_buckets, hashFn=hashFn)
+            phases[f"partition {R.name}"] = partitions[-1].io_count
+        partitions[-1].pins += 1
+    mark = len(disk.array)
+    rows = []
+    for bucket in range(num_buckets):
+        if all(partitions.counts[bucket] for partitions in partitions):
+            runs = [((partitions.blocks[bucket], partitions.counts[bucket]), (i,)) for i, partitions in enumerate(partitions)]
+            joinRunsMultiway(mem, disk, runs, 1, rows, phases)
+    for partitions in partitions:
+        partitions.pins -= 1
+    del disk.array[mark:]
+    return rows, disk.io_count - begin_io_count, phases
+
+def runValues(val, cols):
+    # Tuples of a run hold one value, or a tuple of values for the relations in cols
+    return (val,) if len(cols) == 1 else val
+
+def joinRunsMultiway(mem, disk, runs, depth, rows, phases):
+    # runs are (run, cols) pairs. Joined in memory when the runs other than the largest fit
+    # after semi-join filtering, else every run is re-partitioned with a new seed, skipping
+    # parts empty in any run; keys that still do not split after HYBRID_MAX_DEPTH levels are
+    # joined two runs at a time instead.
+    runs = sorted(runs, key=lambda item: len(item[0][0]))
+    begin_io_count = disk.io_count
+    fits = (len(runs) == 1 or len(runs[0][0][0]) <= mem.SIZE - 1) and joinRunsMultiwayInMemory(mem, disk, runs[:-1], runs[-1], rows)
+    # A failed attempt still read part of the build runs
+    phases["join"] = phases.get("join", 0) + disk.io_count - begin_io_count
+    if fits:
+        return
+    begin_io_count = disk.io_count
+    if depth < HYBRID_MAX_DEPTH:
+        num_parts = mem.SIZE - 1
+        parts = [partitionRun(mem, disk, run, num_parts, lambda key: mixHash(key, num_parts, depth), 0, None, False)[0] for run, _ in runs]
+        phases[f"repartition (level {depth})"] = phases.get(f"repartition (level {depth})", 0) + disk.io_count - begin_io_count
+        for part in range(num_parts):
+            if all(run_parts[part][1] for run_parts in parts):
+                joinRunsMultiway(mem, disk, [(run_parts[part], cols) for run_parts, (_, cols) in zip(parts, runs)], depth + 1, rows, phases)
+        return
+    (build, build_cols), (probe, probe_cols) = runs[0], runs[1]
+    pairs = []
+    joinRunsInMemory(mem, disk, build, probe, True, pairs)
+    writer = RunWriter(mem, disk, mem.base_address)
+    for key, valBuild, valProbe in pairs:
+        writer.append((key, runValues(valBuild, build_cols) + runValues(valProbe, probe_cols)))
+    joined = writer.close()
+    mem.flush()
+    phases["pairwise join"] = phases.get("pairwise join", 0) + disk.io_count - begin_io_count
+    if joined[1]:
+        joinRunsMultiway(mem, disk, [(joined, build_cols + probe_cols)] + runs[2:], depth, rows, phases)
+
+def joinRunsMultiwayInMemory(mem, disk, builds, probe, rows):
+    # The build runs are read through slot 0, smallest first, and only tuples whose key is in
+    # the tables built so far are kept, packed into the blocks after it. Returns False, with
+    # nothing joined, when those do not fit; otherwise slot 0 then streams the probe run.
+    mem.flush()
+    offset, end, tables = mem.base_address + disk.BLOCK_SIZE, mem.base_address + mem.SIZE * disk.BLOCK_SIZE, []
+    for run, cols in builds:
+        start = offset
+        for block_id in run[0]:
+            mem.readFromDisk(disk, block_id, mem.base_address)
+            for tuple in mem.array[mem.base_address:mem.base_address + disk.BLOCK_SIZE]:
+                # Each table only holds keys of the ones before it, so the last decides
+                if tuple != None and (not tables or tuple[0] in tables[-1]):
+                    if offset == end:
+                        mem.flush()
+                        return False
+                    mem.array[offset] = tuple
+                    offset += 1
+        table = {}
+        for tuple in mem.array[start:offset]:
+            table.setdefault(tuple[0], []).append(runValues(tuple[1], cols))
+        tables.append(table)
+    run, probe_cols = probe
+    # Values come out in build order and then the probe's; order puts them back in relation order
+    cols = [col for _, build_cols in builds for col in build_cols] + list(probe_cols)
+    order = sorted(range(len(cols)), key=cols.__getitem__)
+    for key, val in scanRun(mem, disk, run, mem.base_address):
+        matches = [table.get(key) for table in tables]
+        if all(matches):
+            for combo in product(*matches):
+                values = [*chain.from_iterable(combo), *runValues(val, probe_cols)]
+                rows.append((key, *(values[i] for i in order)))
+    mem.flush()
+    return True
+
+def materializeRelation(disk, name, tuples):
+    # writeRelation for operator output: every block written counts as disk IO
+    end = disk.cursor + math.ceil(len(tuples) / disk.BLOCK_SIZE)
+    if end > disk.num_blocks:
+        raise ValueError(f"relations need {end} blocks, the disk holds {disk.num_blocks}; create it with num_blocks")
+    base_address = disk.getWriteCursor()
+    for i in range(0, len(tuples), disk.BLOCK_SIZE):
+        disk.writeBlock(VirtualDiskBlock(disk.BLOCK_SIZE, tuples[i:i + disk.BLOCK_SIZE]), disk.cursor)
+        disk.cursor += 1
+    R = Relation(name, base_address, len(tuples), tuples, {key for key, _ in tuples})
+    disk.bucket_base += R.numBlocks(disk.BLOCK_SIZE)
+    return R
+
+def pairwiseJoinChain(mem, disk, relations, hashFn=jenkinsHash):
+    # The same join as multiwayHashJoin as a chain of hashJoins: every intermediate result is
+    # written to disk as a relation of (B, values) tuples, partitioned for the next join and
+    # dropped from the catalog after it. The intermediates' blocks are freed when the chain ends.
+    begin_io_count = disk.io_count
+    num_buckets = mem.SIZE - 1
+    phases = {}
+    cursor, bucket_base = disk.cursor, disk.bucket_base
+    R, cols = relations[0], (0,)
+    rows = [(key, val) for key, val in R.ref]
+    try:
+        for i, S in enumerate(relations[1:], 1):
+            joinResults, io_count = hashJoin(mem, disk, R, S, hashFn=hashFn)
+            phases[f"{R.name} ⨝ {S.name}"] = io_count
+            if len(cols) > 1:
+                mem.catalog.drop(R, num_buckets, hashFn)
+            tuples = [(key, runValues(valR, cols) + (valS,)) for key, valR, valS in joinResults]
+            cols += (i,)
+            if i == len(relations) - 1:
+                rows = [(key,) + values for key, values in tuples]
+                break
+            begin = disk.io_count
+            R = materializeRelation(disk, f"{R.name} ⨝ {S.name}", tuples)
+            phases[f"write {R.name}"] = disk.io_count - begin
+    finally:
+        for block_id in range(cursor, disk.cursor):
+            disk.array[block_id] = None
+        disk.cursor, disk.bucket_base = cursor, bucket_base
+    return rows, disk.io_count - begin_io_count, phases
+
+def compareMultiwayJoin(mem, disk, relations, hashFn=jenkinsHash):
+    # Disk IO and peak Python memory (tracemalloc) of both plans, each from cold partitions;
+    # rows are (plan, disk IO, peak KiB, result rows)
+    rows, results = [], []
+    for name, join in (("pairwise chain", pairwiseJoinChain), ("multi-way", multiwayHashJoin)):
+        mem.catalog.clear()
+        tracemalloc.start()
+        joinResults, io_count, _ = join(mem, disk, relations, hashFn)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        rows.append([name, io_count, round(peak / 1024, 1), len(joinResults)])
+        results.append(joinResults)
+    mem.catalog.clear()
+    return rows, results
+
+def estimateSortCost(blocks, mem_size, is_sorted):
+    # Returns (I/O, runs left for the fused merge) for externalSort(..., max_runs=mem_size)
+    if is_sorted:
+        return 0, 1
+    runs, cost = math.ceil(blocks / mem_size), 2 * blocks
+    while runs > mem_size:
+        runs, cost = math.ceil(runs / (mem_size - 1)), cost + 2 * blocks
+    return cost, runs
+
+def estimateHybridCost(build, probe, mem_size, depth=0):
+    # Mirrors hybridJoinRuns: the resident share of both sides skips the write and re-read,
+    # each spilled partition pair is estimated as its own, smaller hybrid join
+    if build <= mem_size - 1 or depth >= HYBRID_MAX_DEPTH:
+        return build + probe
+    spills, _, share = choosePartitions(math.ceil(build), mem_size)
+    spilled = 1 - share / build
+    cost = build + probe + spilled * (build + probe) + spills
+    part_build, part_probe = spilled * build / spills, spilled * probe / spills
+    return cost + spills * estimateHybridCost(part_build, part_probe, mem_size, depth + 1)
+
+def estimateJoinCosts(mem, disk, R1, R2, reuse=True, index=None):
+    # Block I/O estimates from relation sizes and memory size alone; with reuse, partitions
+    # already in the catalog are free for the grace join, and with an index on R1.B the
+    # index nested-loop join only pays for its probes
+    num_buckets = mem.SIZE - 1
+    blocks = [R.numBlocks(disk.BLOCK_SIZE) for R in (R1, R2)]
+    estimates = {}
+
+    # Grace: partitioning reads a relation and writes it back with a partial block per
+    # bucket on average half full, unless its buckets are in the catalog;
+    # the join reads both, re-partitioning bucket pairs whose smaller side overflows memory
+    grace = 0
+    for R, n in zip((R1, R2), blocks):
+        if not reuse or mem.catalog.peek(R, num_buckets, jenkinsHash) == None:
+            grace += n + n + num_buckets / 2
+    bucket_blocks = [n / num_buckets + 0.5 for n in blocks]
+    grace += num_buckets * estimateHybridCost(min(bucket_blocks), max(bucket_blocks), mem.SIZE, 1)
+    estimates["grace hash"] = round(grace)
+
+    estimates["hybrid hash"] = round(estimateHybridCost(min(blocks), max(blocks), mem.SIZE))
+
+    sort_costs = [estimateSortCost(n, mem.SIZE, R.is_sorted) for R, n in zip((R1, R2), blocks)]
+    sort_merge = sum(cost for cost, _ in sort_costs) + sum(blocks)
+    runs = [runs for _, runs in sort_costs]
+    while sum(runs) > mem.SIZE:
+        larger = 0 if runs[0] >= runs[1] else 1
+        runs[larger] = math.ceil(runs[larger] / (mem.SIZE - 1))
+        sort_merge += 2 * blocks[larger]
+    estimates["sort-merge"] = sort_merge
+
+    estimates["index nested-loop"] = round(estimateIndexCost(mem, disk, R1, R2, index))
+    return estimates
+
+def estimateIndexCost(mem, disk, R1, R2, index=None, order=13):
+    # Mirrors indexNestedLoopJoin: R2 is scanned once and each batch of probes costs one IO
+    # per node it reaches. On a level of n nodes, p uniform probes reach n(1 - (1 - 1/n)^p)
+    # distinct nodes, at most p, so the probes cost at most height × probe count. Without an
+    # index, buildIndex scans R1 and bulk loads a tree with full nodes.
+    blocks = R2.numBlocks(disk.BLOCK_SIZE)
+    if index == None:
+        cost = R1.numBlocks(disk.BLOCK_SIZE)
+        levels = [max(1, math.ceil(len(R1.refKeys) / order))]
+        while levels[-1] > 1:
+            levels.append(math.ceil(levels[-1] / (order + 1)))
+    else:
+        cost, levels, nodes = 0, [], [index.root]
+        while nodes:
+            levels.append(len(nodes))
+            nodes = [child for node in nodes for child in node.children]
+    batch_blocks = mem.SIZE - 1
+    for start in range(0, blocks, batch_blocks):
+        probes = min(R2.size - start * disk.BLOCK_SIZE, batch_blocks * disk.BLOCK_SIZE)
+        cost += sum(n * (1 - (1 - 1 / n) ** probes) for n in levels)
+    return cost + blocks
+
+def plannedJoin(mem, disk, R1, R2, index=None):
+    # Runs whichever join method has the lowest estimated I/O; index is an existing
+    # index on R1.B, which makes the index nested-loop join skip building one
+    estimates = estimateJoinCosts(mem, disk, R1, R2, index=index)
+    method = min(estimates, key=estimates.get)
+    if method == "grace hash":
+        joinResults, io_count = hashJoin(mem, disk, R1, R2)
+    elif method == "hybrid hash":
+        joinResults, io_count, _ = hybridHashJoin(mem, disk, R1, R2)
+    elif method == "index nested-loop":
+        joinResults, io_count, _ = indexNestedLoopJoin(mem, disk, R1, R2, index)
+    else:
+        joinResults, io_count, _ = sortMergeJoin(mem, disk, R1, R2)
+    return joinResults, io_count, method, estimates
+
+def buildIndex(mem, disk, R, order=13):
+    # Scans R once and indexes its tuples on B; postings keep every C of a repeated key
+    keys, values = [], []
+    for i in range(R.numBlocks(disk.BLOCK_SIZE)):
+        mem.readFromDisk(disk, R.base_address + i, mem.base_address)
+        for key, val in filter(None, mem.array[mem.base_address:mem.base_address + disk.BLOCK_SIZE]):
+            keys.append(key)
+            values.append(val)
+    mem.flush()
+    index = InstrumentedBPlusTree(order, unique=False)
+    index.build(keys, bulk=True, values=values)
+    return index
+
+def indexNestedLoopJoin(mem, disk, R1, R2, index=None):
+    # R2 is read SIZE - 1 blocks at a time and each batch probes the index on R1.B in key
+    # order, so every node touched by a batch, leaves included, costs one disk IO
+    begin_io_count = disk.io_count
+    phases = {}
+    if index == None:
+        index = buildIndex(mem, disk, R1)
+        phases["index build"] = disk.io_count - begin_io_count
+    joinResults = []
+    r_begin_io_count, visits = disk.io_count, index.metrics.visits
+    batch_blocks = mem.SIZE - 1
+    num_blocks = R2.numBlocks(disk.BLOCK_SIZE)
+    for start in range(0, num_blocks, batch_blocks):
+        chunk = range(start, min(start + batch_blocks, num_blocks))
+        for i, block in enumerate(chunk):
+            mem.readFromDisk(disk, R2.base_address + block, mem.base_address + i * disk.BLOCK_SIZE)
+        tuples = sorted(filter(None, mem.array[mem.base_address:mem.base_address + len(chunk) * disk.BLOCK_SIZE]), key=itemgetter(0))
+        for (key, valR2), matches in zip(tuples, index.get_many([key for key, _ in tuples], ())):
+            for valR1 in matches:
+                joinResults.append((key, valR1, valR2))
+        mem.flush()
+    phases["scan " + R2.name] = disk.io_count - r_begin_io_count
+    disk.countRandom(index.metrics.visits - visits)
+    phases["index probes"] = index.metrics.visits - visits
+    return joinResults, disk.io_count - begin_io_count, phases
+
+def toColumnar(disk, R, width=10):
+    # Rewrites the blocks of R in place as ColumnarBlocks; like generating R, this is not disk IO
+    for i in range(R.numBlocks(disk.BLOCK_SIZE)):
+        rows = [tuple for tuple in disk.array[R.base_address + i].data if tuple != None]
+        disk.array[R.base_address + i] = ColumnarBlock(disk.BLOCK_SIZE, [key for key, _ in rows], packValues([val for _, val in rows], width), width)
+    return R
+
+def partitionColumnarRun(disk, run, num_parts, partsOf, resident_blocks, onResident, store_resident):
+    # partitionRun over columnar runs, reading and writing the same blocks: every partition
+    # buffers one output block and partition 0 may stay resident in resident_blocks. partsOf
+    # maps a whole block of keys to partitions in one call and values are copied as
+    # fixed-width byte slices.
+    resident = resident_blocks > 0
+    keyBufs = [array('q') for _ in range(num_parts)]
+    valBufs = [bytearray() for _ in range(num_parts)]
+    blocks, counts = [[] for _ in range(num_parts)], [0] * num_parts
+    width = None
+
+    def spill(part, keys, values):
+        block_id = disk.allocateBlock()
+        disk.writeBlock(ColumnarBlock(disk.BLOCK_SIZE, keys, values, width), block_id)
+        blocks[part].append(block_id)
+        counts[part] += len(keys)
+
+    for block_id in run[0]:
+        block = disk.readBlock(block_id)
+        width, values = block.width, block.values
+        for i, (key, part) in enumerate(zip(block.keys, partsOf(block.keys))):
+            val = values[i * width:(i + 1) * width]
+            if part == 0 and resident:
+                if not store_resident or len(keyBufs[0]) < resident_blocks * disk.BLOCK_SIZE:
+                    if store_resident:
+                        keyBufs[0].append(key)
+                        valBufs[0] += val
+                    onResident(key, val)
+                    continue
+                for j in range(0, resident_blocks * disk.BLOCK_SIZE, disk.BLOCK_SIZE):
+                    spill(0, keyBufs[0][j:j + disk.BLOCK_SIZE], valBufs[0][j * width:(j + disk.BLOCK_SIZE) * width])
+                keyBufs[0], valBufs[0] = array('q'), bytearray()
+                resident = False
+            keyBufs[part].append(key)
+            valBufs[part] += val
+            if len(keyBufs[part]) == disk.BLOCK_SIZE:
+                spill(part, keyBufs[part], valBufs[part])
+                keyBufs[part], valBufs[part] = array('q'), bytearray()
+    for part in range(num_parts):
+        if keyBufs[part] and not (part == 0 and resident):
+            spill(part, keyBufs[part], valBufs[part])
+    return list(zip(blocks, counts)), resident
+
+def partitionColumnar(disk, run, num_parts, hashFn, seed):
+    # One block is read at a time and every partition buffers one output block, the same
+    # memory as generateBuckets
+    return partitionColumnarRun(disk, run, num_parts, lambda keys: hashBlock(hashFn, keys, num_parts, seed), 0, None, False)[0]
+
+def joinColumnarInMemory(mem, disk, build, probe, build_is_r1, joinResults):
+    # joinRunsInMemory on columnar runs: SIZE - 1 build blocks at a time, the probe run
+    # streamed once per chunk. Values stay encoded in the table and only matching rows
+    # are decoded.
+    chunk = mem.SIZE - 1
+    for start in range(0, len(build[0]), chunk):
+        table = {}
+        for block_id in build[0][start:start + chunk]:
+            block = disk.readBlock(block_id)
+            width, values = block.width, block.values
+            for i, key in enumerate(block.keys):
+                table.setdefault(key, []).append(values[i * width:(i + 1) * width])
+        for block_id in probe[0]:
+            block = disk.readBlock(block_id)
+            for i in [i for i, key in enumerate(block.keys) if key in table]:
+                key, val = block.keys[i], block.value(i)
+                for match in table[key]:
+                    match = match.rstrip(b"\0").decode()
+                    joinResults.append((key, match, val) if build_is_r1 else (key, val, match))
+
+def joinColumnarRuns(mem, disk, build, probe, build_is_r1, depth, joinResults):
+    # hybridJoinRuns on columnar runs: the same partition choice, seeds and resident
+    # partition, so an overflowing bucket costs exactly the IO it costs in hashJoin
+    if len(probe[0]) < len(build[0]):
+        build, probe, build_is_r1 = probe, build, not build_is_r1
+    if len(build[0]) <= mem.SIZE - 1 or depth >= HYBRID_MAX_DEPTH:
+        joinColumnarInMemory(mem, disk, build, probe, build_is_r1, joinResults)
+        return
+
+    spills, resident_blocks, share = choosePartitions(len(build[0]), mem.SIZE)
+    num_parts = spills + (1 if resident_blocks else 0)
+    partsOf = lambda keys: [partitionOf(key, depth, len(build[0]), share, spills) for key in keys]
+    table = {}
+
+    def addResident(key, val):
+        table.setdefault(key, []).append(val)
+
+    def probeResident(key, val):
+        val = val.rstrip(b"\0").decode()
+        for match in table.get(key, ()):
+            match = match.rstrip(b"\0").decode()
+            joinResults.append((key, match, val) if build_is_r1 else (key, val, match))
+
+    build_parts, resident = partitionColumnarRun(disk, build, num_parts, partsOf, resident_blocks, addResident, True)
+    probe_parts, _ = partitionColumnarRun(disk, probe, num_parts, partsOf, resident_blocks if resident else 0, probeResident, False)
+    for part in range(num_parts):
+        if (part == 0 and resident) or build_parts[part][1] == 0 or probe_parts[part][1] == 0:
+            continue
+        joinColumnarRuns(mem, disk, build_parts[part], probe_parts[part], build_is_r1, depth + 1, joinResults)
+
+def columnarHashJoin(mem, disk, R1, R2, hashFn=mixHash):
+    # Grace hash join over relations stored with toColumnar; block reads and writes are
+    # counted exactly as in hashJoin, but partitions are allocated as runs, so BUCKET_CAP
+    # does not limit relation size
+    begin_io_count = disk.io_count
+    mark = len(disk.array)
+    num_parts = mem.SIZE - 1
+    joinResults = []
+    for part1, part2 in zip(partitionColumnar(disk, relationRun(disk, R1), num_parts, hashFn, 0),
+                            partitionColumnar(disk, relationRun(disk, R2), num_parts, hashFn, 0)):
+        # As in HashJoinIterator.probe, the side with fewer tuples builds, R2 on a tie
+        if part1[1] and part2[1]:
+            build_r1 = part1[1] < part2[1]
+            build, probe = (part1, part2) if build_r1 else (part2, part1)
+            joinColumnarRuns(mem, disk, build, probe, build_r1, 1, joinResults)
+    del disk.array[mark:]
     return joinResults, disk.io_count - begin_io_count
 
 def verifyHashJoin(joinResults, R1, R2):
-    for key, valR1, valR2 in joinResults:
-        if (key, valR1) not in R1.ref or (key, valR2) not in R2.ref:
-            print("Error:", key, valR1, valR2)
-            return False
-    print(f"\nJoin verified for {R1.name} and {R2.name}. Total tuples: {len(joinResults)}")
+    # joinResults may be any iterable, including a HashJoinIterator still producing rows;
+    # it must be exactly the join of R1 and R2 as a multiset. The test oracle is only
+    # imported by the workloads that validate against it.
+    from verify import check_join
+    problems, count = check_join(joinResults, R1, R2)
+    if problems:
+        print("Error:", "; ".join(problems))
+        return False
+    print(f"\nJoin verified for {R1.name} and {R2.name}. Total tuples: {count}")
     return True
 
-random.seed(23)
-disk = VirtualDisk()
-mem = VirtualMemory()
+def main():
+    from verify import check_join
+    random.seed(23)
+    disk = VirtualDisk()
+    mem = VirtualMemory()
+
+
+    relationBC = generateRelationBC(disk)
+    relationAB = generateRelationABFromBKeys(disk, relationBC.refKeys)
+    relationAB2 = generateRelationAB(disk)
+
+    joinResults, io_count = hashJoin(mem, disk, relationBC, relationAB)
+    verifyHashJoin(joinResults, relationBC, relationAB)
+    print(f"Total disk IO: {io_count}")
+    graceIoCount = io_count
+    randomBKeys = random.sample(list(relationAB.refKeys), 20)
+
+    results = [t for t in joinResults if t[0] in randomBKeys]
+    print("\nBC ⨝ AB")
+    # print(tabulate(results, headers=["B", "C", "A"]))
+    print(tabulate(results, headers=["B", "C", "A"], tablefmt="rounded_grid"))
+
+    joinResults, io_count = hashJoin(mem, disk, relationBC, relationAB2)
+    verifyHashJoin(joinResults, relationBC, relationAB2)
+    print(f"Disk IO (BC buckets pre-computed): {io_count} \nTotal Disk IO (recounting BC bucket generation): {io_count + relationBC.metrics[0]}")
+    print("\nBC ⨝ AB2")
+    # print(tabulate(joinResults, headers=["B", "C", "A"]))
+    print(tabulate(joinResults, headers=["B", "C", "A"], tablefmt="rounded_grid"))
+
+    hybridResults, io_count, phases = hybridHashJoin(mem, disk, relationBC, relationAB)
+    verifyHashJoin(hybridResults, relationBC, relationAB)
+    gracePhases = {"partition BC": relationBC.metrics[0], "partition AB": relationAB.metrics[0],
+                   "join": graceIoCount - relationBC.metrics[0] - relationAB.metrics[0]}
+    print("\nBC ⨝ AB disk IO per phase")
+    print(tabulate([["grace", phase, io] for phase, io in gracePhases.items()] + [["hybrid", phase, io] for phase, io in phases.items()],
+                   headers=["Join", "Phase", "Disk IO"], tablefmt="rounded_grid"))
+    print(f"Grace hash join: {graceIoCount}, hybrid hash join: {io_count}")
+    hybridIoCount = io_count
+
+    sortMergeResults, io_count, phases = sortMergeJoin(mem, disk, relationBC, relationAB)
+    verifyHashJoin(sortMergeResults, relationBC, relationAB)
+    actual = {"grace hash": graceIoCount, "hybrid hash": hybridIoCount, "sort-merge": io_count}
+
+    # The index on BC.B is assumed to exist already, so only the probes of AB are compared
+    indexBC = buildIndex(mem, disk, relationBC)
+    # Estimate without reusing partitions, as the grace join above started without any
+    estimates = estimateJoinCosts(mem, disk, relationBC, relationAB, reuse=False, index=indexBC)
+    indexResults, io_count, phases = indexNestedLoopJoin(mem, disk, relationBC, relationAB, indexBC)
+    verifyHashJoin(indexResults, relationBC, relationAB)
+    actual["index nested-loop"] = io_count
+    print("\nBC ⨝ AB estimated vs actual disk IO")
+    print(tabulate([[method, estimates.get(method), io] for method, io in actual.items()],
+                   headers=["Join", "Estimated", "Actual"], tablefmt="rounded_grid"))
+    print(f"Planner picks: {min(estimates, key=estimates.get)}")
+
+    # BC ⨝ AB2 again from cold caches, with and without a Bloom filter on BC.B
+    mem.catalog.clear()
+    joinResults, plainIoCount = hashJoin(mem, disk, relationBC, relationAB2)
+    mem.catalog.clear()
+    bloomResults, bloomIoCount = hashJoin(mem, disk, relationBC, relationAB2, bloom=True)
+    verifyHashJoin(bloomResults, relationBC, relationAB2)
+    bloomBC = mem.catalog.peek(relationBC, mem.SIZE - 1, jenkinsHash).filter
+    matching = sum(1 for key, _ in relationAB2.ref if key in relationBC.refKeys)
+    print("\nBC ⨝ AB2 with a Bloom filter on BC.B")
+    print(tabulate([["Filter size (bytes)", len(bloomBC.bits)], ["Hash functions", bloomBC.num_hashes],
+                    ["Expected false-positive rate", f"{bloomBC.expectedFalsePositiveRate():.4f}"],
+                    ["Measured false-positive rate", f"{(bloomBC.passed - matching) / max(1, bloomBC.tested - matching):.4f}"],
+                    ["AB2 tuples dropped", bloomBC.tested - bloomBC.passed],
+                    ["Disk IO without filter", plainIoCount], ["Disk IO with filter", bloomIoCount],
+                    ["Disk IO saved", plainIoCount - bloomIoCount]], tablefmt="rounded_grid"))
+
+    # Streamed BC ⨝ AB2 with pushdown: (B, A) of rows with B below 25000, stopping after five
+    join = HashJoinIterator(mem, disk, relationBC, relationAB2, where=lambda row: row[0] < 25000, columns=(0, 2))
+    join.open()
+    firstRows = []
+    while len(firstRows) < 5:
+        try:
+            firstRows.append(join.next())
+        except StopIteration:
+            break
+    join.close()
+    print("\nFirst rows of a streamed BC ⨝ AB2")
+    print(tabulate(firstRows, headers=["B", "A"], tablefmt="rounded_grid"))
+    print(f"Disk IO until close: {join.io_count}")
+    verifyHashJoin(HashJoinIterator(mem, disk, relationBC, relationAB2), relationBC, relationAB2)
+
+    # Partitioning BC with each hash function: CPU time and bucket skew
+    skewRows = []
+    for name, hashFn in (("jenkins", jenkinsHash), ("mix", mixHash)):
+        begin = time.perf_counter()
+        generateBuckets(mem, disk, relationBC, mem.SIZE - 1, hashFn=hashFn)
+        elapsed = time.perf_counter() - begin
+        report = skewReport(mem, disk, relationBC, hashFn)
+        skewRows.append([name, f"{elapsed * 1000:.1f}", report["min"], report["max"], f"{report['stdev']:.1f}", f"{report['max/mean']:.2f}"])
+    mem.catalog.clear()
+    print("\nPartitioning BC by hash function")
+    print(tabulate(skewRows, headers=["Hash", "Time (ms)", "Min", "Max", "Stdev", "Max/mean"], tablefmt="rounded_grid"))
+
+    # Bucket pairs joined in a process pool must give the serial output in the same order
+    mem.catalog.clear()
+    serialResults, serialIoCount = hashJoin(mem, disk, relationBC, relationAB)
+    mem.catalog.clear()
+    parallelResults, parallelIoCount = hashJoin(mem, disk, relationBC, relationAB, workers=4)
+    print(f"\nParallel BC ⨝ AB matches serial: {parallelResults == serialResults}, disk IO serial {serialIoCount}, parallel {parallelIoCount}")
 
+    # The same join on columnar blocks: identical IO, less CPU per tuple
+    mem.catalog.clear()
+    begin = time.perf_counter()
+    rowResults, rowIoCount = hashJoin(mem, disk, relationBC, relationAB, hashFn=mixHash)
+    rowTime = time.perf_counter() - begin
+    toColumnar(disk, relationBC)
+    toColumnar(disk, relationAB)
+    begin = time.perf_counter()
+    columnarResults, columnarIoCount = columnarHashJoin(mem, disk, relationBC, relationAB)
+    columnarTime = time.perf_counter() - begin
+    verifyHashJoin(columnarResults, relationBC, relationAB)
+    print(tabulate([["rows", rowIoCount, f"{rowTime * 1000:.1f}"], ["columnar", columnarIoCount, f"{columnarTime * 1000:.1f}"]],
+                   headers=["BC ⨝ AB blocks", "Disk IO", "Time (ms)"], tablefmt="rounded_grid"))
 
-relationBC = generateRelationBC(disk)
-relationAB = generateRelationABFromBKeys(disk, relationBC.refKeys)
-relationAB2 = generateRelationAB(disk)
+    # BC ⨝ AB on a file-backed disk, per phase, without and with read-ahead
+    phaseRows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for read_ahead in (0, 32):
+            fileDisk = FileVirtualDisk(os.path.join(directory, f"disk{read_ahead}"), read_ahead=read_ahead)
+            fileMem = VirtualMemory()
+            fileBC = generateRelationBC(fileDisk)
+            fileAB = generateRelationABFromBKeys(fileDisk, fileBC.refKeys)
+            verifyHashJoin(hashJoin(fileMem, fileDisk, fileBC, fileAB)[0], fileBC, fileAB)
+            for phase, stats in fileDisk.phases.items():
+                phaseRows.append([read_ahead, phase, stats["io"], stats["sequential"], stats["random"], f"{stats['seconds'] * 1000:.1f}"])
+            fileDisk.close()
+    print(tabulate(phaseRows, headers=["Read-ahead", "Phase", "Disk IO", "Sequential", "Random", "Time (ms)"], tablefmt="rounded_grid"))
 
-joinResults, io_count = hashJoin(mem, disk, relationBC, relationAB)
-verifyHashJoin(joinResults, relationBC, relationAB)
-print(f"Total disk IO: {io_count}")
-randomBKeys = random.sample(list(relationAB.refKeys), 20)
+    # A catalog holding two relations: BC ⨝ AB2 reuses BC's partitions and evicts AB's, the least
+    # recently used, to make room for AB2's
+    mem.catalog = PartitionCatalog(capacity=relationBC.size // disk.BLOCK_SIZE + relationAB.size // disk.BLOCK_SIZE + 2 * (mem.SIZE - 1))
+    catalogRows = []
+    for R1, R2 in ((relationBC, relationAB), (relationBC, relationAB2), (relationAB, relationAB2)):
+        joinResults, io_count = hashJoin(mem, disk, R1, R2)
+        verifyHashJoin(joinResults, R1, R2)
+        catalogRows.append([f"{R1.name} ⨝ {R2.name}", io_count, mem.catalog.hits, mem.catalog.misses, mem.catalog.evictions, mem.catalog.io_saved])
+    print(tabulate(catalogRows, headers=["Join", "Disk IO", "Hits", "Misses", "Evictions", "IO saved"], tablefmt="rounded_grid"))
 
-results = [t for t in joinResults if t[0] in randomBKeys]
-print("\nBC ⨝ AB")
-# print(tabulate(results, headers=["B", "C", "A"]))
-print(tabulate(results, headers=["B", "C", "A"], tablefmt="rounded_grid"))
+    # BC ⨝ AB ⨝ AB2 on B as one multi-way join and as a chain of two hash joins, from cold partitions
+    mem = VirtualMemory()
+    relations = [relationBC, relationAB, relationAB2]
+    multiwayRows, (chainResults, multiwayResults) = compareMultiwayJoin(mem, disk, relations)
+    problems, _ = check_join(multiwayResults, *relations)
+    print(f"\nMulti-way BC ⨝ AB ⨝ AB2 verified: {not problems and Counter(chainResults) == Counter(multiwayResults)}")
+    print(tabulate(multiwayRows, headers=["BC ⨝ AB ⨝ AB2", "Disk IO", "Peak (KiB)", "Rows"], tablefmt="rounded_grid"))
 
-joinResults, io_count = hashJoin(mem, disk, relationBC, relationAB2)
-verifyHashJoin(joinResults, relationBC, relationAB2)
-print(f"Disk IO (BC buckets pre-computed): {io_count} \nTotal Disk IO (recounting BC bucket generation): {io_count + relationBC.metrics[0]}")
-print("\nBC ⨝ AB2")
-# print(tabulate(joinResults, headers=["B", "C", "A"]))
-print(tabulate(joinResults, headers=["B", "C", "A"], tablefmt="rounded_grid"))
+if __name__ == "__main__":
+    main()
 
 '''
 Doubts:
@@ -0,0 +1,390 @@
+import math
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+PAGE_SIZE = 4096
+MAGIC = b"BPT1"
+NO_PAGE = -1
+
+FREE_PAGE, LEAF_PAGE, INTERNAL_PAGE = 0, 1, 2
+# magic, page size, threshold, root page, page count, free list head
+META_FORMAT = struct.Struct("<4sIIqqq")
+# page type, key count, next leaf, prev leaf (next free page for free pages)
+HEADER_FORMAT = struct.Struct("<BxHqq")
+
+
+class Page:
+    __slots__ = ("page_id", "is_leaf", "keys", "values", "children", "next", "prev", "dirty")
+
+    def __init__(self, page_id, is_leaf):
+        self.page_id = page_id
+        self.is_leaf = is_leaf
+        self.keys = array("q")
+        self.values = array("q")
+        self.children = array("q")
+        self.next = NO_PAGE
+        self.prev = NO_PAGE
+        self.dirty = True
+
+    def encode(self, page_size):
+        kind = LEAF_PAGE if self.is_leaf else INTERNAL_PAGE
+        body = self.keys.tobytes() + (self.values if self.is_leaf else self.children).tobytes()
+        data = HEADER_FORMAT.pack(kind, len(self.keys), self.next, self.prev) + body
+        return data + bytes(page_size - len(data))
+
+    @staticmethod
+    def decode(page_id, data):
+        kind, count, next_id, prev_id = HEADER_FORMAT.unpack_from(data)
+        page = Page(page_id, kind == LEAF_PAGE)
+        page.next, page.prev = next_id, prev_id
+        offset = HEADER_FORMAT.size
+        page.keys.frombytes(data[offset:offset + 8 * count])
+        offset += 8 * count
+        if page.is_leaf:
+            page.values.frombytes(data[offset:offset + 8 * count])
+        else:
+            page.children.frombytes(data[offset:offset + 8 * (count + 1)])
+        page.dirty = False
+        return page
+
+
+class PageFile:
+    def __init__(self, path, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        exists = os.path.exists(path) and os.path.getsize(path) >= page_size
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(page_size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.reads = 0
+        self.writes = 0
+
+    def num_pages(self):
+        return len(self.mm) // self.page_size
+
+    def grow(self, num_pages):
+        self.file.truncate(num_pages * self.page_size)
+        self.mm.resize(num_pages * self.page_size)
+
+    def read(self, page_id):
+        self.reads += 1
+        offset = page_id * self.page_size
+        return self.mm[offset:offset + self.page_size]
+
+    def write(self, page_id, data):
+        self.writes += 1
+        offset = page_id * self.page_size
+        self.mm[offset:offset + self.page_size] = data
+
+    def read_meta(self):
+        return META_FORMAT.unpack_from(self.mm, 0)
+
+    def write_meta(self, *fields):
+        META_FORMAT.pack_into(self.mm, 0, MAGIC, self.page_size, *fields)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class BufferPool:
+    def __init__(self, page_file, capacity=64):
+        self.page_file = page_file
+        self.capacity = capacity
+        self.pages = OrderedDict()
+        # Pages touched by the running operation stay pinned until release()
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fetch(self, page_id):
+        page = self.pages.get(page_id)
+        if page is None:
+            self.misses += 1
+            self._make_room()
+            page = Page.decode(page_id, self.page_file.read(page_id))
+            self.pages[page_id] = page
+        else:
+            self.hits += 1
+            self.pages.move_to_end(page_id)
+        self.pinned.add(page_id)
+        return page
+
+    def add(self, page):
+        if page.page_id not in self.pages:
+            self._make_room()
+        self.pages[page.page_id] = page
+        self.pinned.add(page.page_id)
+
+    def drop(self, page_id):
+        self.pages.pop(page_id, None)
+        self.pinned.discard(page_id)
+
+    def release(self, keep=()):
+        # Unpins every page but those in keep
+        self.pinned = {page_id for page_id in keep if page_id in self.pages}
+
+    def _make_room(self):
+        # Evicts least recently used unpinned pages until a frame is free
+        while len(self.pages) >= self.capacity:
+            page_id = next((page_id for page_id in self.pages if page_id not in self.pinned), None)
+            if page_id is None:
+                raise RuntimeError(f"all {self.capacity} buffer pool frames are pinned")
+            page = self.pages.pop(page_id)
+            self.evictions += 1
+            if page.dirty:
+                self.page_file.write(page_id, page.encode(self.page_file.page_size))
+
+    def flush(self):
+        for page_id, page in self.pages.items():
+            if page.dirty:
+                self.page_file.write(page_id, page.encode(self.page_file.page_size))
+                page.dirty = False
+
+
+class PagedBPlusTree:
+    # Integer keys and integer payloads (record ids) only, so every page has a fixed layout.
+    # This is a separate implementation of BPlusTree's unique-key node logic, not a storage
+    # mode of BPlusTree: no postings, cursors or bulk operations, and test_matches_bplus_tree
+    # keeps insert/delete/get/search/range_search in step with it.
+    def __init__(self, path, order, is_sparse=False, page_size=PAGE_SIZE, pool_size=64):
+        self.order = order
+        self.is_sparse = is_sparse
+        self.page_file = PageFile(path, page_size)
+        self.pool = BufferPool(self.page_file, pool_size)
+        capacity = (page_size - HEADER_FORMAT.size - 8) // 16
+        threshold = math.ceil(order / 2) if is_sparse else order
+        if threshold > capacity:
+            raise ValueError(f"order {order} does not fit in a {page_size} byte page")
+
+        magic, stored_page_size, stored_threshold, root, count, free = self.page_file.read_meta()
+        if magic == MAGIC:
+            if stored_page_size != page_size or stored_threshold != threshold:
+                raise ValueError(f"{path} was created with a different page size or order")
+            self.threshold, self.root_id, self.page_count, self.free_head = stored_threshold, root, count, free
+        else:
+            self.threshold, self.page_count, self.free_head = threshold, 1, NO_PAGE
+            self.root_id = self._allocate(True).page_id
+            self._end()
+
+    def _allocate(self, is_leaf):
+        if self.free_head != NO_PAGE:
+            page_id = self.free_head
+            self.free_head = HEADER_FORMAT.unpack_from(self.page_file.read(page_id))[2]
+        else:
+            page_id = self.page_count
+            self.page_count += 1
+            if self.page_count > self.page_file.num_pages():
+                self.page_file.grow(max(self.page_count, 2 * self.page_file.num_pages()))
+        page = Page(page_id, is_leaf)
+        self.pool.add(page)
+        return page
+
+    def _free(self, page):
+        self.pool.drop(page.page_id)
+        self.page_file.write(page.page_id, HEADER_FORMAT.pack(FREE_PAGE, 0, self.free_head, NO_PAGE)
+                             + bytes(self.page_file.page_size - HEADER_FORMAT.size))
+        self.free_head = page.page_id
+
+    def _end(self):
+        self.page_file.write_meta(self.threshold, self.root_id, self.page_count, self.free_head)
+        self.pool.release()
+
+    def _find_path(self, key):
+        path, page = [], self.pool.fetch(self.root_id)
+        while not page.is_leaf:
+            loc = bisect_right(page.keys, key)
+            path.append((page, loc))
+            page = self.pool.fetch(page.children[loc])
+        return path, page
+
+    def insert(self, key, value=0):
+        path, leaf = self._find_path(key)
+        loc = bisect_left(leaf.keys, key)
+        leaf.dirty = True
+        if loc < len(leaf.keys) and leaf.keys[loc] == key:
+            leaf.values[loc] = value
+            self._end()
+            return
+        leaf.keys.insert(loc, key)
+        leaf.values.insert(loc, value)
+
+        node, split = leaf, None
+        if len(leaf.keys) > self.threshold:
+            split = self._split_leaf(leaf)
+        while split:
+            sep, new_page = split
+            if not path:
+                root = self._allocate(False)
+                root.keys.append(sep)
+                root.children.extend([node.page_id, new_page.page_id])
+                self.root_id = root.page_id
+                break
+            node, loc = path.pop()
+            node.keys.insert(loc, sep)
+            node.children.insert(loc + 1, new_page.page_id)
+            node.dirty = True
+            split = self._split_internal(node) if len(node.keys) > self.threshold else None
+        self._end()
+
+    def _split_leaf(self, leaf):
+        mid = len(leaf.keys) // 2
+        new_leaf = self._allocate(True)
+        new_leaf.keys, leaf.keys = leaf.keys[mid:], leaf.keys[:mid]
+        new_leaf.values, leaf.values = leaf.values[mid:], leaf.values[:mid]
+        new_leaf.prev, new_leaf.next = leaf.page_id, leaf.next
+        if leaf.next != NO_PAGE:
+            successor = self.pool.fetch(leaf.next)
+            successor.prev = new_leaf.page_id
+            successor.dirty = True
+        leaf.next = new_leaf.page_id
+        return new_leaf.keys[0], new_leaf
+
+    def _split_internal(self, node):
+        mid = len(node.keys) // 2
+        new_node = self._allocate(False)
+        sep = node.keys[mid]
+        new_node.keys, node.keys = node.keys[mid + 1:], node.keys[:mid]
+        new_node.children, node.children = node.children[mid + 1:], node.children[:mid + 1]
+        return sep, new_node
+
+    def delete(self, key):
+        path, leaf = self._find_path(key)
+        loc = bisect_left(leaf.keys, key)
+        if loc == len(leaf.keys) or leaf.keys[loc] != key:
+            self._end()
+            return False
+        del leaf.keys[loc]
+        del leaf.values[loc]
+        leaf.dirty = True
+
+        node = leaf
+        while path and len(node.keys) < self._min_keys(node):
+            parent, loc = path.pop()
+            self._rebalance(parent, loc, node)
+            node = parent
+        if not node.is_leaf and not node.keys and not path:
+            self.root_id = node.children[0]
+            self._free(node)
+        self._end()
+        return True
+
+    def _min_keys(self, node):
+        return (self.threshold + 1) // 2 if node.is_leaf else self.threshold // 2
+
+    def _rebalance(self, parent, loc, node):
+        parent.dirty = True
+        left = self.pool.fetch(parent.children[loc - 1]) if loc > 0 else None
+        right = self.pool.fetch(parent.children[loc + 1]) if loc + 1 < len(parent.children) else None
+        if left and len(left.keys) > self._min_keys(left):
+            left.dirty = node.dirty = True
+            if node.is_leaf:
+                node.keys.insert(0, left.keys.pop())
+                node.values.insert(0, left.values.pop())
+                parent.keys[loc - 1] = node.keys[0]
+            else:
+                node.keys.insert(0, parent.keys[loc - 1])
+                node.children.insert(0, left.children.pop())
+                parent.keys[loc - 1] = left.keys.pop()
+        elif right and len(right.keys) > self._min_keys(right):
+            right.dirty = node.dirty = True
+            if node.is_leaf:
+                node.keys.append(right.keys.pop(0))
+                node.values.append(right.values.pop(0))
+                parent.keys[loc] = right.keys[0]
+            else:
+                node.keys.append(parent.keys[loc])
+                node.children.append(right.children.pop(0))
+                parent.keys[loc] = right.keys.pop(0)
+        elif left:
+            self._merge(parent, loc - 1, left, node)
+        else:
+            self._merge(parent, loc, node, right)
+
+    def _merge(self, parent, loc, left, right):
+        # Fold right into left and drop the separator between them from the parent
+        left.dirty = True
+        if left.is_leaf:
+            left.keys.extend(right.keys)
+            left.values.extend(right.values)
+            left.next = right.next
+            if right.next != NO_PAGE:
+                successor = self.pool.fetch(right.next)
+                successor.prev = left.page_id
+                successor.dirty = True
+        else:
+            left.keys.append(parent.keys[loc])
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+        del parent.keys[loc]
+        del parent.children[loc + 1]
+        self._free(right)
+
+    def get(self, key, default=None):
+        _, leaf = self._find_path(key)
+        loc = bisect_left(leaf.keys, key)
+        ret = leaf.values[loc] if loc < len(leaf.keys) and leaf.keys[loc] == key else default
+        self._end()
+        return ret
+
+    def search(self, key):
+        _, leaf = self._find_path(key)
+        loc = bisect_left(leaf.keys, key)
+        ret = [key] if loc < len(leaf.keys) and leaf.keys[loc] == key else []
+        self._end()
+        return ret
+
+    def range_search(self, start, end):
+        _, leaf = self._find_path(start)
+        ret, lo = [], bisect_left(leaf.keys, start)
+        while True:
+            hi = bisect_right(leaf.keys, end, lo)
+            ret.extend(leaf.keys[lo:hi])
+            if hi < len(leaf.keys) or leaf.next == NO_PAGE:
+                break
+            leaf, lo = self.pool.fetch(leaf.next), 0
+            # Only the leaf being scanned needs to stay pinned
+            self.pool.release(keep=(leaf.page_id,))
+        self._end()
+        return ret
+
+    def build(self, keys):
+        for key in keys:
+            self.insert(key)
+
+    def stats(self):
+        return {
+            "pool_size": self.pool.capacity,
+            "cached_pages": len(self.pool.pages),
+            "page_count": self.page_count,
+            "hits": self.pool.hits,
+            "misses": self.pool.misses,
+            "hit_rate": self.pool.hits / max(1, self.pool.hits + self.pool.misses),
+            "evictions": self.pool.evictions,
+            "page_reads": self.page_file.reads,
+            "page_writes": self.page_file.writes,
+        }
+
+    def flush(self):
+        self.pool.flush()
+        self._end()
+        self.page_file.flush()
+
+    def close(self):
+        self.flush()
+        self.page_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
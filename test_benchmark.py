@@ -0,0 +1,24 @@
+import csv, json
+from benchmark import FIELDS, JOIN_METHODS, TREE_OPS, main
+
+ARGV = ["--keys", "100", "--ops", "100", "--sizes", "200:200", "--memory", "8", "--repeat", "1"]
+
+def test_json_output(capsys):
+    main(ARGV + ["--format", "json"])
+    output = json.loads(capsys.readouterr().out)
+    assert output["meta"]["seed"] == 1 and output["meta"]["argv"][-1] == "json"
+    results = output["results"]
+    assert all(list(row) == FIELDS for row in results)
+    trees = [row for row in results if row["suite"] == "tree"]
+    joins = [row for row in results if row["suite"] == "join"]
+    assert len(trees) == 2 * 2 * len(TREE_OPS) and {row["op"] for row in trees} == set(TREE_OPS)
+    assert len(joins) == 2 * len(JOIN_METHODS) and {row["op"] for row in joins} == set(JOIN_METHODS)
+    assert all(row["ops"] > 0 and row["io_count"] > 0 and row["p50_us"] <= row["p99_us"] for row in joins)
+    assert all(row["ops"] == (1 if row["op"] == "search_many" else 100) for row in trees)
+
+def test_csv_output_to_a_file(tmp_path):
+    path = tmp_path / "results.csv"
+    main(ARGV + ["joins", "--format", "csv", "--output", str(path)])
+    with open(path, newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert rows and list(rows[0]) == FIELDS and {row["suite"] for row in rows} == {"join"}
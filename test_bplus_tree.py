@@ -0,0 +1,230 @@
+import random
+import pytest
+from bplus_tree import BPlusTree, ConcurrentBPlusTree, InstrumentedBPlusTree, concurrent_stress_test, snapshot_stress_test
+from verify import audit_tree, stress_tree
+
+def _structure_problems(tree):
+    problems, stack = [], [tree.root]
+    while stack:
+        node = stack.pop()
+        if node is not tree.root and len(node.keys) < node.min_keys():
+            problems.append(f"underfull node {list(node.keys)}")
+        if not node.is_leaf:
+            if len(node.children) != len(node.keys) + 1 or any(child.parent is not node for child in node.children):
+                problems.append(f"broken children under {list(node.keys)}")
+            stack.extend(node.children)
+    return problems
+
+@pytest.mark.parametrize("order", [3, 4, 5, 13])
+@pytest.mark.parametrize("is_sparse", [False, True])
+def test_delete_rebalances_after_every_key(order, is_sparse):
+    rng, tree = random.Random(order), BPlusTree(order, is_sparse=is_sparse)
+    keys = list(range(400))
+    rng.shuffle(keys)
+    for key in keys:
+        tree.insert(key)
+    remaining = set(keys)
+    rng.shuffle(keys)
+    for key in keys:
+        tree.delete(key)
+        remaining.discard(key)
+        assert _structure_problems(tree) == []
+        assert tree.search(key) == []
+        if len(remaining) % 50 == 0:
+            assert tree.range_search(0, 400) == sorted(remaining)
+    assert tree.root.is_leaf and tree.root.keys == []
+
+def test_delete_keeps_the_surviving_leaf_of_a_merge():
+    tree = BPlusTree(3)
+    for key in range(1, 11):
+        tree.insert(key)
+    for key in (4, 5, 6):
+        tree.delete(key)
+        assert _structure_problems(tree) == []
+    assert [key for key in range(1, 11) if tree.search(key)] == [1, 2, 3, 7, 8, 9, 10]
+
+@pytest.mark.parametrize("order", [3, 4, 5, 13, 24])
+@pytest.mark.parametrize("is_sparse", [False, True])
+@pytest.mark.parametrize("fill_factor", [0.1, 0.5, 0.7, 1.0])
+def test_bulk_load_then_delete_everything(order, is_sparse, fill_factor):
+    tree = BPlusTree(order, is_sparse=is_sparse)
+    tree.build(range(1000), bulk=True, fill_factor=fill_factor)
+    assert audit_tree(tree, check_fill=False) == []
+    keys = list(range(1000))
+    random.Random(order).shuffle(keys)
+    for key in keys:
+        tree.delete(key)
+    assert tree.leaf_keys() == []
+    assert audit_tree(tree) == []
+
+@pytest.mark.parametrize("order", [3, 13])
+@pytest.mark.parametrize("fill_factor", [0.1, 0.7, 1.0])
+def test_stress_after_bulk_load(order, fill_factor):
+    stress_tree(BPlusTree(order), 3000, seed=order, check_every=500, bulk_keys=1000, fill_factor=fill_factor)
+
+@pytest.mark.parametrize("is_sparse", [False, True])
+def test_stress(is_sparse):
+    stress_tree(BPlusTree(4, is_sparse=is_sparse), 5000, check_every=500)
+
+def test_concurrent_stress():
+    for threads, _, _, _, errors in concurrent_stress_test(5, (1, 4), ops_per_thread=1000, count=2000):
+        assert errors == 0, f"{threads} threads"
+
+@pytest.mark.parametrize("tree_class", [BPlusTree, ConcurrentBPlusTree])
+def test_delete_single_posting(tree_class):
+    tree = tree_class(4, unique=False)
+    for key in range(20):
+        tree.insert(key, "a")
+        tree.insert(key, "b")
+    tree.delete(5, "zzz")
+    tree.delete(50, "a")
+    assert tree.get(5) == ["a", "b"] and tree.get(50) is None
+    tree.delete(5, "a")
+    assert tree.get(5) == ["b"]
+    tree.delete(5, "b")
+    assert tree.get(5) is None and tree.leaf_keys() == [key for key in range(20) if key != 5]
+
+def test_concurrent_tree_versions_settle():
+    tree = ConcurrentBPlusTree(3)
+    for key in range(300):
+        tree.insert(key)
+    for key in range(0, 300, 2):
+        tree.delete(key)
+    assert audit_tree(tree) == []
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        assert node.version % 2 == 0 and not node.obsolete
+        stack.extend(node.children)
+    assert tree.range_search(0, 300) == list(range(1, 300, 2))
+
+def test_snapshot_stress():
+    row = snapshot_stress_test(5, count=2000, writes=20000, scanners=2)
+    assert row[3] >= 2 and row[-1] == 0
+
+@pytest.mark.parametrize("fill_factor", [None, 0.7])
+def test_bulk_merge(fill_factor):
+    tree = BPlusTree(5, unique=False)
+    tree.build(range(0, 2000, 2), bulk=True, values=range(1000), fill_factor=0.7)
+    leaves = _leaves(tree)
+    batch = [101, 103, 100, 100, 5001]
+    tree.bulk_merge(batch, fill_factor, values=["a", "b", "c", "d", "e"])
+    assert audit_tree(tree, check_fill=False) == []
+    assert tree.get(100) == [50, "c", "d"] and tree.get(103) == ["b"] and tree.get(5001) == ["e"]
+    assert tree.leaf_keys() == sorted(set(range(0, 2000, 2)) | set(batch))
+    untouched = [leaf for leaf in leaves if leaf.keys[-1] < 100 or leaf.keys[0] > 103]
+    if fill_factor is None:
+        assert sum(1 for leaf in _leaves(tree) if any(leaf is old for old in untouched)) == len(untouched)
+
+@pytest.mark.parametrize("order", [3, 4, 13])
+@pytest.mark.parametrize("is_sparse", [False, True])
+def test_bulk_merge_small_batches_match_inserts(order, is_sparse):
+    rng = random.Random(order)
+    tree, expected = BPlusTree(order, is_sparse=is_sparse), BPlusTree(order, is_sparse=is_sparse)
+    for key in rng.sample(range(20000), 2000):
+        tree.insert(key, key)
+        expected.insert(key, key)
+    for i in range(40):
+        batch = [rng.randrange(20000) for _ in range(rng.randint(1, 60))]
+        tree.bulk_merge(batch, values=[i] * len(batch))
+        for key in batch:
+            expected.insert(key, i)
+        assert audit_tree(tree) == []
+    assert list(tree.leaf_items()) == list(expected.leaf_items())
+
+def test_bulk_merge_repacks_large_batches():
+    tree = BPlusTree(5)
+    tree.build(range(100))
+    tree.bulk_merge(range(100, 200))
+    assert audit_tree(tree) == [] and tree.leaf_keys() == list(range(200))
+    assert all(len(leaf.keys) == 5 for leaf in _leaves(tree))
+
+def _leaves(tree):
+    node, ret = tree.find_leaf(), []
+    while node:
+        ret.append(node)
+        node = node.next
+    return ret
+
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("include_start, include_end", [(True, True), (False, True), (True, False), (False, False)])
+@pytest.mark.parametrize("start, end", [(None, None), (40, 160), (41, 161), (None, 100), (100, None), (500, 600)])
+@pytest.mark.parametrize("limit", [None, 7])
+def test_cursor_bounds(reverse, include_start, include_end, start, end, limit):
+    tree = BPlusTree(4)
+    keys = list(range(0, 300, 2))
+    for key in keys:
+        tree.insert(key, -key)
+    expected = [key for key in keys
+                if (start is None or key > start or (include_start and key == start))
+                and (end is None or key < end or (include_end and key == end))]
+    if reverse:
+        expected.reverse()
+    expected = expected[:limit]
+    cursor = tree.cursor(start, end, reverse, include_start, include_end, limit, items=True)
+    assert list(cursor) == [(key, -key) for key in expected]
+    assert cursor.position == (expected[-1] if expected else None)
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_cursor_resumes_after_the_tree_changes(reverse):
+    tree = BPlusTree(3)
+    model = set(range(0, 200, 2))
+    for key in model:
+        tree.insert(key)
+    cursor = tree.cursor(20, 180, reverse=reverse)
+    first = [next(cursor) for _ in range(10)]
+    cursor.close()
+    with pytest.raises(StopIteration):
+        next(cursor)
+    # Keys on both sides of the saved position change before the scan resumes
+    for key in range(1, 200, 6):
+        tree.insert(key)
+        model.add(key)
+    for key in range(0, 200, 8):
+        tree.delete(key)
+        model.discard(key)
+    rest = list(tree.cursor(20, 180, reverse=reverse, resume=cursor.position))
+    position = first[-1]
+    expected = sorted((key for key in model if 20 <= key <= 180 and (key < position if reverse else key > position)), reverse=reverse)
+    assert rest == expected
+    assert first == sorted((key for key in range(20, 181, 2)), reverse=reverse)[:10]
+
+@pytest.mark.parametrize("size", [0, 1, 3000])
+@pytest.mark.parametrize("is_sparse", [False, True])
+@pytest.mark.parametrize("unique", [True, False])
+def test_batched_lookups_match_single_lookups(size, is_sparse, unique):
+    rng = random.Random(size)
+    tree = BPlusTree(5, is_sparse=is_sparse, unique=unique)
+    for key in rng.sample(range(0, 20000, 2), size):
+        tree.insert(key, key * 10)
+    # Unsorted, with duplicates, absent keys in between and beyond both ends
+    probes = [rng.randrange(-100, 20100) for _ in range(1000)] + [7, 7, -1]
+    assert tree.search_many(probes) == [tree.search(key) for key in probes]
+    assert tree.contains_many(probes) == [tree.search(key) != [] for key in probes]
+    assert tree.get_many(probes, "none") == [tree.get(key, "none") for key in probes]
+    assert tree.search_many([]) == tree.get_many([]) == tree.contains_many([]) == []
+
+def test_instrumented_tree_counts_visits_events_and_latency():
+    tree = InstrumentedBPlusTree(4)
+    for key in range(200):
+        tree.insert(key)
+    height = tree.stats()["height"]
+    assert tree.metrics.events["leaf_split"] > 0 and tree.metrics.events["internal_split"] > 0
+    for key in (5, 150, 1000):
+        tree.search(key)
+    tree.range_search(0, 10)
+    for key in range(0, 200, 2):
+        tree.delete(key)
+    tree.get_many([1, 3, 500])
+    stats = tree.stats()
+    assert stats["operations"] == {"insert": 200, "search": 3, "range_search": 1, "delete": 100, "get_many": 1}
+    assert stats["nodes_visited_per_op"]["search"] == height
+    # The scan over 0..10 descends once, then walks the chain up to the first leaf past 10
+    plain = BPlusTree(4)
+    plain.build(range(200))
+    walked = next(i for i, leaf in enumerate(_leaves(plain)) if leaf.keys[-1] > 10)
+    assert stats["nodes_visited_per_op"]["range_search"] == height + walked
+    assert stats["nodes_visited_per_op"]["get_many"] >= height
+    assert stats["events"]["leaf_merge"] > 0
+    for op, count in stats["operations"].items():
+        assert sum(stats["latency_us"][op].values()) == count
@@ -0,0 +1,259 @@
+import gc, random, warnings
+from collections import Counter
+import pytest
+from hash_join import ColumnarBlock, HashJoinIterator, MappedBlocks, VirtualDisk, VirtualDiskBlock, VirtualMemory, buildIndex, columnarHashJoin, estimateIndexCost, externalSort, generateBuckets, generateRelation, hashJoin, hybridHashJoin, indexNestedLoopJoin, jenkinsHash, loadRelationBinary, loadRelationCSV, mixHash, multiwayHashJoin, pairwiseJoinChain, plannedJoin, readRelation, relationRun, saveRelationBinary, saveRelationCSV, scanRun, skewReport, sortMergeJoin, toColumnar, writeRelation
+from verify import check_join
+
+@pytest.fixture
+def disk():
+    random.seed(1)
+    return VirtualDisk()
+
+def relations(disk, low):
+    R = generateRelation(disk, "R", 800, keyRange=(low, low + 1000), unique=True)
+    S = generateRelation(disk, "S", 800, refKeys=R.refKeys)
+    return R, S
+
+def test_regenerated_relation_is_not_served_stale_partitions(disk):
+    mem = VirtualMemory()
+    R, S = relations(disk, 0)
+    assert check_join(hashJoin(mem, disk, R, S)[0], R, S) == ([], 800)
+    R, S = relations(disk, 2000)
+    gc.collect()
+    assert check_join(hashJoin(mem, disk, R, S)[0], R, S) == ([], 800)
+
+def test_lambda_hash_functions_do_not_share_partitions(disk):
+    mem = VirtualMemory()
+    R, S = relations(disk, 0)
+    T = generateRelation(disk, "T", 400, refKeys=R.refKeys)
+    modulo = lambda key, size, seed=0: key % size
+    shifted = lambda key, size, seed=0: (key // 7) % size
+    assert check_join(hashJoin(mem, disk, R, T, hashFn=modulo)[0], R, T) == ([], 400)
+    assert check_join(hashJoin(mem, disk, R, S, hashFn=shifted)[0], R, S) == ([], 800)
+
+@pytest.mark.parametrize("mem_size, sizes", [(15, (5000, 1000)), (6, (3000, 3000)), (4, (1500, 2500))])
+def test_columnar_join_counts_the_same_io(disk, mem_size, sizes):
+    R = generateRelation(disk, "R", sizes[0], keyRange=(0, 10 * sizes[0]), unique=True)
+    S = generateRelation(disk, "S", sizes[1], refKeys=R.refKeys)
+    mem = VirtualMemory(mem_size)
+    rows, io_count = hashJoin(mem, disk, R, S, hashFn=mixHash)
+    mem.catalog.clear()
+    toColumnar(disk, R)
+    toColumnar(disk, S)
+    columnarRows, columnarIoCount = columnarHashJoin(mem, disk, R, S)
+    assert columnarIoCount == io_count
+    assert check_join(columnarRows, R, S) == ([], sizes[1])
+
+def test_parallel_join_repartitions_in_workers(disk):
+    R = generateRelation(disk, "R", 3000, keyRange=(0, 30000), unique=True)
+    S = generateRelation(disk, "S", 3000, refKeys=R.refKeys)
+    mem = VirtualMemory(6)
+    rows, io_count = hashJoin(mem, disk, R, S)
+    mem.catalog.clear()
+    parallelRows, parallelIoCount = hashJoin(mem, disk, R, S, workers=2)
+    assert parallelRows == rows
+    assert parallelIoCount == io_count
+
+def test_bloom_filter_is_built_for_cached_partitions(disk):
+    R = generateRelation(disk, "R", 2000, keyRange=(0, 20000), unique=True)
+    S = generateRelation(disk, "S", 3000, refKeys=R.refKeys, matchRate=0.2)
+    mem = VirtualMemory()
+    hashJoin(mem, disk, R, S)
+    rows, _ = hashJoin(mem, disk, R, S, bloom=True)
+    assert check_join(rows, R, S) == ([], 600)
+    bloom = mem.catalog.peek(R, mem.SIZE - 1, jenkinsHash).filter
+    assert bloom != None and bloom.tested == 3000 and bloom.passed < 1000
+
+def test_mapped_blocks_reject_blocks_of_the_wrong_shape(tmp_path):
+    blocks = MappedBlocks(str(tmp_path / "disk"), 10, 10, 4)
+    blocks[0] = VirtualDiskBlock(10, [(1, "a"), (2, "b")])
+    with pytest.raises(ValueError):
+        blocks[1] = ColumnarBlock(10, [1, 2], b"x" * 24, 12)
+    with pytest.raises(ValueError):
+        blocks[1] = ColumnarBlock(10, [1, 2], b"x" * 15, 10)
+    with pytest.raises(ValueError):
+        blocks[1] = VirtualDiskBlock(20, [(1, "a")])
+    with pytest.raises(ValueError):
+        blocks[1] = VirtualDiskBlock(10, [(1, "a", "b")])
+    blocks.close()
+
+def test_multiway_join_matches_the_pairwise_chain(disk):
+    R, S = relations(disk, 0)
+    T = generateRelation(disk, "T", 600, refKeys=R.refKeys)
+    cursor = disk.cursor
+    mem = VirtualMemory(6)
+    chainRows, chainIoCount, _ = pairwiseJoinChain(mem, disk, [R, S, T])
+    mem.catalog.clear()
+    assert disk.cursor == cursor
+    assert all(disk.array[block_id] == None for block_id in range(cursor, cursor + 200))
+    rows, io_count, _ = multiwayHashJoin(mem, disk, [R, S, T])
+    assert check_join(rows, R, S, T)[0] == []
+    assert Counter(rows) == Counter(chainRows)
+    assert io_count < chainIoCount
+
+def test_iterator_open_is_idempotent_and_ends_with_stop_iteration(disk):
+    mem = VirtualMemory()
+    R, S = relations(disk, 0)
+    join = HashJoinIterator(mem, disk, R, S)
+    join.open()
+    rows = list(join)
+    assert check_join(rows, R, S) == ([], 800)
+    assert join.p1.pins == 0 and join.p2.pins == 0
+    with pytest.raises(StopIteration):
+        join.next()
+    join.open()
+    assert join.next() in rows
+    join.close()
+    assert join.p1.pins == 0 and join.p2.pins == 0
+
+def test_iterator_probes_the_output_of_another_join(disk):
+    # Every S key is drawn from R, so R ⨝ S projected to (B, S value) joined with T is T ⨝ S
+    R, S = relations(disk, 0)
+    T = generateRelation(disk, "T", 600, refKeys=R.refKeys)
+    inner = HashJoinIterator(VirtualMemory(), disk, R, S, columns=(0, 2))
+    rows = list(HashJoinIterator(VirtualMemory(), disk, T, inner))
+    problems, count = check_join(rows, T, S)
+    assert problems == [] and count > 0
+
+def test_skew_report_warns_about_skew_and_the_bucket_cap(disk):
+    mem = VirtualMemory()
+    uniform = generateRelation(disk, "U", 5000, keyRange=(0, 50000))
+    skewed = generateRelation(disk, "Z", 2000, keyRange=(0, 50000), distribution="zipf", skew=1.5)
+    for R in (uniform, skewed):
+        generateBuckets(mem, disk, R, mem.SIZE - 1, hashFn=mixHash)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        report = skewReport(mem, disk, uniform, mixHash)
+    assert report["over memory"] and report["skewed"] == [] and report["over cap"] == []
+    with pytest.warns(UserWarning, match="skewed buckets"):
+        report = skewReport(mem, disk, skewed, mixHash)
+    assert report["skewed"] and report["max/mean"] > 2
+    disk.BUCKET_CAP = 30
+    with pytest.warns(UserWarning, match="BUCKET_CAP"):
+        assert skewReport(mem, disk, uniform, mixHash)["over cap"] == list(range(mem.SIZE - 1))
+
+@pytest.mark.parametrize("save, load, suffix", [(saveRelationCSV, loadRelationCSV, "csv"), (saveRelationBinary, loadRelationBinary, "bin")])
+def test_relation_round_trips_through_the_loaders(disk, tmp_path, save, load, suffix):
+    R = generateRelation(disk, "R", 333, keyRange=(0, 1000), distribution="zipf")
+    path = str(tmp_path / f"R.{suffix}")
+    save(disk, R, path)
+    loaded = load(disk, path)
+    assert loaded.name == "R" and loaded.size == 333 and loaded.base_address > R.base_address
+    assert readRelation(disk, loaded) == readRelation(disk, R) == R.ref
+
+def test_loaders_reject_foreign_files(disk, tmp_path):
+    path = tmp_path / "R.bin"
+    path.write_bytes(b"CSV1" + bytes(8))
+    with pytest.raises(ValueError):
+        loadRelationBinary(disk, str(path))
+
+@pytest.mark.parametrize("distribution", ["uniform", "zipf"])
+def test_generated_keys(disk, distribution):
+    unique = generateRelation(disk, "U", 2000, keyRange=(0, 2500), unique=True)
+    keys = [key for key, _ in unique.ref]
+    assert len(set(keys)) == 2000 and all(0 <= key <= 2500 for key in keys)
+    R = generateRelation(disk, "R", 3000, refKeys=unique.refKeys, distribution=distribution)
+    assert {key for key, _ in R.ref} <= unique.refKeys
+    S = generateRelation(disk, "S", 3000, keyRange=(0, 2500), refKeys=unique.refKeys, distribution=distribution, matchRate=0.25)
+    assert sum(key in unique.refKeys for key, _ in S.ref) == 750
+    assert all(key > 2500 for key, _ in S.ref if key not in unique.refKeys)
+    with pytest.raises(ValueError):
+        generateRelation(disk, "Z", 10, distribution="zipf", unique=True)
+
+def skewedRelations(disk, distribution, sizes=(600, 900)):
+    R = generateRelation(disk, "R", sizes[0], keyRange=(0, 3 * sizes[0]), distribution=distribution)
+    S = generateRelation(disk, "S", sizes[1], refKeys=R.refKeys, distribution=distribution, matchRate=0.8)
+    return R, S
+
+@pytest.mark.parametrize("mem_size", [3, 4, 6])
+@pytest.mark.parametrize("distribution", ["uniform", "zipf"])
+def test_hybrid_hash_join_at_small_memory(disk, mem_size, distribution):
+    R, S = skewedRelations(disk, distribution)
+    blocks = len(disk.array)
+    rows, io_count, phases = hybridHashJoin(VirtualMemory(mem_size), disk, R, S)
+    assert check_join(rows, R, S)[0] == []
+    assert io_count > 0 and sum(phases.values()) == io_count
+    assert len(disk.array) == blocks
+
+@pytest.mark.parametrize("mem_size", [3, 4, 6])
+@pytest.mark.parametrize("max_runs", [1, 3])
+def test_external_sort_runs_are_sorted(disk, mem_size, max_runs):
+    R, _ = skewedRelations(disk, "zipf")
+    mem = VirtualMemory(mem_size)
+    runs = externalSort(mem, disk, relationRun(disk, R), max_runs)
+    assert 1 <= len(runs) <= max_runs and sum(count for _, count in runs) == R.size
+    scanned = [list(scanRun(mem, disk, run, mem.base_address)) for run in runs]
+    assert all([key for key, _ in run] == sorted(key for key, _ in run) for run in scanned)
+    assert Counter(tuple for run in scanned for tuple in run) == Counter(R.ref)
+
+@pytest.mark.parametrize("mem_size", [3, 4, 6])
+@pytest.mark.parametrize("distribution", ["uniform", "zipf"])
+def test_sort_merge_join_at_small_memory(disk, mem_size, distribution):
+    R, S = skewedRelations(disk, distribution)
+    blocks = len(disk.array)
+    rows, io_count, phases = sortMergeJoin(VirtualMemory(mem_size), disk, R, S)
+    assert check_join(rows, R, S)[0] == []
+    assert sum(phases.values()) == io_count
+    assert len(disk.array) == blocks
+
+def sortedCopy(disk, R):
+    return writeRelation(disk, R.name, sorted(R.ref), is_sorted=True)
+
+@pytest.mark.parametrize("mem_size, sizes, presorted, method", [
+    (15, (100, 3000), False, "hybrid hash"),
+    (4, (3000, 500), False, "index nested-loop"),
+    (6, (1500, 1500), True, "sort-merge"),
+])
+def test_planner_picks_the_cheapest_join(disk, mem_size, sizes, presorted, method):
+    # Cases with a clear winner: the planned method must also cost the least actual IO
+    R, S = skewedRelations(disk, "uniform", sizes)
+    if presorted:
+        R, S = sortedCopy(disk, R), sortedCopy(disk, S)
+    mem = VirtualMemory(mem_size)
+    rows, io_count, chosen, estimates = plannedJoin(mem, disk, R, S)
+    assert chosen == method and check_join(rows, R, S)[0] == []
+    mem.catalog.clear()
+    actual = {"grace hash": hashJoin(mem, disk, R, S)[1],
+              "hybrid hash": hybridHashJoin(mem, disk, R, S)[1],
+              "sort-merge": sortMergeJoin(mem, disk, R, S)[1],
+              "index nested-loop": indexNestedLoopJoin(mem, disk, R, S)[1]}
+    assert actual[method] == io_count == min(actual.values())
+
+@pytest.mark.parametrize("mem_size", [4, 15])
+@pytest.mark.parametrize("distribution", ["uniform", "zipf"])
+def test_index_nested_loop_join(disk, mem_size, distribution):
+    R, S = skewedRelations(disk, distribution)
+    mem = VirtualMemory(mem_size)
+    rows, io_count, phases = indexNestedLoopJoin(mem, disk, R, S)
+    assert check_join(rows, R, S)[0] == []
+    assert phases["index build"] == R.numBlocks(disk.BLOCK_SIZE)
+    index = buildIndex(mem, disk, R)
+    rows, probeIoCount, phases = indexNestedLoopJoin(mem, disk, R, S, index)
+    assert check_join(rows, R, S)[0] == [] and "index build" not in phases
+    assert io_count - probeIoCount == R.numBlocks(disk.BLOCK_SIZE)
+    # Skewed probes, and keys past the last one indexed, reach fewer nodes than the
+    # uniform probes the estimate assumes
+    assert estimateIndexCost(mem, disk, R, S) >= io_count
+    assert estimateIndexCost(mem, disk, R, S, index) >= probeIoCount
+
+@pytest.mark.parametrize("mem_size", [4, 15])
+def test_index_cost_estimate_for_uniform_probes(disk, mem_size):
+    R = generateRelation(disk, "R", 5000, keyRange=(0, 50000), unique=True)
+    S = generateRelation(disk, "S", 1000, refKeys=R.refKeys)
+    mem = VirtualMemory(mem_size)
+    io_count = indexNestedLoopJoin(mem, disk, R, S)[1]
+    assert abs(estimateIndexCost(mem, disk, R, S) - io_count) <= 0.02 * io_count
+    index = buildIndex(mem, disk, R)
+    io_count = indexNestedLoopJoin(mem, disk, R, S, index)[1]
+    assert abs(estimateIndexCost(mem, disk, R, S, index) - io_count) <= 0.02 * io_count
+
+def test_planner_probes_an_existing_index(disk):
+    R = generateRelation(disk, "R", 5000, keyRange=(0, 50000), unique=True)
+    S = generateRelation(disk, "S", 200, refKeys=R.refKeys)
+    mem = VirtualMemory()
+    index = buildIndex(mem, disk, R)
+    rows, io_count, method, estimates = plannedJoin(mem, disk, R, S, index)
+    assert method == "index nested-loop" and check_join(rows, R, S) == ([], 200)
+    mem.catalog.clear()
+    assert io_count < min(hashJoin(mem, disk, R, S)[1], hybridHashJoin(mem, disk, R, S)[1], sortMergeJoin(mem, disk, R, S)[1])
+    assert plannedJoin(mem, disk, R, S)[2] != "index nested-loop"
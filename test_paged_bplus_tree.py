@@ -0,0 +1,63 @@
+import random
+import pytest
+from bplus_tree import BPlusTree
+from paged_bplus_tree import BufferPool, PagedBPlusTree
+
+def test_eviction_skips_pinned_pages(tmp_path):
+    with PagedBPlusTree(str(tmp_path / "tree"), 4, pool_size=64) as tree:
+        tree.build(range(200))
+        page_ids = list(tree.pool.pages)[:3]
+        tree.flush()
+        pool = BufferPool(tree.page_file, capacity=2)
+        first, second, third = page_ids
+        pool.fetch(first)
+        pool.fetch(second)
+        with pytest.raises(RuntimeError):
+            pool.fetch(third)
+        pool.release(keep=(first,))
+        pool.fetch(third)
+        assert set(pool.pages) == {first, third}
+
+@pytest.mark.parametrize("order", [3, 4, 13])
+def test_small_pool_matches_model(tmp_path, order):
+    rng, model = random.Random(order), set()
+    path = str(tmp_path / "tree")
+    with PagedBPlusTree(path, order, pool_size=16) as tree:
+        for _ in range(4000):
+            key, op = rng.randrange(1500), rng.random()
+            if op < 0.5:
+                tree.insert(key)
+                model.add(key)
+            elif op < 0.8:
+                tree.delete(key)
+                model.discard(key)
+            elif op < 0.9:
+                assert tree.search(key) == ([key] if key in model else [])
+            else:
+                assert tree.range_search(key, key + 200) == sorted(k for k in model if key <= k <= key + 200)
+            assert len(tree.pool.pages) <= 16
+    with PagedBPlusTree(path, order, pool_size=16) as tree:
+        assert tree.range_search(0, 1500) == sorted(model)
+
+# PagedBPlusTree reimplements the node logic over int64 pages, so it is checked against BPlusTree
+@pytest.mark.parametrize("order,is_sparse", [(3, False), (4, True), (13, False)])
+def test_matches_bplus_tree(tmp_path, order, is_sparse):
+    rng, reference = random.Random(order), BPlusTree(order, is_sparse, typecode="q", value_typecode="q")
+    with PagedBPlusTree(str(tmp_path / "tree"), order, is_sparse) as tree:
+        for _ in range(3000):
+            key, op = rng.randrange(-500, 1000), rng.random()
+            if op < 0.5:
+                value = rng.randrange(1 << 40)
+                tree.insert(key, value)
+                reference.insert(key, value)
+            elif op < 0.8:
+                tree.delete(key)
+                reference.delete(key)
+            elif op < 0.9:
+                assert tree.get(key) == reference.get(key)
+                assert tree.search(key) == reference.search(key)
+            else:
+                assert tree.range_search(key, key + 100) == reference.range_search(key, key + 100)
+        items = list(reference.leaf_items())
+        assert tree.range_search(-500, 1000) == [key for key, _ in items]
+        assert [tree.get(key) for key, _ in items] == [value for _, value in items]
@@ -0,0 +1,262 @@
+import argparse, random, time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from itertools import chain
+from tabulate import tabulate
+
+# Keys per chunk of the reference model; chunks split at twice this
+CHUNK_SIZE = 1000
+
+class ReferenceModel:
+    # Expected contents of a unique BPlusTree: a dict for point lookups next to a chunked
+    # sorted list (sorted runs indexed by their last key) so inserts, deletes and range
+    # scans all stay logarithmic plus the size of the answer
+    def __init__(self, keys=(), values=None):
+        self.items = dict.fromkeys(keys) if values is None else dict(zip(keys, values))
+        ordered = sorted(self.items)
+        self.chunks = [ordered[i:i + CHUNK_SIZE] for i in range(0, len(ordered), CHUNK_SIZE)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def insert(self, key, value=None):
+        if key in self.items:
+            self.items[key] = value
+            return
+        self.items[key] = value
+        if not self.chunks:
+            self.chunks, self.maxes = [[key]], [key]
+            return
+        i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+        chunk = self.chunks[i]
+        insort(chunk, key)
+        self.maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self.chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self.maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def delete(self, key):
+        if key not in self.items:
+            return False
+        del self.items[key]
+        i = bisect_left(self.maxes, key)
+        chunk = self.chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        if chunk:
+            self.maxes[i] = chunk[-1]
+        else:
+            del self.chunks[i], self.maxes[i]
+        return True
+
+    def delete_range(self, start, end):
+        for key in self.range_search(start, end):
+            self.delete(key)
+
+    def delete_many(self, keys):
+        for key in set(keys):
+            self.delete(key)
+
+    def get(self, key, default=None):
+        return self.items.get(key, default)
+
+    def search(self, key):
+        return [key] if key in self.items else []
+
+    def range_search(self, start, end):
+        ret, i = [], bisect_left(self.maxes, start)
+        while i < len(self.chunks):
+            chunk = self.chunks[i]
+            hi = bisect_right(chunk, end)
+            ret.extend(chunk[bisect_left(chunk, start):hi])
+            if hi < len(chunk):
+                break
+            i += 1
+        return ret
+
+    def keys(self):
+        return chain.from_iterable(self.chunks)
+
+def audit_tree(tree, check_fill=True, limit=20):
+    # Structural invariants of a BPlusTree: key order and separator bounds, node sizes
+    # (minimum fill can be skipped for trees bulk loaded below it), equal leaf depth, and
+    # consistent parent, root and leaf-chain pointers. Returns at most limit violations.
+    problems, leaves, depths = [], [], set()
+    stack = [(tree.root, None, None, None, 1)]
+    while stack and len(problems) < limit:
+        node, parent, lo, hi, depth = stack.pop()
+        keys, where = node.keys, f"node {list(node.keys[:3])}... at depth {depth}"
+        if node.parent is not parent:
+            problems.append(f"{where}: parent pointer does not point to its parent")
+        if node.is_root != (parent is None):
+            problems.append(f"{where}: is_root is {node.is_root}")
+        if node.threshold != tree.threshold:
+            problems.append(f"{where}: threshold {node.threshold}, tree has {tree.threshold}")
+        if any(a >= b for a, b in zip(keys, keys[1:])):
+            problems.append(f"{where}: keys out of order")
+        if keys and ((lo is not None and keys[0] < lo) or (hi is not None and keys[-1] >= hi)):
+            problems.append(f"{where}: keys outside the separator bounds [{lo}, {hi})")
+        if len(keys) > tree.threshold:
+            problems.append(f"{where}: {len(keys)} keys, more than {tree.threshold}")
+        if parent is not None and check_fill and len(keys) < node.min_keys():
+            problems.append(f"{where}: {len(keys)} keys, fewer than {node.min_keys()}")
+        if node.is_leaf:
+            if len(node.values) != len(keys):
+                problems.append(f"{where}: {len(node.values)} values for {len(keys)} keys")
+            leaves.append(node)
+            depths.add(depth)
+            continue
+        if len(node.children) != len(keys) + 1:
+            problems.append(f"{where}: {len(node.children)} children for {len(keys)} keys")
+            continue
+        if not keys:
+            problems.append(f"{where}: internal node without separators")
+        bounds = [lo] + list(keys) + [hi]
+        for i in reversed(range(len(node.children))):
+            stack.append((node.children[i], node, bounds[i], bounds[i + 1], depth + 1))
+    if len(depths) > 1:
+        problems.append(f"leaves at depths {sorted(depths)}")
+    for i, leaf in enumerate(leaves):
+        if leaf.prev is not (leaves[i - 1] if i else None) or leaf.next is not (leaves[i + 1] if i + 1 < len(leaves) else None):
+            problems.append(f"leaf {i} of {len(leaves)}: next/prev do not follow the tree order")
+            break
+    return problems[:limit]
+
+def check_tree(tree, model, check_fill=True):
+    # Audit plus a full comparison of the leaf level against the model
+    problems = audit_tree(tree, check_fill)
+    compare_values = tree.unique
+    expected = ((key, model.items[key]) for key in model.keys())
+    for i, (actual, wanted) in enumerate(zip(tree.leaf_items(), expected)):
+        if actual[0] != wanted[0] or (compare_values and actual[1] != wanted[1]):
+            problems.append(f"entry {i}: tree has {actual}, expected {wanted}")
+            break
+    size = tree.stats()["keys"]
+    if size != len(model):
+        problems.append(f"tree holds {size} keys, expected {len(model)}")
+    return problems
+
+def assert_tree(tree, model, check_fill=True):
+    problems = check_tree(tree, model, check_fill)
+    if problems:
+        raise AssertionError("; ".join(problems))
+
+def check_join(joinResults, R1, *others):
+    # Compares the output as a multiset of (key, R1 value, R2 value, ...) rows against the
+    # join computed from hash indexes on the other relations' refs, so duplicates and
+    # missing rows are both caught
+    expected = Counter((key, val) for key, val in R1.ref)
+    for R in others:
+        index = {}
+        for key, val in R.ref:
+            index.setdefault(key, []).append(val)
+        joined = Counter()
+        for row, n in expected.items():
+            for val in index.get(row[0], ()):
+                joined[row + (val,)] += n
+        expected = joined
+    actual = Counter(joinResults)
+    missing, extra = expected - actual, actual - expected
+    problems = []
+    if missing:
+        problems.append(f"{sum(missing.values())} rows missing, e.g. {next(iter(missing))}")
+    if extra:
+        problems.append(f"{sum(extra.values())} unexpected rows, e.g. {next(iter(extra))}")
+    return problems, sum(actual.values())
+
+STRESS_MIX = (("insert", 40), ("delete", 25), ("search", 20), ("range_search", 10), ("delete_range", 2), ("delete_many", 3))
+
+def stress_tree(tree, ops, seed=0, key_space=None, check_every=100000, check_fill=True, bulk_keys=0, fill_factor=1.0):
+    # Random operations applied to the tree and a reference model side by side; every
+    # result is compared as it comes and the whole tree is checked every check_every ops.
+    # With bulk_keys the tree is first bulk loaded with that many random keys at fill_factor.
+    # Raises AssertionError at the first divergence, otherwise returns the op counts.
+    rng = random.Random(seed)
+    key_space = key_space or max(1000, 2 * ops, 2 * bulk_keys)
+    if bulk_keys:
+        # Leaves packed below full stay underfull until deletes merge them
+        check_fill = check_fill and fill_factor >= 1.0
+        tree.bulk_load(rng.sample(range(key_space), bulk_keys), fill_factor)
+        problems = audit_tree(tree, check_fill)
+        if problems:
+            raise AssertionError(f"after bulk loading {bulk_keys} keys at fill {fill_factor}: " + "; ".join(problems))
+    items = list(tree.leaf_items())
+    model = ReferenceModel([key for key, _ in items], [value for _, value in items])
+    names = [name for name, _ in STRESS_MIX]
+    weights = [weight for _, weight in STRESS_MIX]
+    counts = Counter()
+    for i, op in enumerate(rng.choices(names, weights, k=ops), 1):
+        key = rng.randrange(key_space)
+        if op == "insert":
+            tree.insert(key, i)
+            model.insert(key, i)
+        elif op == "delete":
+            tree.delete(key)
+            model.delete(key)
+        elif op == "search":
+            ret, wanted = tree.search(key), model.search(key)
+            if ret != wanted:
+                raise AssertionError(f"op {i}: search({key}) returned {ret}, expected {wanted}")
+        elif op == "range_search":
+            end = key + rng.randint(0, 100)
+            ret, wanted = tree.range_search(key, end), model.range_search(key, end)
+            if ret != wanted:
+                raise AssertionError(f"op {i}: range_search({key}, {end}) returned {len(ret)} keys, expected {len(wanted)}")
+        elif op == "delete_range":
+            end = key + rng.randint(0, 50)
+            tree.delete_range(key, end)
+            model.delete_range(key, end)
+        else:
+            batch = [rng.randrange(key_space) for _ in range(rng.randint(1, 50))]
+            tree.delete_many(batch)
+            model.delete_many(batch)
+        counts[op] += 1
+        if i % check_every == 0 or i == ops:
+            problems = check_tree(tree, model, check_fill)
+            if problems:
+                raise AssertionError(f"after op {i} ({op}): " + "; ".join(problems))
+    return counts
+
+def main(argv=None):
+    from bplus_tree import BPlusTree, concurrent_stress_test, snapshot_stress_test
+    parser = argparse.ArgumentParser(description="Randomized differential test of BPlusTree against a reference model")
+    parser.add_argument("--ops", type=int, default=1000000)
+    parser.add_argument("--orders", type=int, nargs="+", default=[13, 24])
+    parser.add_argument("--layouts", nargs="+", choices=["dense", "sparse"], default=["dense", "sparse"])
+    parser.add_argument("--check-every", type=int, default=100000)
+    parser.add_argument("--bulk-keys", type=int, default=0, help="bulk load this many keys before the random operations")
+    parser.add_argument("--fill-factors", type=float, nargs="+", default=[1.0], help="fill factors of the bulk load")
+    parser.add_argument("--threads", type=int, nargs="+", help="also stress ConcurrentBPlusTree with these thread counts, --ops split between the threads")
+    parser.add_argument("--snapshot-scanners", type=int, help="also stress CopyOnWriteBPlusTree: one writer does --ops writes while this many threads scan snapshots")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    rows = []
+    for order in args.orders:
+        for layout in args.layouts:
+            for fill_factor in args.fill_factors if args.bulk_keys else [None]:
+                tree = BPlusTree(order, is_sparse=layout == "sparse")
+                begin = time.perf_counter()
+                counts = stress_tree(tree, args.ops, args.seed, check_every=args.check_every, bulk_keys=args.bulk_keys, fill_factor=fill_factor)
+                elapsed = time.perf_counter() - begin
+                rows.append([order, layout, fill_factor or "-", args.ops, len(list(tree.leaf_keys())), f"{elapsed:.1f}", f"{args.ops / elapsed:.0f}"])
+    print(tabulate(rows, headers=["Order", "Layout", "Bulk fill", "Ops", "Final keys", "Time (s)", "Ops/s"], tablefmt="rounded_grid"))
+    if args.threads:
+        random.seed(args.seed)
+        for order in args.orders:
+            print(f"ConcurrentBPlusTree, order {order}")
+            for threads, _, _, _, errors in concurrent_stress_test(order, args.threads, args.ops // max(args.threads)):
+                if errors:
+                    raise AssertionError(f"order {order}, {threads} threads: {errors} scans or searches saw a wrong result")
+    if args.snapshot_scanners:
+        random.seed(args.seed)
+        for order in args.orders:
+            print(f"CopyOnWriteBPlusTree, order {order}")
+            errors = snapshot_stress_test(order, writes=args.ops, scanners=args.snapshot_scanners)[-1]
+            if errors:
+                raise AssertionError(f"order {order}: {errors} snapshot scans were not consistent")
+
+if __name__ == "__main__":
+    main()